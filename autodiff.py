@@ -6,8 +6,18 @@ import forward_diff
 import reverse_diff
 import irvisitor
 
+def diff_struct_key(type_id : str, width : int | None) -> str | tuple[str, int]:
+    """ Key of a differential type in diff_structs.
+        Single-tangent types are keyed by the primal type ID (e.g., 'float'),
+        K-tangent types (K > 1) by (primal type ID, K).
+    """
+    if width is None or width == 1:
+        return type_id
+    return (type_id, width)
+
 def type_to_diff_type(diff_structs : dict[str, loma_ir.Struct],
-                      t : loma_ir.type) -> loma_ir.type:
+                      t : loma_ir.type,
+                      width : int | None = None) -> loma_ir.type:
     """ Given a loma type t, look up diff_structs for the differential type.
     For example, for float, we will generate a class "_dfloat" to represent
     both the primal value and the differential:
@@ -20,26 +30,30 @@ def type_to_diff_type(diff_structs : dict[str, loma_ir.Struct],
 
     diff_structs is a map that goes from the ID of the type to the differential
     struct. For example, diff_structs['float'] will return the _dfloat type.
+
+    When width = K > 1, the differential types carry K tangents
+    (see resolve_diff_types()), e.g., _dfloat_w4.
     """
 
     match t:
         case loma_ir.Int():
             return diff_structs['int']
         case loma_ir.Float():
-            return diff_structs['float']
+            return diff_structs[diff_struct_key('float', width)]
         case loma_ir.Array():
             return loma_ir.Array(\
-                type_to_diff_type(diff_structs, t.t),
+                type_to_diff_type(diff_structs, t.t, width),
                 t.static_size)
         case loma_ir.Struct():
-            return diff_structs[t.id]
+            return diff_structs[diff_struct_key(t.id, width)]
         case None:
             return None
         case _:
             assert False, f'Unhandled type {t}'
 
 def replace_diff_types(diff_structs : dict[str, loma_ir.Struct],
-                       func : loma_ir.FunctionDef) -> loma_ir.FunctionDef:
+                       func : loma_ir.FunctionDef,
+                       add_width = None) -> loma_ir.FunctionDef:
     """ Given a loma function func, find all function arguments and
         declarations with type Diff[...] and turn them into the 
         corresponding differential type by looking up diff_structs.
@@ -58,6 +72,10 @@ def replace_diff_types(diff_structs : dict[str, loma_ir.Struct],
         differential struct. For example, diff_structs['float'] will 
         return the _dfloat type.
 
+        Diff[float, K] resolves to the K-tangent type _dfloat_wK.
+        add_width(K) is called first so that the K-tangent
+        structs exist in diff_structs.
+
         Currently, we do not allow repeated applications of Diff[]
         (like Diff[Diff[float]]).
     """
@@ -75,13 +93,16 @@ def replace_diff_types(diff_structs : dict[str, loma_ir.Struct],
             case loma_ir.Struct():
                 return t
             case loma_ir.Diff():
+                width = t.width
+                if width is not None and width > 1 and add_width is not None:
+                    add_width(width)
                 t = _replace_diff_type(t.t)
                 if isinstance(t, loma_ir.Int):
                     return diff_structs['int']
                 elif isinstance(t, loma_ir.Float):
-                    return diff_structs['float']
+                    return diff_structs[diff_struct_key('float', width)]
                 elif isinstance(t, loma_ir.Struct):
-                    return diff_structs[t.id]
+                    return diff_structs[diff_struct_key(t.id, width)]
                 else:
                     # TODO: throw an user error
                     assert False, "No Diff[Array]"
@@ -142,6 +163,13 @@ def resolve_diff_types(structs : dict[str, loma_ir.Struct],
 
         The naming of the differential Structs is done by prefixing '_d' to the struct ID.
 
+        For vector forward mode (fwd_diff(f, width = K) or Diff[T, K]), we additionally
+        generate K-tangent versions of the differential Structs:
+        class _dfloat_wK:
+            val : float
+            dval : Array[float, K]
+        and _dFoo_wK built from them, keyed by ('float', K) and ('Foo', K) in diff_structs.
+
         Next, we go through all functions in funcs, and resolve the Diff[] types.
         See replace_diff_types() for more details.
 
@@ -168,31 +196,69 @@ def resolve_diff_types(structs : dict[str, loma_ir.Struct],
 
     diff_structs['int'] = loma_ir.Int()
 
-    def convert_struct_to_diff(s):
+    def convert_struct_to_diff(s, dfloat_t, suffix):
         match s:
             case loma_ir.Float():
-                return dfloat
+                return dfloat_t
             case loma_ir.Int():
                 return loma_ir.Int()
             case loma_ir.Array():
                 return loma_ir.Array(\
-                    convert_struct_to_diff(s.t), s.static_size)
+                    convert_struct_to_diff(s.t, dfloat_t, suffix), s.static_size)
             case loma_ir.Struct():
-                return loma_ir.Struct('_d' + s.id,
-                    [loma_ir.MemberDef(m.id, convert_struct_to_diff(m.t)) for m in s.members])
+                return loma_ir.Struct('_d' + s.id + suffix,
+                    [loma_ir.MemberDef(m.id, convert_struct_to_diff(m.t, dfloat_t, suffix)) for m in s.members])
             case _:
                 assert False
 
-    for s in structs.values():
-        diff_structs[s.id] = convert_struct_to_diff(s)
+    primal_structs = list(structs.values())
+    for s in primal_structs:
+        diff_structs[s.id] = convert_struct_to_diff(s, dfloat, '')
 
     for ds in diff_structs.values():
         if isinstance(ds, loma_ir.Struct):
             structs[ds.id] = ds
 
+    def add_width(width):
+        """ Generate the K-tangent differential Structs and their
+            make__dfloat_wK constructor, if not done already.
+        """
+        if diff_struct_key('float', width) in diff_structs:
+            return
+        suffix = f'_w{width}'
+        dfloat_w = loma_ir.Struct('_dfloat' + suffix,
+                                  [loma_ir.MemberDef('val', loma_ir.Float()),
+                                   loma_ir.MemberDef('dval', loma_ir.Array(loma_ir.Float(), width))])
+        assert dfloat_w.id not in structs
+        diff_structs[diff_struct_key('float', width)] = dfloat_w
+        structs[dfloat_w.id] = dfloat_w
+        for s in primal_structs:
+            ds = convert_struct_to_diff(s, dfloat_w, suffix)
+            diff_structs[diff_struct_key(s.id, width)] = ds
+            structs[ds.id] = ds
+
+        dval_t = loma_ir.Array(loma_ir.Float(), width)
+        make_id = 'make_' + dfloat_w.id
+        funcs[make_id] = loma_ir.FunctionDef(
+            make_id,
+            args = [loma_ir.Arg('val', loma_ir.Float(), loma_ir.In())] + \
+                   [loma_ir.Arg(f'dval{i}', loma_ir.Float(), loma_ir.In()) for i in range(width)],
+            body = [loma_ir.Declare('ret', dfloat_w),
+                    loma_ir.Assign(loma_ir.StructAccess(loma_ir.Var('ret'), 'val'), loma_ir.Var('val'))] + \
+                   [loma_ir.Assign(loma_ir.ArrayAccess(loma_ir.StructAccess(loma_ir.Var('ret'), 'dval', t = dval_t),
+                                                       loma_ir.ConstInt(i)),
+                                   loma_ir.Var(f'dval{i}')) for i in range(width)] + \
+                   [loma_ir.Return(loma_ir.Var('ret'))],
+            is_simd = False,
+            ret_type = dfloat_w)
+
+    for f in list(funcs.values()):
+        if isinstance(f, loma_ir.ForwardDiff) and f.width is not None and f.width > 1:
+            add_width(f.width)
+
     # Replace all Diff types with their differential types in the code
-    for f in funcs.values():
-        funcs[f.id] = replace_diff_types(diff_structs, f)
+    for f in list(funcs.values()):
+        funcs[f.id] = replace_diff_types(diff_structs, f, add_width)
 
     # Create a make__dfloat function
     funcs['make__dfloat'] = loma_ir.FunctionDef(
@@ -253,32 +319,39 @@ def differentiate(structs : dict[str, loma_ir.Struct],
     """
 
     # Map functions to their forward/reverse versions
-    func_to_fwd = dict()
+    # (forward mode is keyed by the number of tangents as well)
+    func_to_fwd_by_width = dict()
     func_to_rev = dict()
     for f in funcs.values():
         if isinstance(f, loma_ir.ForwardDiff):
-            func_to_fwd[f.primal_func] = f.id
+            width = f.width if f.width is not None else 1
+            func_to_fwd_by_width.setdefault(width, dict())[f.primal_func] = f.id
         elif isinstance(f, loma_ir.ReverseDiff):
             func_to_rev[f.primal_func] = f.id
 
     # Traverse: for each function that requires forward diff
     # recursively having all called functions to require forward diff
     # as well
-    visited_func = set(func_to_fwd.keys())
-    func_stack = list(func_to_fwd.keys())
-    while len(func_stack) > 0:
-        primal_func_id = func_stack.pop()
-        primal_func = funcs[primal_func_id]
-        if primal_func_id not in func_to_fwd:
-            fwd_func_id = '_d_fwd_' + primal_func_id
-            func_to_fwd[primal_func_id] = fwd_func_id
-            funcs[fwd_func_id] = loma_ir.ForwardDiff(fwd_func_id, primal_func_id)
-        cfv = CallFuncVisitor()
-        cfv.visit_function(primal_func)
-        for f in cfv.called_func_ids:
-            if f not in visited_func:
-                visited_func.add(f)
-                func_stack.append(f)
+    for width, func_to_fwd in func_to_fwd_by_width.items():
+        visited_func = set(func_to_fwd.keys())
+        func_stack = list(func_to_fwd.keys())
+        while len(func_stack) > 0:
+            primal_func_id = func_stack.pop()
+            primal_func = funcs[primal_func_id]
+            if primal_func_id not in func_to_fwd:
+                if width == 1:
+                    fwd_func_id = '_d_fwd_' + primal_func_id
+                    funcs[fwd_func_id] = loma_ir.ForwardDiff(fwd_func_id, primal_func_id)
+                else:
+                    fwd_func_id = f'_d_fwd_w{width}_' + primal_func_id
+                    funcs[fwd_func_id] = loma_ir.ForwardDiff(fwd_func_id, primal_func_id, width)
+                func_to_fwd[primal_func_id] = fwd_func_id
+            cfv = CallFuncVisitor()
+            cfv.visit_function(primal_func)
+            for f in cfv.called_func_ids:
+                if f not in visited_func:
+                    visited_func.add(f)
+                    func_stack.append(f)
     # Do the same for reverse diff
     visited_func = set(func_to_rev.keys())
     func_stack = list(func_to_rev.keys())
@@ -296,11 +369,12 @@ def differentiate(structs : dict[str, loma_ir.Struct],
                 visited_func.add(f)
                 func_stack.append(f)
 
-    for f in funcs.values():
+    for f in list(funcs.values()):
         if isinstance(f, loma_ir.ForwardDiff):
+            width = f.width if f.width is not None else 1
             fwd_diff_func = forward_diff.forward_diff(\
                 f.id, structs, funcs, diff_structs,
-                funcs[f.primal_func], func_to_fwd)
+                funcs[f.primal_func], func_to_fwd_by_width[width], width)
             funcs[f.id] = fwd_diff_func
             import pretty_print
             print(f'\nForward differentiation of function {f.id}:')
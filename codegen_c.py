@@ -5,23 +5,26 @@ import _asdl.loma as loma_ir
 import irvisitor
 import compiler
 
-def type_to_string(node : loma_ir.type | loma_ir.arg) -> str:
+FLOAT_INTRINSICS = {'sin', 'cos', 'sqrt', 'pow', 'exp', 'log'} # Math functions C has an f-suffixed single precision version of
+
+def type_to_string(node : loma_ir.type | loma_ir.arg, float_type : str = 'float') -> str:
     """ Given a loma type, return a string that represents
-        the type in C.
+        the type in C. float_type is the C type loma floats are lowered to
+        ('float' or 'double', see compiler.compile's precision argument).
     """
 
     match node:
         case loma_ir.Arg():
             if isinstance(node.t, loma_ir.Array):
-                return type_to_string(node.t)
+                return type_to_string(node.t, float_type)
             else:
-                return type_to_string(node.t) + ('*' if node.i == loma_ir.Out() else '')
+                return type_to_string(node.t, float_type) + ('*' if node.i == loma_ir.Out() else '')
         case loma_ir.Int():
             return 'int'
         case loma_ir.Float():
-            return 'float'
+            return float_type
         case loma_ir.Array():
-            return type_to_string(node.t) + '*'
+            return type_to_string(node.t, float_type) + '*'
         case loma_ir.Struct():
             return node.id
         case None:
@@ -37,19 +40,21 @@ class CCodegenVisitor(irvisitor.IRVisitor):
     code = ''
     tab_count = 0
     funcs_defs = None
+    float_type = 'float'
 
-    def __init__(self, func_defs):
+    def __init__(self, func_defs, float_type = 'float'):
         self.func_defs = func_defs
+        self.float_type = float_type
 
     def emit_tabs(self):
         self.code += '\t' * self.tab_count
 
     def visit_function_def(self, node):
-        self.code += f'{type_to_string(node.ret_type)} {node.id}('
+        self.code += f'{type_to_string(node.ret_type, self.float_type)} {node.id}('
         for i, arg in enumerate(node.args):
             if i > 0:
                 self.code += ', '
-            self.code += f'{type_to_string(arg)} {arg.id}'
+            self.code += f'{type_to_string(arg, self.float_type)} {arg.id}'
         if node.is_simd:
             if len(node.args) > 0:
                 self.code += ', '
@@ -101,11 +106,11 @@ class CCodegenVisitor(irvisitor.IRVisitor):
     def visit_declare(self, node):
         self.emit_tabs()
         if not isinstance(node.t, loma_ir.Array):
-            self.code += f'{type_to_string(node.t)} {node.target}'
+            self.code += f'{type_to_string(node.t, self.float_type)} {node.target}'
         else:
             # Special rule for arrays
             assert node.t.static_size != None
-            self.code += f'{type_to_string(node.t.t)} {node.target}[{node.t.static_size}]'
+            self.code += f'{type_to_string(node.t.t, self.float_type)} {node.target}[{node.t.static_size}]'
         if node.val is not None:
             self.code += f' = {self.visit_expr(node.val)};\n'
         else:
@@ -162,7 +167,7 @@ class CCodegenVisitor(irvisitor.IRVisitor):
             case loma_ir.StructAccess():
                 return f'({self.visit_expr(node.struct)}).{node.member_id}'
             case loma_ir.ConstFloat():
-                return f'(float)({node.val})'
+                return f'({self.float_type})({node.val})'
             case loma_ir.ConstInt():
                 return f'(int)({node.val})'
             case loma_ir.BinaryOp():
@@ -200,20 +205,11 @@ class CCodegenVisitor(irvisitor.IRVisitor):
                     return f'{arg0_str} += {arg1_str}'
                 func_id = node.id
                 # call the single precision versions of the intrinsic functions
-                if func_id == 'sin':
-                    func_id = 'sinf'
-                elif func_id == 'cos':
-                    func_id = 'cosf'
-                elif func_id == 'sqrt':
-                    func_id = 'sqrtf'
-                elif func_id == 'pow':
-                    func_id = 'powf'
-                elif func_id == 'exp':
-                    func_id = 'expf'
-                elif func_id == 'log':
-                    func_id = 'logf'
-                elif func_id == 'int2float':
-                    func_id = '(float)'
+                # (the unsuffixed C names are already the double precision ones)
+                if self.float_type == 'float' and func_id in FLOAT_INTRINSICS:
+                    func_id += 'f'
+                if func_id == 'int2float':
+                    func_id = f'({self.float_type})'
                 elif func_id == 'float2int':
                     func_id = '(int)'
 
@@ -236,7 +232,8 @@ class CCodegenVisitor(irvisitor.IRVisitor):
                 assert False, f'Visitor error: unhandled expression {expr}'
 
 def codegen_c(structs : dict[str, loma_ir.Struct],
-              funcs : dict[str, loma_ir.func]) -> str:
+              funcs : dict[str, loma_ir.func],
+              float_type : str = 'float') -> str:
     """ Given loma Structs (structs) and loma functions (funcs),
         return a string that represents the equivalent C code.
 
@@ -245,6 +242,7 @@ def codegen_c(structs : dict[str, loma_ir.Struct],
                 the corresponding Struct
         funcs - a dictionary that maps the ID of a function to 
                 the corresponding func
+        float_type - the C type loma floats are lowered to, 'float' or 'double'
     """
 
     sorted_structs_list = compiler.topo_sort_structs(structs)
@@ -256,18 +254,18 @@ def codegen_c(structs : dict[str, loma_ir.Struct],
         for m in s.members:
             # Special rule for arrays
             if isinstance(m.t, loma_ir.Array) and m.t.static_size is not None:
-                code += f'\t{type_to_string(m.t.t)} {m.id}[{m.t.static_size}];\n'
+                code += f'\t{type_to_string(m.t.t, float_type)} {m.id}[{m.t.static_size}];\n'
             else:
-                code += f'\t{type_to_string(m.t)} {m.id};\n'
+                code += f'\t{type_to_string(m.t, float_type)} {m.id};\n'
         code += f'}} {s.id};\n'
 
     # Forward declaration of functions
     for f in funcs.values():
-        code += f'{type_to_string(f.ret_type)} {f.id}('
+        code += f'{type_to_string(f.ret_type, float_type)} {f.id}('
         for i, arg in enumerate(f.args):
             if i > 0:
                 code += ', '
-            code += f'{type_to_string(arg)} {arg.id}'
+            code += f'{type_to_string(arg, float_type)} {arg.id}'
         if f.is_simd:
             if len(f.args) > 0:
                 code += ', '
@@ -275,7 +273,7 @@ def codegen_c(structs : dict[str, loma_ir.Struct],
         code += ');\n'
 
     for f in funcs.values():
-        cg = CCodegenVisitor(funcs)
+        cg = CCodegenVisitor(funcs, float_type)
         cg.visit_function(f)
         code += cg.code
     return code
@@ -9,8 +9,8 @@ class ISPCCodegenVisitor(codegen_c.CCodegenVisitor):
         See https://ispc.github.io/index.html for more details about ispc.
     """
 
-    def __init__(self, func_defs):
-        super().__init__(func_defs)
+    def __init__(self, func_defs, float_type = 'float'):
+        super().__init__(func_defs, float_type)
 
     def visit_function_def(self, node):
         if node.is_simd:
@@ -18,7 +18,7 @@ class ISPCCodegenVisitor(codegen_c.CCodegenVisitor):
             for i, arg in enumerate(node.args):
                 if i > 0:
                     self.code += ', '
-                self.code += f'uniform {codegen_c.type_to_string(arg)} uniform {arg.id}'
+                self.code += f'uniform {codegen_c.type_to_string(arg, self.float_type)} uniform {arg.id}'
             if len(node.args) > 0:
                 self.code += ', '
             self.code += 'uniform int total_work'
@@ -55,7 +55,7 @@ class ISPCCodegenVisitor(codegen_c.CCodegenVisitor):
             for i, arg in enumerate(node.args):
                 if i > 0:
                     self.code += ', '
-                self.code += f'uniform {codegen_c.type_to_string(arg)} uniform {arg.id}'
+                self.code += f'uniform {codegen_c.type_to_string(arg, self.float_type)} uniform {arg.id}'
             if len(node.args) > 0:
                 self.code += ', '
             self.code += 'uniform int total_work'
@@ -74,11 +74,11 @@ class ISPCCodegenVisitor(codegen_c.CCodegenVisitor):
             self.code += '\tsync;\n'
             self.code += '}\n'
         else:
-            self.code += f'extern \"C\" {codegen_c.type_to_string(node.ret_type)} {node.id}('
+            self.code += f'extern \"C\" {codegen_c.type_to_string(node.ret_type, self.float_type)} {node.id}('
             for i, arg in enumerate(node.args):
                 if i > 0:
                     self.code += ', '
-                self.code += f'{codegen_c.type_to_string(arg)} {arg.id}'
+                self.code += f'{codegen_c.type_to_string(arg, self.float_type)} {arg.id}'
             self.code += ') {\n'
             self.tab_count += 1
 
@@ -114,7 +114,8 @@ class ISPCCodegenVisitor(codegen_c.CCodegenVisitor):
         return super().visit_expr(node)
 
 def codegen_ispc(structs : dict[str, loma_ir.Struct],
-                 funcs : dict[str, loma_ir.func]) -> str:
+                 funcs : dict[str, loma_ir.func],
+                 float_type : str = 'float') -> str:
     """ Given loma Structs (structs) and loma functions (funcs),
         return a string that represents the equivalent ISPC code.
 
@@ -123,6 +124,7 @@ def codegen_ispc(structs : dict[str, loma_ir.Struct],
                 the corresponding Struct
         funcs - a dictionary that maps the ID of a function to 
                 the corresponding func
+        float_type - the type loma floats are lowered to, 'float' or 'double'
     """
 
     sorted_structs_list = compiler.topo_sort_structs(structs)
@@ -132,7 +134,7 @@ def codegen_ispc(structs : dict[str, loma_ir.Struct],
     for s in sorted_structs_list:
         code += f'struct {s.id} {{\n'
         for m in s.members:
-            code += f'\t{codegen_c.type_to_string(m.t)} {m.id};\n'
+            code += f'\t{codegen_c.type_to_string(m.t, float_type)} {m.id};\n'
         code += f'}};\n'
 
     # Forward declaration of functions
@@ -141,13 +143,13 @@ def codegen_ispc(structs : dict[str, loma_ir.Struct],
             code += 'export '
         else:
             code += 'extern \"C\" '
-        code += f'{codegen_c.type_to_string(f.ret_type)} {f.id}('
+        code += f'{codegen_c.type_to_string(f.ret_type, float_type)} {f.id}('
         for i, arg in enumerate(f.args):
             if i > 0:
                 code += ', '
             if f.is_simd:
                 code += 'uniform '
-            code += f'{codegen_c.type_to_string(arg)}'
+            code += f'{codegen_c.type_to_string(arg, float_type)}'
             if f.is_simd:
                 code += ' uniform'
             code += f' {arg.id}'
@@ -158,7 +160,7 @@ def codegen_ispc(structs : dict[str, loma_ir.Struct],
         code += ');\n'
 
     for f in funcs.values():
-        cg = ISPCCodegenVisitor(funcs)
+        cg = ISPCCodegenVisitor(funcs, float_type)
         cg.visit_function(f)
         code += cg.code
 
@@ -8,8 +8,8 @@ class OpenCLCodegenVisitor(codegen_c.CCodegenVisitor):
     """ Generates OpenCL code from loma IR.
     """
 
-    def __init__(self, func_defs):
-        super().__init__(func_defs)
+    def __init__(self, func_defs, float_type = 'float'):
+        super().__init__(func_defs, float_type)
 
     def visit_function_def(self, node):
         if node.is_simd:
@@ -17,14 +17,14 @@ class OpenCLCodegenVisitor(codegen_c.CCodegenVisitor):
             for i, arg in enumerate(node.args):
                 if i > 0:
                     self.code += ', '
-                self.code += f'__global {codegen_c.type_to_string(arg)} {arg.id}'
+                self.code += f'__global {codegen_c.type_to_string(arg, self.float_type)} {arg.id}'
             self.code += ') {\n'
         else:
-            self.code += f'{codegen_c.type_to_string(node.ret_type)} {node.id}('
+            self.code += f'{codegen_c.type_to_string(node.ret_type, self.float_type)} {node.id}('
             for i, arg in enumerate(node.args):
                 if i > 0:
                     self.code += ', '
-                self.code += f'{codegen_c.type_to_string(arg)} {arg.id}'
+                self.code += f'{codegen_c.type_to_string(arg, self.float_type)} {arg.id}'
             self.code += ') {\n'
 
         self.byref_args = set([arg.id for arg in node.args if \
@@ -63,7 +63,8 @@ class OpenCLCodegenVisitor(codegen_c.CCodegenVisitor):
         return super().visit_expr(node)
 
 def codegen_opencl(structs : dict[str, loma_ir.Struct],
-                   funcs : dict[str, loma_ir.func]) -> str:
+                   funcs : dict[str, loma_ir.func],
+                   float_type : str = 'float') -> str:
     """ Given loma Structs (structs) and loma functions (funcs),
         return a string that represents the equivalent OpenCL code.
 
@@ -72,6 +73,7 @@ def codegen_opencl(structs : dict[str, loma_ir.Struct],
                 the corresponding Struct
         funcs - a dictionary that maps the ID of a function to 
                 the corresponding func
+        float_type - the type loma floats are lowered to, 'float' or 'double'
     """
 
     sorted_structs_list = compiler.topo_sort_structs(structs)
@@ -81,25 +83,25 @@ def codegen_opencl(structs : dict[str, loma_ir.Struct],
     for s in sorted_structs_list:
         code += f'typedef struct {s.id} {{\n'
         for m in s.members:
-            code += f'\t{codegen_c.type_to_string(m.t)} {m.id};\n'
+            code += f'\t{codegen_c.type_to_string(m.t, float_type)} {m.id};\n'
         code += f'}} {s.id};\n'
 
     # Forward declaration of functions
     for f in funcs.values():
         if f.is_simd:
             code += '__kernel '
-        code += f'{codegen_c.type_to_string(f.ret_type)} {f.id}('
+        code += f'{codegen_c.type_to_string(f.ret_type, float_type)} {f.id}('
         for i, arg in enumerate(f.args):
             if i > 0:
                 code += ', '
             if f.is_simd:
                 code += '__global '
-            code += f'{codegen_c.type_to_string(arg)}'
+            code += f'{codegen_c.type_to_string(arg, float_type)}'
             code += f' {arg.id}'
         code += ');\n'
 
     for f in funcs.values():
-        cg = OpenCLCodegenVisitor(funcs)
+        cg = OpenCLCodegenVisitor(funcs, float_type)
         cg.visit_function(f)
         code += cg.code
 
@@ -22,26 +22,28 @@ import platform
 import distutils.ccompiler
 
 def loma_to_ctypes_type(t : loma_ir.type | loma_ir.arg,
-                        ctypes_structs : dict[str, ctypes.Structure]) -> ctypes.Structure:
+                        ctypes_structs : dict[str, ctypes.Structure],
+                        precision : str = 'single') -> ctypes.Structure:
     """ Given a loma type, maps to the corresponding ctypes type by
-        looking up ctypes_structs
+        looking up ctypes_structs. precision ('single' or 'double')
+        decides whether loma floats map to c_float or c_double.
     """
 
     match t:
         case loma_ir.Arg():
             if isinstance(t.t, loma_ir.Array):
-                return loma_to_ctypes_type(t.t, ctypes_structs)
+                return loma_to_ctypes_type(t.t, ctypes_structs, precision)
             else:
                 if t.i == loma_ir.Out():
-                    return ctypes.POINTER(loma_to_ctypes_type(t.t, ctypes_structs))
+                    return ctypes.POINTER(loma_to_ctypes_type(t.t, ctypes_structs, precision))
                 else:
-                    return loma_to_ctypes_type(t.t, ctypes_structs)
+                    return loma_to_ctypes_type(t.t, ctypes_structs, precision)
         case loma_ir.Int():
             return ctypes.c_int
         case loma_ir.Float():
-            return ctypes.c_float
+            return ctypes.c_double if precision == 'double' else ctypes.c_float
         case loma_ir.Array():
-            return ctypes.POINTER(loma_to_ctypes_type(t.t, ctypes_structs))
+            return ctypes.POINTER(loma_to_ctypes_type(t.t, ctypes_structs, precision))
         case loma_ir.Struct():
             return ctypes_structs[t.id]
         case None:
@@ -72,7 +74,9 @@ def compile(loma_code : str,
             opencl_context = None,
             opencl_device = None,
             opencl_command_queue = None,
-            print_error = True):
+            print_error = True,
+            precision : str = 'single',
+            vectorize : bool = False):
     """ Given loma frontend code represented as a string,
         compiles it to either C, ISPC, or OpenCL code.
         Furthermore, generates a library from the compiled code,
@@ -87,8 +91,17 @@ def compile(loma_code : str,
         opencl_context, opencl_device, opencl_command_queue - see cl_utils.create_context()
                     only used by the opencl backend
         print_error - whether it prints compile errors or not
+        precision - 'single' or 'double': whether loma floats are lowered to
+            float or double (and the matching math functions and ctypes types).
+            'double' on the opencl backend requires cl_khr_fp64 and cl_khr_int64_base_atomics.
+        vectorize - C backend only: let gcc vectorize loops, with enough runtime alias checks
+            for a loop over several separate arrays. Floating point operations are not reordered,
+            so the results do not change.
     """
 
+    assert precision in ('single', 'double'), f'unrecognized precision {precision}'
+    float_type = 'double' if precision == 'double' else 'float'
+
     # The compiler passes
     # first parse the frontend code
     try:
@@ -120,7 +133,7 @@ def compile(loma_code : str,
 
     # Generate and compile the code
     if target == 'c':
-        code = codegen_c.codegen_c(structs, funcs)
+        code = codegen_c.codegen_c(structs, funcs, float_type)
         # add standard headers
         code = """
 #include <math.h>
@@ -147,24 +160,25 @@ def compile(loma_code : str,
                 print(log.stderr)
             os.remove(tmp_c_filename)
         else:
-            log = run(['gcc', '-shared', '-fPIC', '-o', output_filename, '-O2', '-x', 'c', '-'],
+            opt_flags = ['-O3', '-fno-math-errno', '--param', 'vect-max-version-for-alias-checks=32'] if vectorize else ['-O2']
+            log = run(['gcc', '-shared', '-fPIC', '-o', output_filename, *opt_flags, '-x', 'c', '-'],
                 input = code,
                 encoding='utf-8',
                 capture_output=True)
             if log.returncode != 0:
                 print(log.stderr)
     elif target == 'ispc':
-        code = codegen_ispc.codegen_ispc(structs, funcs)
+        code = codegen_ispc.codegen_ispc(structs, funcs, float_type)
         # add atomic add
-        code = """
-void atomic_add(float *ptr, float val) {
-    float found = *ptr;
-    float expected;
-    do {
+        code = f"""
+void atomic_add({float_type} *ptr, {float_type} val) {{
+    {float_type} found = *ptr;
+    {float_type} expected;
+    do {{
         expected = found;
         found = atomic_compare_exchange_global(ptr, expected, expected + val);
-    } while (found != expected);
-}
+    }} while (found != expected);
+}}
         \n""" + code
 
         print('Generated ISPC code:')
@@ -207,9 +221,37 @@ void atomic_add(float *ptr, float val) {
                 encoding='utf-8',
                 capture_output=True)
     elif target == 'opencl':
-        code = codegen_opencl.codegen_opencl(structs, funcs)
+        code = codegen_opencl.codegen_opencl(structs, funcs, float_type)
         # add atomic add (taken from https://gist.github.com/PolarNick239/9dffaf365b332b4442e2ac63b867034f)
-        code = """
+        if precision == 'double':
+            code = """
+#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#pragma OPENCL EXTENSION cl_khr_int64_base_atomics : enable
+
+static double atomic_cmpxchg_f64(volatile __global double *p, double cmp, double val) {
+    union {
+        unsigned long u64;
+        double        f64;
+    } cmp_union, val_union, old_union;
+
+    cmp_union.f64 = cmp;
+    val_union.f64 = val;
+    old_union.u64 = atom_cmpxchg((volatile __global unsigned long *) p, cmp_union.u64, val_union.u64);
+    return old_union.f64;
+}
+
+static double cl_atomic_add(volatile __global double *p, double val) {
+    double found = *p;
+    double expected;
+    do {
+        expected = found;
+        found = atomic_cmpxchg_f64(p, expected, expected + val);
+    } while (found != expected);
+    return found;
+}
+            \n""" + code
+        else:
+            code = """
 static float atomic_cmpxchg_f32(volatile __global float *p, float cmp, float val) {
     union {
         unsigned int u32;
@@ -231,7 +273,7 @@ static float cl_atomic_add(volatile __global float *p, float val) {
     } while (found != expected);
     return found;
 }
-        \n""" + code
+            \n""" + code
 
         print('Generated OpenCL code:')
         print(code)
@@ -250,9 +292,14 @@ static float cl_atomic_add(volatile __global float *p, float val) {
 
     # build ctypes structs/classes
     ctypes_structs = {}
+    def member_ctypes_type(t):
+        # statically sized array members are stored inline (see codegen_c)
+        if isinstance(t, loma_ir.Array) and t.static_size is not None:
+            return member_ctypes_type(t.t) * t.static_size
+        return loma_to_ctypes_type(t, ctypes_structs, precision)
     for s in sorted_structs_list:
         ctypes_structs[s.id] = type(s.id, (ctypes.Structure, ), {
-            '_fields_': [(m.id, loma_to_ctypes_type(m.t, ctypes_structs)) for m in s.members]
+            '_fields_': [(m.id, member_ctypes_type(m.t)) for m in s.members]
         })
 
     # load the dynamic library
@@ -264,11 +311,11 @@ static float cl_atomic_add(volatile __global float *p, float val) {
                 if not f.is_simd:
                     continue
             c_func = getattr(lib, f.id)
-            argtypes = [loma_to_ctypes_type(arg, ctypes_structs) for arg in f.args]
+            argtypes = [loma_to_ctypes_type(arg, ctypes_structs, precision) for arg in f.args]
             # for simd functions, the last argument is the number of threads
             if f.is_simd:
                 argtypes.append(ctypes.c_int)
             c_func.argtypes = argtypes
-            c_func.restype = loma_to_ctypes_type(f.ret_type, ctypes_structs)
+            c_func.restype = loma_to_ctypes_type(f.ret_type, ctypes_structs, precision)
 
     return ctypes_structs, lib
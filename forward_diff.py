@@ -13,41 +13,113 @@ def forward_diff(
     diff_structs: dict[str, loma_ir.Struct],
     func: loma_ir.FunctionDef,
     func_to_fwd: dict[str, str],
+    width: int = 1,
 ) -> loma_ir.FunctionDef:
     """Given a primal loma function func, apply forward differentiation
     and return a function that computes the total derivative of func.
+
+    With width = K > 1 (vector mode), every differential carries K tangents
+    (see autodiff.resolve_diff_types), so one call propagates K seed
+    directions. Expressions are mutated into a primal value and a list of
+    K tangent expressions, one per lane. Primal subexpressions the tangent
+    rules reuse are stored in temporaries, so the primal work is done once
+    and shared by all lanes instead of being recomputed per lane.
     """
 
+    def diff_type(t):
+        return autodiff.type_to_diff_type(diff_structs, t, width)
+
+    make_dfloat_id = "make_" + diff_type(loma_ir.Float()).id
+
     class FwdDiffMutator(irmutator.IRMutator):
+        def __init__(self):
+            # temporaries holding shared primal values (vector mode only)
+            self.tmp_declares = []
+            # statements computing the temporaries used by the current statement
+            self.pre_stmts = []
+            # no temporaries in loop/branch conditions: they would only be computed once
+            self.share_primal = width > 1
+
+        def zero_dval(self):
+            return [loma_ir.ConstFloat(0.0) for _ in range(width)]
+
+        def dval_of(self, d_expr):
+            """Tangent lanes of an expression of type _dfloat (or _dfloat_wK)."""
+            if width == 1:
+                return [loma_ir.StructAccess(d_expr, "dval", t=loma_ir.Float())]
+            dval_arr = loma_ir.StructAccess(
+                d_expr, "dval", t=loma_ir.Array(loma_ir.Float(), width))
+            return [loma_ir.ArrayAccess(dval_arr, loma_ir.ConstInt(i), t=loma_ir.Float())
+                    for i in range(width)]
+
+        def make_dfloat(self, val, dval, lineno=None):
+            return loma_ir.Call(make_dfloat_id, (val, *dval),
+                                t=diff_type(loma_ir.Float()), lineno=lineno)
+
+        def is_cheap(self, expr):
+            """Variables, constants, and member/element reads of them need no temporary."""
+            match expr:
+                case loma_ir.Var() | loma_ir.ConstFloat() | loma_ir.ConstInt():
+                    return True
+                case loma_ir.StructAccess():
+                    return self.is_cheap(expr.struct)
+                case loma_ir.ArrayAccess():
+                    return self.is_cheap(expr.array) and \
+                        isinstance(expr.index, (loma_ir.Var, loma_ir.ConstInt))
+                case _:
+                    return False
+
+        def share(self, expr, t=loma_ir.Float()):
+            """In vector mode, evaluate expr once into a temporary and return the temporary."""
+            if not self.share_primal or self.is_cheap(expr):
+                return expr
+            tmp_id = f"_primal_tmp_{len(self.tmp_declares)}"
+            self.tmp_declares.append(loma_ir.Declare(tmp_id, t))
+            tmp = loma_ir.Var(tmp_id, t=t)
+            self.pre_stmts.append(loma_ir.Assign(tmp, expr))
+            return tmp
+
         def mutate_function_def(self, node):
             new_func_args = [
                 loma_ir.Arg(
-                    arg.id, autodiff.type_to_diff_type(
-                        diff_structs, arg.t), arg.i
+                    arg.id, diff_type(arg.t), arg.i
                 )
                 for arg in node.args
             ]
             new_body = [self.mutate_stmt(stmt) for stmt in node.body]
-            new_body = irmutator.flatten(new_body)
+            new_body = self.tmp_declares + irmutator.flatten(new_body)
             return loma_ir.FunctionDef(
                 diff_func_id,
                 new_func_args,
                 new_body,
                 node.is_simd,
-                autodiff.type_to_diff_type(diff_structs, node.ret_type),
+                diff_type(node.ret_type),
                 node.lineno,
             )
 
+        def mutate_stmt(self, node):
+            outer_pre_stmts = self.pre_stmts
+            self.pre_stmts = []
+            new_stmt = super().mutate_stmt(node)
+            if not isinstance(new_stmt, list):
+                new_stmt = [new_stmt]
+            new_stmts = self.pre_stmts + new_stmt
+            self.pre_stmts = outer_pre_stmts
+            return new_stmts
+
+        def mutate_cond(self, cond):
+            share_primal = self.share_primal
+            self.share_primal = False
+            cond_val, _ = self.mutate_expr(cond)
+            self.share_primal = share_primal
+            return cond_val
+
         def mutate_return(self, node):
             val, dval = self.mutate_expr(node.val)
             if isinstance(node.val.t, loma_ir.Int):
                 return loma_ir.Return(val, lineno=node.lineno)
             elif isinstance(node.val.t, loma_ir.Float):
-                assembled_result = loma_ir.Call(
-                    "make__dfloat",
-                    (val, dval),
-                    t=autodiff.type_to_diff_type(diff_structs, node.val.t)
-                )
+                assembled_result = self.make_dfloat(val, dval)
                 return loma_ir.Return(assembled_result, lineno=node.lineno)
             elif isinstance(node.val.t, loma_ir.Struct):
                 return loma_ir.Return(val, lineno=node.lineno)
@@ -56,27 +128,23 @@ def forward_diff(
 
         def mutate_declare(self, node):
             new_val = None
-            new_type = autodiff.type_to_diff_type(diff_structs, node.t)
+            new_type = diff_type(node.t)
             if node.val:
                 val, dval = self.mutate_expr(node.val)
                 if isinstance(node.t, loma_ir.Int) or isinstance(node.t, loma_ir.Struct):
                     new_val = val
                 else:
-                    new_val = loma_ir.Call(
-                        "make__dfloat", (val, dval), t=new_type)
+                    new_val = self.make_dfloat(val, dval)
             return loma_ir.Declare(node.target, new_type, new_val, node.lineno)
 
         def mutate_assign(self, node):
             rhs_val, rhs_dval = self.mutate_expr(node.val)
             new_rhs = None
-            lhs_diff_type = autodiff.type_to_diff_type(
-                diff_structs, node.target.t)
 
             if isinstance(node.target.t, loma_ir.Int) or isinstance(node.target.t, loma_ir.Struct):
                 new_rhs = rhs_val
             elif isinstance(node.target.t, loma_ir.Float):
-                new_rhs = loma_ir.Call(
-                    "make__dfloat", (rhs_val, rhs_dval), t=lhs_diff_type)
+                new_rhs = self.make_dfloat(rhs_val, rhs_dval)
             else:
                 new_rhs = rhs_val
             new_lhs = self.mutate_expr_lhs(node.target)
@@ -93,16 +161,14 @@ def forward_diff(
                         index_val = loma_ir.Call(
                             "int2float", (index_val,), t=loma_ir.Int())
                 mutated_array = self.mutate_expr_lhs(node_target.array)
-                element_diff_type = autodiff.type_to_diff_type(
-                    diff_structs, node_target.t)
+                element_diff_type = diff_type(node_target.t)
                 return loma_ir.ArrayAccess(
                     array=mutated_array, index=index_val,
                     lineno=node_target.lineno, t=element_diff_type
                 )
             elif isinstance(node_target, loma_ir.StructAccess):
                 mutated_struct = self.mutate_expr_lhs(node_target.struct)
-                member_diff_type = autodiff.type_to_diff_type(
-                    diff_structs, node_target.t)
+                member_diff_type = diff_type(node_target.t)
                 return loma_ir.StructAccess(
                     struct=mutated_struct, member_id=node_target.member_id,
                     lineno=node_target.lineno, t=member_diff_type
@@ -112,7 +178,7 @@ def forward_diff(
                 return primal_part
 
         def mutate_ifelse(self, node):
-            cond_val, _ = self.mutate_expr(node.cond)
+            cond_val = self.mutate_cond(node.cond)
             new_then_stmts = [self.mutate_stmt(
                 stmt) for stmt in node.then_stmts]
             new_then_stmts = irmutator.flatten(new_then_stmts)
@@ -123,7 +189,7 @@ def forward_diff(
 
         def mutate_while(self, node: loma_ir.While):
             # Mutate the condition (only primal needed for control flow)
-            cond_val, _ = self.mutate_expr(node.cond)
+            cond_val = self.mutate_cond(node.cond)
 
             # Mutate the statements within the loop body
             new_body = [self.mutate_stmt(stmt) for stmt in node.body]
@@ -138,23 +204,22 @@ def forward_diff(
             )
 
         def mutate_const_float(self, node):
-            return loma_ir.ConstFloat(node.val), loma_ir.ConstFloat(0.0)
+            return loma_ir.ConstFloat(node.val), self.zero_dval()
 
         def mutate_const_int(self, node):
-            return loma_ir.ConstInt(node.val), loma_ir.ConstFloat(0.0)
+            return loma_ir.ConstInt(node.val), self.zero_dval()
 
         def mutate_var(self, node):
             if isinstance(node.t, loma_ir.Int):
-                return node, loma_ir.ConstFloat(0.0)
+                return node, self.zero_dval()
             elif isinstance(node.t, loma_ir.Float):
                 val = loma_ir.StructAccess(node, "val", t=loma_ir.Float())
-                dval = loma_ir.StructAccess(node, "dval", t=loma_ir.Float())
-                return val, dval
+                return val, self.dval_of(node)
             elif isinstance(node.t, loma_ir.Struct):
                 # Placeholder, may need member-wise handling
-                return node, loma_ir.ConstFloat(0.0)
+                return node, self.zero_dval()
             # Fallback for other types if any (e.g. Array - though access is handled separately)
-            return node, loma_ir.ConstFloat(0.0)
+            return node, self.zero_dval()
 
         def mutate_array_access(self, node):
             original_array_expr = node.array
@@ -167,8 +232,7 @@ def forward_diff(
                         "float2int", (index_val,), t=loma_ir.Int())
 
             mutated_array_expr, _ = self.mutate_expr(original_array_expr)
-            array_element_diff_type = autodiff.type_to_diff_type(
-                diff_structs, node.t)
+            array_element_diff_type = diff_type(node.t)
             array_element_access = loma_ir.ArrayAccess(
                 array=mutated_array_expr, index=index_val,
                 lineno=node.lineno, t=array_element_diff_type
@@ -176,11 +240,9 @@ def forward_diff(
             if isinstance(node.t, loma_ir.Float):
                 val = loma_ir.StructAccess(
                     array_element_access, "val", t=loma_ir.Float())
-                dval = loma_ir.StructAccess(
-                    array_element_access, "dval", t=loma_ir.Float())
-                return val, dval
+                return val, self.dval_of(array_element_access)
             elif isinstance(node.t, loma_ir.Int) or isinstance(node.t, loma_ir.Struct):
-                return array_element_access, loma_ir.ConstFloat(0.0)
+                return array_element_access, self.zero_dval()
             else:
                 raise NotImplementedError(
                     f"Array access for element type {node.t} not implemented.")
@@ -188,7 +250,7 @@ def forward_diff(
         def mutate_struct_access(self, node):
             original_struct_expr = node.struct
             mutated_struct_expr, _ = self.mutate_expr(original_struct_expr)
-            member_diff_type = autodiff.type_to_diff_type(diff_structs, node.t)
+            member_diff_type = diff_type(node.t)
             member_access_expr = loma_ir.StructAccess(
                 struct=mutated_struct_expr, member_id=node.member_id,
                 lineno=node.lineno, t=member_diff_type
@@ -196,11 +258,9 @@ def forward_diff(
             if isinstance(node.t, loma_ir.Float):
                 val = loma_ir.StructAccess(
                     member_access_expr, "val", t=loma_ir.Float())
-                dval = loma_ir.StructAccess(
-                    member_access_expr, "dval", t=loma_ir.Float())
-                return val, dval
+                return val, self.dval_of(member_access_expr)
             elif isinstance(node.t, loma_ir.Int) or isinstance(node.t, loma_ir.Struct):
-                return member_access_expr, loma_ir.ConstFloat(0.0)
+                return member_access_expr, self.zero_dval()
             else:
                 raise NotImplementedError(
                     f"Struct access for member type {node.t} not implemented.")
@@ -212,8 +272,7 @@ def forward_diff(
                 op_constructor(), left_val, right_val,
                 lineno=node.lineno, t=loma_ir.Int()
             )
-            dval_op_result = loma_ir.ConstFloat(0.0)
-            return primal_op_result, dval_op_result
+            return primal_op_result, self.zero_dval()
 
         def mutate_less(self, node): return self._create_comparison_op(
             node, loma_ir.Less)
@@ -252,8 +311,8 @@ def forward_diff(
                         "int2float", (right_val,), t=loma_ir.Float(), lineno=ln)
             result_val = loma_ir.BinaryOp(
                 loma_ir.Add(), left_val, right_val, lineno=ln, t=primal_res_type)
-            result_dval = loma_ir.ConstFloat(0.0) if is_int_op else loma_ir.BinaryOp(
-                loma_ir.Add(), left_dval, right_dval, lineno=ln, t=loma_ir.Float())
+            result_dval = self.zero_dval() if is_int_op else [loma_ir.BinaryOp(
+                loma_ir.Add(), ld, rd, lineno=ln, t=loma_ir.Float()) for ld, rd in zip(left_dval, right_dval)]
             return result_val, result_dval
 
         def mutate_sub(self, node):
@@ -272,8 +331,8 @@ def forward_diff(
                         "int2float", (right_val,), t=loma_ir.Float(), lineno=ln)
             result_val = loma_ir.BinaryOp(
                 loma_ir.Sub(), left_val, right_val, lineno=ln, t=primal_res_type)
-            result_dval = loma_ir.ConstFloat(0.0) if is_int_op else loma_ir.BinaryOp(
-                loma_ir.Sub(), left_dval, right_dval, lineno=ln, t=loma_ir.Float())
+            result_dval = self.zero_dval() if is_int_op else [loma_ir.BinaryOp(
+                loma_ir.Sub(), ld, rd, lineno=ln, t=loma_ir.Float()) for ld, rd in zip(left_dval, right_dval)]
             return result_val, result_dval
 
         def mutate_mul(self, node):
@@ -290,17 +349,21 @@ def forward_diff(
                 if isinstance(node.right.t, loma_ir.Int):
                     right_val = loma_ir.Call(
                         "int2float", (right_val,), t=loma_ir.Float(), lineno=ln)
+            if not is_int_op:
+                left_val, right_val = self.share(left_val), self.share(right_val)
             result_val = loma_ir.BinaryOp(
                 loma_ir.Mul(), left_val, right_val, lineno=ln, t=primal_res_type)
             if is_int_op:
-                result_dval = loma_ir.ConstFloat(0.0)
+                result_dval = self.zero_dval()
             else:
-                term1_dval = loma_ir.BinaryOp(
-                    loma_ir.Mul(), left_dval, right_val, lineno=ln, t=loma_ir.Float())
-                term2_dval = loma_ir.BinaryOp(
-                    loma_ir.Mul(), left_val, right_dval, lineno=ln, t=loma_ir.Float())
-                result_dval = loma_ir.BinaryOp(
-                    loma_ir.Add(), term1_dval, term2_dval, lineno=ln, t=loma_ir.Float())
+                result_dval = []
+                for ld, rd in zip(left_dval, right_dval):
+                    term1_dval = loma_ir.BinaryOp(
+                        loma_ir.Mul(), ld, right_val, lineno=ln, t=loma_ir.Float())
+                    term2_dval = loma_ir.BinaryOp(
+                        loma_ir.Mul(), left_val, rd, lineno=ln, t=loma_ir.Float())
+                    result_dval.append(loma_ir.BinaryOp(
+                        loma_ir.Add(), term1_dval, term2_dval, lineno=ln, t=loma_ir.Float()))
             return result_val, result_dval
 
         def mutate_div(self, node):
@@ -317,21 +380,25 @@ def forward_diff(
                 if isinstance(node.right.t, loma_ir.Int):
                     right_val = loma_ir.Call(
                         "int2float", (right_val,), t=loma_ir.Float(), lineno=ln)
+            if not is_int_op:
+                left_val, right_val = self.share(left_val), self.share(right_val)
             result_val = loma_ir.BinaryOp(
                 loma_ir.Div(), left_val, right_val, lineno=ln, t=primal_res_type)
             if is_int_op:
-                result_dval = loma_ir.ConstFloat(0.0)
+                result_dval = self.zero_dval()
             else:
-                num_t1 = loma_ir.BinaryOp(
-                    loma_ir.Mul(), left_dval, right_val, lineno=ln, t=loma_ir.Float())
-                num_t2 = loma_ir.BinaryOp(
-                    loma_ir.Mul(), left_val, right_dval, lineno=ln, t=loma_ir.Float())
-                num_dval = loma_ir.BinaryOp(
-                    loma_ir.Sub(), num_t1, num_t2, lineno=ln, t=loma_ir.Float())
-                den_dval = loma_ir.BinaryOp(
-                    loma_ir.Mul(), right_val, right_val, lineno=ln, t=loma_ir.Float())
-                result_dval = loma_ir.BinaryOp(
-                    loma_ir.Div(), num_dval, den_dval, lineno=ln, t=loma_ir.Float())
+                den_dval = self.share(loma_ir.BinaryOp(
+                    loma_ir.Mul(), right_val, right_val, lineno=ln, t=loma_ir.Float()))
+                result_dval = []
+                for ld, rd in zip(left_dval, right_dval):
+                    num_t1 = loma_ir.BinaryOp(
+                        loma_ir.Mul(), ld, right_val, lineno=ln, t=loma_ir.Float())
+                    num_t2 = loma_ir.BinaryOp(
+                        loma_ir.Mul(), left_val, rd, lineno=ln, t=loma_ir.Float())
+                    num_dval = loma_ir.BinaryOp(
+                        loma_ir.Sub(), num_t1, num_t2, lineno=ln, t=loma_ir.Float())
+                    result_dval.append(loma_ir.BinaryOp(
+                        loma_ir.Div(), num_dval, den_dval, lineno=ln, t=loma_ir.Float()))
             return result_val, result_dval
 
         def mutate_call(self, node):
@@ -360,10 +427,10 @@ def forward_diff(
                     return self.mutate_log(val, dval, lineno)
                 case "int2float":
                     val, _ = self.mutate_expr(node.args[0])
-                    return loma_ir.Call("int2float", (val,), t=loma_ir.Float(), lineno=lineno), loma_ir.ConstFloat(0.0)
+                    return loma_ir.Call("int2float", (val,), t=loma_ir.Float(), lineno=lineno), self.zero_dval()
                 case "float2int":
                     val, _ = self.mutate_expr(node.args[0])
-                    return loma_ir.Call("float2int", [val], t=loma_ir.Int(), lineno=lineno), loma_ir.ConstFloat(0.0)
+                    return loma_ir.Call("float2int", [val], t=loma_ir.Int(), lineno=lineno), self.zero_dval()
                 case _:
                     if node.id in func_to_fwd:
                         diff_func_name = func_to_fwd[node.id]
@@ -382,24 +449,24 @@ def forward_diff(
                             elif isinstance(original_arg.t, loma_ir.Int):
                                 mutated_args.append(mutated_arg_val)
                             elif isinstance(original_arg.t, loma_ir.Float):
-                                mutated_args.append(loma_ir.Call("make__dfloat", (mutated_arg_val, mutated_arg_dval), t=autodiff.type_to_diff_type(
-                                    diff_structs, original_arg.t), lineno=lineno))
+                                mutated_args.append(self.make_dfloat(
+                                    mutated_arg_val, mutated_arg_dval, lineno=lineno))
                             elif isinstance(original_arg.t, loma_ir.Struct):
                                 mutated_args.append(mutated_arg_val)
                             else:
                                 mutated_args.append(mutated_arg_val)
-                        return_diff_type = autodiff.type_to_diff_type(
-                            diff_structs, original_return_type)
+                        return_diff_type = diff_type(original_return_type)
                         call_expr_d_type = loma_ir.Call(diff_func_name, tuple(
                             mutated_args), t=return_diff_type, lineno=lineno)
                         if isinstance(original_return_type, loma_ir.Float):
+                            # call once and read all lanes from the result
+                            call_expr_d_type = self.share(
+                                call_expr_d_type, return_diff_type)
                             ret_val_access = loma_ir.StructAccess(
                                 call_expr_d_type, "val", t=loma_ir.Float(), lineno=lineno)
-                            ret_dval_access = loma_ir.StructAccess(
-                                call_expr_d_type, "dval", t=loma_ir.Float(), lineno=lineno)
-                            return ret_val_access, ret_dval_access
+                            return ret_val_access, self.dval_of(call_expr_d_type)
                         elif isinstance(original_return_type, loma_ir.Int) or isinstance(original_return_type, loma_ir.Struct):
-                            return call_expr_d_type, loma_ir.ConstFloat(0.0)
+                            return call_expr_d_type, self.zero_dval()
                         elif original_return_type is None:
                             print(
                                 f"Warning: mutate_call called for void function {node.id}")
@@ -414,7 +481,7 @@ def forward_diff(
                             mutated_args_primal.append(arg_val)
                         primal_call = loma_ir.Call(node.id, tuple(
                             mutated_args_primal), t=original_return_type, lineno=lineno)
-                        return primal_call, loma_ir.ConstFloat(0.0)
+                        return primal_call, self.zero_dval()
 
         def mutate_call_stmt(self, node):
             func_id = node.call.id
@@ -435,8 +502,8 @@ def forward_diff(
                     elif isinstance(original_arg.t, loma_ir.Int):
                         mutated_args.append(mutated_arg_val)
                     elif isinstance(original_arg.t, loma_ir.Float):
-                        mutated_args.append(loma_ir.Call("make__dfloat", (mutated_arg_val, mutated_arg_dval), t=autodiff.type_to_diff_type(
-                            diff_structs, original_arg.t), lineno=lineno))
+                        mutated_args.append(self.make_dfloat(
+                            mutated_arg_val, mutated_arg_dval, lineno=lineno))
                     elif isinstance(original_arg.t, loma_ir.Struct):
                         mutated_args.append(mutated_arg_val)
                     else:
@@ -454,44 +521,60 @@ def forward_diff(
                 return loma_ir.CallStmt(primal_call_expr, lineno=lineno)
 
         def mutate_sin(self, val, dval, lineno):
+            val = self.share(val)
+            cos_val = self.share(loma_ir.Call(
+                "cos", (val,), t=loma_ir.Float(), lineno=lineno))
             return (loma_ir.Call("sin", (val,), t=loma_ir.Float(), lineno=lineno),
-                    loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.Call("cos", (val,), t=loma_ir.Float(), lineno=lineno), dval, t=loma_ir.Float(), lineno=lineno))
+                    [loma_ir.BinaryOp(loma_ir.Mul(), cos_val, d, t=loma_ir.Float(), lineno=lineno) for d in dval])
 
         def mutate_cos(self, val, dval, lineno):
+            val = self.share(val)
+            sin_val = self.share(loma_ir.Call(
+                "sin", (val,), t=loma_ir.Float(), lineno=lineno))
             return (loma_ir.Call("cos", (val,), t=loma_ir.Float(), lineno=lineno),
-                    loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.ConstFloat(-1.0), dval, t=loma_ir.Float(), lineno=lineno), loma_ir.Call("sin", (val,), t=loma_ir.Float(), lineno=lineno), t=loma_ir.Float(), lineno=lineno))
+                    [loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.ConstFloat(-1.0), d, t=loma_ir.Float(), lineno=lineno), sin_val, t=loma_ir.Float(), lineno=lineno) for d in dval])
 
         def mutate_sqrt(self, val, dval, lineno):
-            return (loma_ir.Call("sqrt", (val,), t=loma_ir.Float(), lineno=lineno),
-                    loma_ir.BinaryOp(loma_ir.Div(), dval, loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.ConstFloat(2.0), loma_ir.Call("sqrt", (val,), t=loma_ir.Float(), lineno=lineno), t=loma_ir.Float(), lineno=lineno), t=loma_ir.Float(), lineno=lineno))
+            val = self.share(val)
+            sqrt_val = self.share(loma_ir.Call(
+                "sqrt", (val,), t=loma_ir.Float(), lineno=lineno))
+            return (sqrt_val,
+                    [loma_ir.BinaryOp(loma_ir.Div(), d, loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.ConstFloat(2.0), sqrt_val, t=loma_ir.Float(), lineno=lineno), t=loma_ir.Float(), lineno=lineno) for d in dval])
 
         def mutate_pow(self, x_val, y_val, x_dval, y_dval, lineno):
-            primal_call = loma_ir.Call(
-                "pow", (x_val, y_val), t=loma_ir.Float(), lineno=lineno)
+            x_val, y_val = self.share(x_val), self.share(y_val)
+            primal_call = self.share(loma_ir.Call(
+                "pow", (x_val, y_val), t=loma_ir.Float(), lineno=lineno))
             y_minus_1 = loma_ir.BinaryOp(loma_ir.Sub(), y_val, loma_ir.ConstFloat(
                 1.0), t=loma_ir.Float(), lineno=lineno)
             pow_x_y_minus_1 = loma_ir.Call(
                 "pow", (x_val, y_minus_1), t=loma_ir.Float(), lineno=lineno)
-            term1_factor1 = loma_ir.BinaryOp(
-                loma_ir.Mul(), y_val, pow_x_y_minus_1, t=loma_ir.Float(), lineno=lineno)
-            term1 = loma_ir.BinaryOp(
-                loma_ir.Mul(), term1_factor1, x_dval, t=loma_ir.Float(), lineno=lineno)
+            term1_factor1 = self.share(loma_ir.BinaryOp(
+                loma_ir.Mul(), y_val, pow_x_y_minus_1, t=loma_ir.Float(), lineno=lineno))
             log_x = loma_ir.Call(
                 "log", (x_val,), t=loma_ir.Float(), lineno=lineno)
-            term2_factor1 = loma_ir.BinaryOp(
-                loma_ir.Mul(), primal_call, log_x, t=loma_ir.Float(), lineno=lineno)
-            term2 = loma_ir.BinaryOp(
-                loma_ir.Mul(), term2_factor1, y_dval, t=loma_ir.Float(), lineno=lineno)
-            total_dval = loma_ir.BinaryOp(
-                loma_ir.Add(), term1, term2, t=loma_ir.Float(), lineno=lineno)
+            term2_factor1 = self.share(loma_ir.BinaryOp(
+                loma_ir.Mul(), primal_call, log_x, t=loma_ir.Float(), lineno=lineno))
+            total_dval = []
+            for xd, yd in zip(x_dval, y_dval):
+                term1 = loma_ir.BinaryOp(
+                    loma_ir.Mul(), term1_factor1, xd, t=loma_ir.Float(), lineno=lineno)
+                term2 = loma_ir.BinaryOp(
+                    loma_ir.Mul(), term2_factor1, yd, t=loma_ir.Float(), lineno=lineno)
+                total_dval.append(loma_ir.BinaryOp(
+                    loma_ir.Add(), term1, term2, t=loma_ir.Float(), lineno=lineno))
             return primal_call, total_dval
 
         def mutate_exp(self, val, dval, lineno):
-            return (loma_ir.Call("exp", (val,), t=loma_ir.Float(), lineno=lineno),
-                    loma_ir.BinaryOp(loma_ir.Mul(), loma_ir.Call("exp", (val,), t=loma_ir.Float(), lineno=lineno), dval, t=loma_ir.Float(), lineno=lineno))
+            val = self.share(val)
+            exp_val = self.share(loma_ir.Call(
+                "exp", (val,), t=loma_ir.Float(), lineno=lineno))
+            return (exp_val,
+                    [loma_ir.BinaryOp(loma_ir.Mul(), exp_val, d, t=loma_ir.Float(), lineno=lineno) for d in dval])
 
         def mutate_log(self, val, dval, lineno):
+            val = self.share(val)
             return (loma_ir.Call("log", (val,), t=loma_ir.Float(), lineno=lineno),
-                    loma_ir.BinaryOp(loma_ir.Div(), dval, val, t=loma_ir.Float(), lineno=lineno))
+                    [loma_ir.BinaryOp(loma_ir.Div(), d, val, t=loma_ir.Float(), lineno=lineno) for d in dval])
 
     return FwdDiffMutator().mutate_function_def(func)
@@ -12,7 +12,7 @@ def generate_asdl_file():
     ADT("""
     module loma {
       func = FunctionDef ( string id, arg* args, stmt* body, bool is_simd, type? ret_type )
-           | ForwardDiff ( string id, string primal_func )
+           | ForwardDiff ( string id, string primal_func, int? width )
            | ReverseDiff ( string id, string primal_func )
              attributes  ( int? lineno )
 
@@ -39,7 +39,7 @@ def generate_asdl_file():
            | Float  ( )
            | Array  ( type t, int? static_size )
            | Struct ( string id, struct_member* members, int? lineno )
-           | Diff   ( type t )
+           | Diff   ( type t, int? width )
 
       struct_member = MemberDef ( string id, type t )
 
@@ -55,7 +55,15 @@ def annotation_to_type(node) -> loma_ir.type:
                 return loma_ir.Array(annotation_to_type(array_type), static_size)
             elif node.value.id == 'Diff':
                 # This is a "differential type" -- we'll resolve this in autodiff
-                return loma_ir.Diff(annotation_to_type(node.slice))
+                # Diff[T, K] carries K tangents, matching fwd_diff(f, width = K)
+                diff_type = node.slice
+                width = None
+                if isinstance(diff_type, ast.Tuple):
+                    assert len(diff_type.elts) == 2 # TODO: error message
+                    assert isinstance(diff_type.elts[1], ast.Constant)
+                    width = int(diff_type.elts[1].value)
+                    diff_type = diff_type.elts[0]
+                return loma_ir.Diff(annotation_to_type(diff_type), width)
             else:
                 # TODO: error message
                 assert False
@@ -147,6 +155,11 @@ def visit_Differentiate(node) -> loma_ir.func:
         d_foo = fwd_diff(foo)
         converts to
         loma_ir.ForwardDiff('d_foo', 'foo')
+
+        Forward mode optionally takes a vector width:
+        d_foo = fwd_diff(foo, width = 4)
+        converts to
+        loma_ir.ForwardDiff('d_foo', 'foo', 4)
     """
 
     assert isinstance(node, ast.Assign)
@@ -160,8 +173,14 @@ def visit_Differentiate(node) -> loma_ir.func:
     primal_func_id = node.value.args[0]
     assert isinstance(primal_func_id, ast.Name)
     primal_func_id = primal_func_id.id
+    width = None
+    for kw in node.value.keywords:
+        assert kw.arg == 'width' and call_name == 'fwd_diff', \
+            f'Unknown argument {kw.arg} to {call_name}'
+        assert isinstance(kw.value, ast.Constant)
+        width = int(kw.value.value)
     if call_name == 'fwd_diff':
-        return loma_ir.ForwardDiff(func_id, primal_func_id, lineno = node.lineno)
+        return loma_ir.ForwardDiff(func_id, primal_func_id, width, lineno = node.lineno)
     elif call_name == 'rev_diff':
         return loma_ir.ReverseDiff(func_id, primal_func_id, lineno = node.lineno)
     else:
@@ -343,7 +362,7 @@ def fill_structs(s : loma_ir.Struct,
         new_m = m
         if isinstance(m.t, loma_ir.Struct):
             new_m = attrs.evolve(m, t=structs[m.t.id])
-        elif isinstance(m.t, loma_ir.Array):
+        elif isinstance(m.t, loma_ir.Array) and isinstance(m.t.t, loma_ir.Struct):
             new_m = attrs.evolve(m,
                 t=loma_ir.Array(structs[m.t.t.id], m.t.static_size))
         new_members.append(new_m)
@@ -23,6 +23,8 @@ def type_to_string(node : loma_ir.type) -> str:
         case loma_ir.Struct():
             return node.id
         case loma_ir.Diff():
+            if node.width is not None:
+                return f'Diff[{type_to_string(node.t)}, {node.width}]'
             return f'Diff[{type_to_string(node.t)}]'
         case None:
             return 'void'
@@ -61,7 +63,10 @@ class PrettyPrintVisitor(irvisitor.IRVisitor):
         self.tab_count -= 1
 
     def visit_forward_diff(self, node):
-        self.code += f'{node.id} = fwd_diff({node.primal_func})'
+        if node.width is not None:
+            self.code += f'{node.id} = fwd_diff({node.primal_func}, width = {node.width})'
+        else:
+            self.code += f'{node.id} = fwd_diff({node.primal_func})'
 
     def visit_reverse_diff(self, node):
         self.code += f'{node.id} = rev_diff({node.primal_func})'
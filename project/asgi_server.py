@@ -0,0 +1,268 @@
+# asgi_server.py (Asyncio entry point for the simulation server)
+#
+# Serves the routes of server.py from a Quart app on one event loop. Every call that waits on a simulation
+# or the disk (opening a session, draining and serializing frames, seeking, checkpoints, the waits of a
+# /stream) runs on a pool of dispatch threads and is awaited, so pages, static files and scenario lists
+# never queue behind it and many viewers share one process. The work behind each route is the helper
+# server.py uses, and sessions run in the same worker process pool.
+#
+# Run it with `python asgi_server.py`, or under an ASGI server in a single process, e.g.
+# `hypercorn --workers 0 asgi_server:app`. Sessions are looked up in this process's memory, and the worker
+# pool already spreads their simulations over the cores.
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+from quart import Quart, Response, render_template, jsonify, request
+from server import (CHECKPOINT_DIR, STATE_MAX_FRAMES, STREAM_WINDOW_FRAMES, STREAM_KEEPALIVE_SECONDS, DEFAULT_HIGH_WATER, DIAGNOSTIC_FIELDS, CHAOS_FIELDS,
+                    sessions, pool, scenario_config, chaos_config, start_session, check_frames, pack_frames, stream_event, checkpoint_file, scenario_file,
+                    save_scenario_file, scenario_summaries, load_scenario_config)
+from session_pool import RemoteFrameProducer
+
+app = Quart(__name__)
+
+DISPATCH_THREADS = 32 # Blocking calls of requests in flight at once
+STREAM_THREADS = 256 # Blocking calls of open /streams in flight at once, kept apart so streams never hold up requests
+dispatch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=DISPATCH_THREADS, thread_name_prefix='dispatch')
+stream_pool = concurrent.futures.ThreadPoolExecutor(max_workers=STREAM_THREADS, thread_name_prefix='stream')
+
+async def dispatch(fn, *args, executor=dispatch_pool, **kwargs):
+    # Runs a blocking call on a dispatch thread and awaits its result
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+async def wait_for_window(producer, window: int) -> int:
+    # How many frames a /stream may send, once its window opens or STREAM_KEEPALIVE_SECONDS pass. A worker
+    # process session waits in its worker and the reply is awaited here, so an idle stream holds no thread.
+    try:
+        if isinstance(producer, RemoteFrameProducer):
+            return await asyncio.wrap_future(producer.submit('wait_for_window', window, STREAM_KEEPALIVE_SECONDS))
+        return await dispatch(producer.wait_for_window, window, STREAM_KEEPALIVE_SECONDS, executor=stream_pool)
+    except Exception:
+        return 0 # The stream's next event reports why
+
+async def get_session(session_id):
+    # Looking a session up may evict idle ones, which waits for their workers to stop
+    return await dispatch(sessions.get, session_id)
+
+@app.after_serving
+async def shutdown():
+    await dispatch(pool.close)
+    dispatch_pool.shutdown(wait=False)
+    stream_pool.shutdown(wait=False)
+
+@app.route("/")
+async def index(): return await render_template("index.html")
+
+@app.route("/scenario-builder")
+async def scenario_builder(): return await render_template("scenario_builder.html")
+
+@app.route("/conversions")
+async def conversions(): return await render_template("conversions.html")
+
+@app.route("/init_session", methods=['POST'])
+async def init_session():
+    try:
+        data = await request.get_json()
+        simulation_name = data['simulation_name']
+        app.logger.info(f"init_session: Initializing: {simulation_name}")
+        cfg = scenario_config(simulation_name)
+        if not cfg:
+            app.logger.error(f"init_session: Unknown simulation: {simulation_name}")
+            return jsonify({"error": f"Unknown simulation: {simulation_name}"}), 400
+
+        cfg.diagnostics = bool(data.get('diagnostics', False))
+        cfg.chaos_indicators = bool(data.get('chaos_indicators', False))
+        try: chaos_config(cfg)
+        except ValueError as e: return jsonify({"error": str(e)}), 400
+        new_id, _ = await dispatch(start_session, lambda sid: pool.open(sid, cfg, high_water=int(data.get('high_water', DEFAULT_HIGH_WATER)),
+                                                                        checkpoint_dir=os.path.join(CHECKPOINT_DIR, sid), checkpoint_every=int(data.get('checkpoint_every', 0))))
+        return jsonify({"session_id": new_id, "system_config": cfg})
+    except Exception as e:
+        app.logger.exception("Error in init_session")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/state/<session_id>")
+async def get_state(session_id):
+    sim_runner = await get_session(session_id)
+    if sim_runner is None:
+        app.logger.warning(f"get_state: Invalid session ID: {session_id}")
+        return jsonify({"error": "Invalid session ID"}), 404
+
+    def drain_json():
+        # Serializing BodyState frames takes as long as draining them on large systems, so it stays off the loop too
+        new_states = sim_runner.drain(STATE_MAX_FRAMES)
+        problem = check_frames(new_states, session_id)
+        return problem, None if problem else app.json.dumps(new_states)
+
+    try:
+        problem, body = await dispatch(drain_json)
+        if problem: return jsonify(problem), 500
+        return Response(body, mimetype='application/json')
+    except Exception as e:
+        app.logger.exception(f"get_state: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/state_binary/<session_id>")
+async def get_state_binary(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        payload = await dispatch(lambda: pack_frames(*producer.drain_positions()))
+        return Response(payload, mimetype='application/octet-stream')
+    except ValueError as e:
+        app.logger.error(f"get_state_binary: {e} for session {session_id}")
+        return jsonify({"error": "Simulation produced NaN values.", "details": str(e)}), 500
+    except Exception as e:
+        app.logger.exception(f"get_state_binary: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/stream/<session_id>")
+async def stream_state(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    window = max(int(request.args.get('window', STREAM_WINDOW_FRAMES)), 1)
+
+    async def events():
+        while await dispatch(sessions.get, session_id, executor=stream_pool) is producer:
+            allowed = await wait_for_window(producer, window)
+            event, done = await dispatch(stream_event, producer, window, session_id, allowed, executor=stream_pool)
+            if event: yield event
+            if done: return
+
+    response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None # The stream lasts as long as the session, past Quart's response timeout
+    return response
+
+@app.route("/ack/<session_id>", methods=['POST'])
+async def ack_frames(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        frame = int((await request.get_json())['frame'])
+        def ack():
+            producer.ack(frame)
+            return producer.acked
+        return jsonify({"acked": await dispatch(ack)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.get("/diagnostics/<session_id>")
+async def get_diagnostics(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    diagnostics = getattr(producer, 'diagnostics', None)
+    if diagnostics is None:
+        return jsonify({"error": "No diagnostics recorded for this session"}), 404
+    return jsonify({"fields": list(DIAGNOSTIC_FIELDS), "frames": diagnostics.tolist()})
+
+@app.get("/chaos/<session_id>")
+async def get_chaos(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    chaos = getattr(producer, 'chaos', None)
+    if chaos is None:
+        return jsonify({"error": "No chaos indicators recorded for this session"}), 404
+    return jsonify({"fields": list(CHAOS_FIELDS), "frames": chaos.tolist()})
+
+@app.route("/checkpoint/<session_id>", methods=['POST'])
+async def save_checkpoint(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        name, frame = await dispatch(producer.save_checkpoint, CHECKPOINT_DIR, session_id)
+        return jsonify({"checkpoint": name, "frame": frame})
+    except Exception as e:
+        app.logger.exception(f"save_checkpoint: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/restore/<name>", methods=['POST'])
+async def restore_checkpoint(name):
+    path = checkpoint_file(name)
+    if not path or not os.path.exists(path): return jsonify({'error': 'Checkpoint not found'}), 404
+    try:
+        def restore():
+            new_id, sim_runner = start_session(lambda sid: pool.restore(sid, path, checkpoint_dir=os.path.join(CHECKPOINT_DIR, sid)))
+            return new_id, sim_runner.frame, sim_runner.cfg
+        new_id, frame, cfg = await dispatch(restore)
+        app.logger.info(f"Restored checkpoint '{name}' at frame {frame} into session {new_id}.")
+        return jsonify({'session_id': new_id, 'frame': frame, 'system_config': cfg})
+    except Exception as e:
+        app.logger.exception(f"Error restoring checkpoint {name}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route("/seek/<session_id>", methods=['POST'])
+async def seek(session_id):
+    producer = await get_session(session_id)
+    if producer is None:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        frame = int((await request.get_json())['frame'])
+        if frame < 0: return jsonify({"error": "Frame must not be negative"}), 400
+        def seek_to():
+            producer.seek(frame)
+            return producer.frame
+        return jsonify({"frame": await dispatch(seek_to)})
+    except Exception as e:
+        app.logger.exception(f"seek: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/admin/sessions")
+async def list_sessions():
+    return jsonify(await dispatch(sessions.stats))
+
+@app.route("/admin/sessions/<session_id>", methods=['DELETE'])
+async def close_session(session_id):
+    if not await dispatch(sessions.remove, session_id):
+        return jsonify({"error": "Invalid session ID"}), 404
+    return jsonify({"closed": session_id})
+
+@app.route('/add_planet', methods=['POST'])
+async def add_planet():
+    data = await request.get_json()
+    app.logger.info(f"Conceptual add_planet: {data.get('name')}, mass {data.get('mass')} M☉")
+    return jsonify({'message': 'Planet data received (conceptual). Re-init for changes.'}), 200
+
+@app.route('/save_scenario', methods=['POST'])
+async def save_scenario():
+    try:
+        sane_name = await dispatch(save_scenario_file, await request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    app.logger.info(f"Scenario '{sane_name}' saved with mass converted to Solar Masses.")
+    return jsonify({'message': 'Scenario saved successfully'}), 200
+
+@app.route('/list_scenarios')
+async def list_scenarios():
+    return jsonify(await dispatch(scenario_summaries))
+
+@app.route('/load_scenario/<filename>')
+async def load_scenario(filename):
+    path = scenario_file(filename)
+    if not path: return jsonify({'error': 'Invalid scenario name'}), 400
+    if not os.path.exists(path): return jsonify({'error': 'Scenario not found'}), 404
+
+    def read():
+        with open(path, 'r') as f: scenario_data = json.load(f)
+        return scenario_data, load_scenario_config(scenario_data)
+
+    try:
+        scenario_data, loaded_cfg = await dispatch(read)
+        try: chaos_config(loaded_cfg)
+        except ValueError as e: return jsonify({'error': str(e)}), 400
+        new_id, _ = await dispatch(start_session, lambda sid: pool.open(sid, loaded_cfg, high_water=int(scenario_data.get('high_water', DEFAULT_HIGH_WATER)),
+                                                                        checkpoint_dir=os.path.join(CHECKPOINT_DIR, sid), checkpoint_every=int(scenario_data.get('checkpoint_every', 0))))
+        app.logger.info(f"Loaded scenario '{filename}' into session {new_id}.")
+        return jsonify({'session_id': new_id, 'system_config': loaded_cfg})
+    except Exception as e:
+        app.logger.exception(f"Error loading scenario {filename}")
+        return jsonify({'error': str(e)}), 500
+
+if __name__ == '__main__':
+    app.run(debug=True, port=5555)
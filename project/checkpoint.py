@@ -0,0 +1,47 @@
+# checkpoint.py (Flat binary snapshots of a simulation session)
+#
+# A checkpoint file is
+#   header   64 bytes: magic b'LOMACKPT', format version (u32), JSON length, states offset and states length (u64 each)
+#   JSON     the SolarSystemConfig, the frame it was taken at and whatever else the runner needs to resume
+#   states   the loma BodyState array byte for byte as the native code lays it out, at a 64 byte aligned offset
+# so the states can be memory-mapped straight into a ctypes array or NumPy view without parsing.
+import dataclasses
+import json
+import mmap
+import struct
+from config import BodyState, SolarSystemConfig
+
+MAGIC = b'LOMACKPT'
+VERSION = 1
+HEADER = struct.Struct('<8sIQQQ')
+HEADER_SIZE = 64
+ALIGNMENT = 64
+
+def config_to_dict(cfg: SolarSystemConfig) -> dict:
+    return dataclasses.asdict(cfg)
+
+def config_from_dict(data: dict) -> SolarSystemConfig:
+    bodies = [BodyState(**{k: tuple(v) if isinstance(v, list) else v for k, v in b.items()}) for b in data['initial_bodies_data']]
+    return SolarSystemConfig(**{**data, 'initial_bodies_data': bodies})
+
+def write_checkpoint(path: str, cfg: SolarSystemConfig, body_states, meta: dict):
+    """ Writes body_states (a ctypes array of loma BodyState) with cfg and meta to path """
+    text = json.dumps({'config': config_to_dict(cfg), **meta}).encode('utf-8')
+    states_offset = -(-(HEADER_SIZE + len(text)) // ALIGNMENT) * ALIGNMENT
+    states = bytes(body_states)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(text), states_offset, len(states)).ljust(HEADER_SIZE, b'\0'))
+        f.write(text)
+        f.write(b'\0' * (states_offset - HEADER_SIZE - len(text)))
+        f.write(states)
+
+def read_checkpoint(path: str):
+    """ Maps the checkpoint at path. Returns its config, its JSON metadata and a read-only
+        memoryview of the raw BodyState array, which stays valid while the view is alive. """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, text_length, states_offset, states_length = HEADER.unpack_from(mapped)
+    if magic != MAGIC: raise ValueError(f"{path} is not a checkpoint")
+    if version != VERSION: raise ValueError(f"{path} has checkpoint format {version}, expected {VERSION}")
+    meta = json.loads(mapped[HEADER_SIZE:HEADER_SIZE + text_length].decode('utf-8'))
+    return config_from_dict(meta.pop('config')), meta, memoryview(mapped)[states_offset:states_offset + states_length]
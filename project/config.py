@@ -10,6 +10,7 @@ class BodyState:
     vel: Union[tuple[float, float, float], float] = (0.0, 0.0, 0.0) # Velocity in AU/year
     color: Optional[str] = None # Visual color
     radius: Optional[float] = None # Visual radius, not used in physics
+    collision_radius: Optional[float] = None # Physical radius in AU for SolarSystemConfig.collisions; None is a point
 
 @dataclass
 class SolarSystemConfig:
@@ -22,4 +23,19 @@ class SolarSystemConfig:
     initial_bodies_data: List[BodyState]
     loma_code_file: str = "planetary_motion_3d_loma.py" 
     dimensions: int = 3
-    integrator: Literal['symplectic_euler', 'rk4'] = 'symplectic_euler'
\ No newline at end of file
+    integrator: Literal['symplectic_euler', 'rk4', 'leapfrog', 'yoshida4', 'forest_ruth', 'dopri5', 'block_leapfrog', 'wisdom_holman'] = 'symplectic_euler' # The symplectic ones keep energy bounded; leapfrog costs 1 force evaluation per step, yoshida4 and forest_ruth 3. 'dopri5' sizes its own steps, 'block_leapfrog' gives each body its own, 'wisdom_holman' solves the orbits about body 0 analytically
+    gradient_mode: Literal['forward', 'forward_vector', 'reverse'] = 'reverse' # 'forward' keeps the per-partial fwd_diff path, 'forward_vector' uses one 6-wide pass per body
+    force_method: Literal['direct', 'barnes_hut', 'fmm'] = 'direct' # 'barnes_hut' trades exact O(N^2) forces for an O(N log N) octree approximation, 'fmm' for an O(N) one
+    theta: float = 0.5 # Opening angle for the tree methods; smaller is more accurate, 0 reproduces the direct sum
+    fmm_order: int = 4 # FMM expansion order, 1 = monopole forces; see fmm_sweep.py to pick one per scenario
+    fmm_leaf_size: int = 16 # Bodies per FMM leaf; larger leaves trade M2L work for direct pair sums
+    layout: Literal['aos', 'soa'] = 'aos' # 'soa' runs the 'direct' sum over contiguous x/y/z/mass arrays, in a loop the C compiler vectorizes
+    tolerance: float = 1e-8 # Per-step relative error target of 'dopri5', which then ignores sim_steps_per_frame (at least 1e-6 in single precision)
+    max_block_level: int = 10 # 'block_leapfrog' steps each body with dt / 2^level, level <= max_block_level, where dt = years_per_frame / sim_steps_per_frame
+    block_eta: float = 0.005 # ... and dt / 2^level <= block_eta * min over other bodies j of sqrt(d^3 / (G m_j))
+    test_particle_mass: float = 0.0 # Bodies lighter than this feel the others but pull on nothing, so they cost O(N_massive) each
+    collisions: Literal['none', 'merge', 'bounce', 'flag'] = 'none' # What happens when bodies come within their collision_radius sum; every contact is logged
+    restitution: float = 1.0 # Share of the approach speed a 'bounce' gives back, 1 = elastic
+    diagnostics: bool = False # Record DIAGNOSTIC_FIELDS (energy, momentum, angular momentum, center of mass) natively at every frame
+    chaos_indicators: bool = False # Step the variational equations alongside and record CHAOS_FIELDS (Lyapunov exponent, MEGNO) at every frame
+    precision: Literal['single', 'double'] = 'single' # 'double' lowers loma floats to C doubles; its energy error stays small at far larger dt
\ No newline at end of file
@@ -0,0 +1,76 @@
+# fmm_sweep.py (Accuracy vs. cost of the tree force methods against the direct gradient)
+#
+#   python fmm_sweep.py [scenario] [--orders 1,2,4,6,8] [--thetas 0.3,0.5,0.7] [--repeats 5]
+#
+# scenario is one of solarsys, jupiterchaotic, trulychaotic or cluster[:N] (default cluster:2000).
+# Every force method is run through the same native get_forces used by the integrators, and compared
+# against force_method = 'direct', i.e. -dH/dr of n_body_hamiltonian summed pair by pair.
+import argparse
+import contextlib
+import ctypes
+import dataclasses
+import io
+import logging
+import time
+import numpy as np
+import planetary_motion as pm
+
+def parse_scenario(name: str):
+    if name == "solarsys": return pm.setup_solar_system_scenario()
+    if name == "jupiterchaotic": return pm.setup_jupiter_system_scenario()
+    if name == "trulychaotic": return pm.setup_true_chaotic_scenario()
+    if name.startswith("cluster"):
+        return pm.setup_star_cluster_scenario(int(name.split(':')[1]) if ':' in name else 2000)
+    raise ValueError(f"Unknown scenario: {name}")
+
+def measure_forces(structs, lib, cfg, states, repeats: int):
+    """ Returns the (N, 3) forces of one get_forces call and its best wall time over repeats """
+    derivs = (structs['BodyDerivative'] * cfg.current_n_bodies)()
+    sim_conf = pm.make_sim_config(structs, cfg)
+    workspace = pm.make_force_workspace(structs, cfg)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        lib.get_forces(states, sim_conf, derivs, ctypes.byref(workspace))
+        best = min(best, time.perf_counter() - start)
+    forces = np.array([(d.d_mom.x, d.d_mom.y, d.d_mom.z) for d in derivs], dtype=np.float64)
+    return forces, best
+
+def force_errors(forces, reference):
+    rel = np.linalg.norm(forces - reference, axis=1) / np.maximum(np.linalg.norm(reference, axis=1), 1e-30)
+    return np.sqrt(np.mean(rel**2)), np.max(rel)
+
+def main():
+    parser = argparse.ArgumentParser(description="Force error and cost of Barnes-Hut and FMM against the direct sum")
+    parser.add_argument("scenario", nargs="?", default="cluster:2000")
+    parser.add_argument("--orders", default="1,2,3,4,5,6,8")
+    parser.add_argument("--thetas", default="0.3,0.5,0.7")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    np.random.seed(0)
+    base_cfg = parse_scenario(args.scenario)
+    with contextlib.redirect_stdout(io.StringIO()): # The compiler echoes the generated code
+        structs, lib = pm.compile_loma_code(base_cfg.loma_code_file, pm.COMPILED_LIB_NAME_PREFIX_3D, base_cfg.precision)
+    if not structs or not lib: raise SystemExit("Failed to compile the loma code")
+    states = (structs['BodyState'] * base_cfg.current_n_bodies)()
+    pm.load_initial_states(structs, base_cfg, states)
+
+    reference, direct_time = measure_forces(structs, lib, dataclasses.replace(base_cfg, force_method='direct'), states, args.repeats)
+    print(f"{base_cfg.name}: N = {base_cfg.current_n_bodies}")
+    print(f"{'method':<12}{'theta':>7}{'order':>7}{'time (ms)':>12}{'speedup':>9}{'rms rel err':>14}{'max rel err':>14}")
+    print(f"{'direct':<12}{'':>7}{'':>7}{direct_time*1e3:>12.2f}{1.0:>9.2f}{0.0:>14.2e}{0.0:>14.2e}")
+    for theta in [float(t) for t in args.thetas.split(',')]:
+        cfg = dataclasses.replace(base_cfg, force_method='barnes_hut', theta=theta)
+        forces, t = measure_forces(structs, lib, cfg, states, args.repeats)
+        rms, worst = force_errors(forces, reference)
+        print(f"{'barnes_hut':<12}{theta:>7.2f}{'':>7}{t*1e3:>12.2f}{direct_time/t:>9.2f}{rms:>14.2e}{worst:>14.2e}")
+        for order in [int(o) for o in args.orders.split(',')]:
+            cfg = dataclasses.replace(base_cfg, force_method='fmm', theta=theta, fmm_order=order)
+            forces, t = measure_forces(structs, lib, cfg, states, args.repeats)
+            rms, worst = force_errors(forces, reference)
+            print(f"{'fmm':<12}{theta:>7.2f}{order:>7}{t*1e3:>12.2f}{direct_time/t:>9.2f}{rms:>14.2e}{worst:>14.2e}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# frame_producer.py (Background frame computation for a simulation session)
+#
+# A FrameProducer owns a SimulationRunner and a worker thread that keeps a bounded buffer of frames
+# computed ahead. The worker refills the buffer in chunks up to its high-water mark and then sleeps
+# until frames are drained, so a request only copies out what is ready while the native code, which
+# releases the GIL, runs alongside the server. Frames are buffered as position arrays and only turned
+# into BodyState dataclasses for callers that ask for them.
+import collections
+import contextlib
+import os
+import threading
+import numpy as np
+import utils
+
+DEFAULT_HIGH_WATER = 240 # Frames computed ahead, 2 s of playback at 120 fps
+DEFAULT_CHUNK_FRAMES = 30 # Frames per native call; smaller chunks refill sooner, larger ones amortize the call
+
+class FrameProducer:
+    def __init__(self, runner, high_water: int = DEFAULT_HIGH_WATER, chunk_frames: int = DEFAULT_CHUNK_FRAMES):
+        self.runner = runner
+        self.high_water, self.chunk_frames = max(high_water, 1), max(chunk_frames, 1)
+        self.frame = runner.frame # Frame the next drained frame belongs to
+        self.diagnostics = None # (frames, DIAGNOSTIC_FIELDS) of the latest drain if the runner records them
+        self.chaos = None # (frames, CHAOS_FIELDS) of the latest drain if the runner records them
+        self.error = None # Exception that stopped the worker, raised again by the next drain
+        self.acked = self.frame # Frame a streaming client has reported playing up to, see ack()
+        self._frames = collections.deque() # (positions (N, 3), present mask (N,), diagnostics row or None, chaos row or None) per frame
+        self._stopped = False
+        # The worker holds _runner_lock while stepping; _ready guards the buffer. Always take them in that order.
+        self._runner_lock = threading.Lock()
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._produce, name=f"frames-{runner.cfg.name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def cfg(self): return self.runner.cfg
+
+    @property
+    def collisions(self): return self.runner.collisions
+
+    @property
+    def stopped(self): return self._stopped
+
+    @property
+    def buffered_frames(self): return len(self._frames)
+
+    def _produce(self):
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._stopped or len(self._frames) < self.high_water)
+                if self._stopped: return
+                n = min(self.chunk_frames, self.high_water - len(self._frames))
+            with self._runner_lock:
+                try:
+                    positions, present = self.runner.advance(n)
+                    diagnostics = self.runner.diagnostics if self.runner.cfg.diagnostics else None
+                    chaos = self.runner.chaos if self.runner.cfg.chaos_indicators else None
+                except Exception as e:
+                    with self._ready:
+                        self.error, self._stopped = e, True
+                        self._ready.notify_all()
+                    return
+                with self._ready:
+                    none = [None] * len(positions)
+                    self._frames.extend(zip(positions, present, diagnostics if diagnostics is not None else none, chaos if chaos is not None else none))
+                    self._ready.notify_all()
+
+    def drain_positions(self, max_frames: int = None, timeout: float = 30.0):
+        """ Takes up to max_frames of the frames computed so far (all of them by default), waiting up to
+            timeout seconds for the first one if none are ready. Returns the frame number of the first,
+            their (frames, N, 3) positions over the runner's initial bodies and the (frames, N) mask of
+            the bodies present, as runner.advance does. """
+        with self._ready:
+            self._ready.wait_for(lambda: self._frames or self._stopped, timeout)
+            if not self._frames and self.error is not None: raise self.error
+            n = len(self._frames) if max_frames is None else min(max_frames, len(self._frames))
+            drained = [self._frames.popleft() for _ in range(n)]
+            first_frame, self.frame = self.frame, self.frame + n
+            self._ready.notify_all()
+        rows = [row for _, _, row, _ in drained if row is not None]
+        if rows: self.diagnostics = np.array(rows)
+        rows = [row for _, _, _, row in drained if row is not None]
+        if rows: self.chaos = np.array(rows)
+        n_bodies = self.runner.initial_cfg.current_n_bodies
+        positions = np.array([p for p, _, _, _ in drained]).reshape(n, n_bodies, 3)
+        present = np.array([m for _, m, _, _ in drained], dtype=bool).reshape(n, n_bodies)
+        return first_frame, positions, present
+
+    def drain(self, max_frames: int = None, timeout: float = 30.0):
+        """ Like drain_positions, but returns the frames as lists of BodyState, as calling the runner does """
+        _, positions, present = self.drain_positions(max_frames, timeout)
+        return utils.convert_positions_to_body_states(positions, present, self.runner.initial_cfg)
+
+    __call__ = drain
+
+    def ack(self, frame: int):
+        """ Records that the client has played up to frame, which lets wait_for_window hand out more """
+        with self._ready:
+            self.acked = max(self.acked, min(frame, self.frame))
+            self._ready.notify_all()
+
+    def wait_for_window(self, window: int, timeout: float) -> int:
+        """ Waits up to timeout seconds until fewer than window drained frames are still unacknowledged.
+            Returns how many more may be drained, 0 if it timed out or the producer stopped. """
+        with self._ready:
+            self._ready.wait_for(lambda: self._stopped or self.frame - self.acked < window, timeout)
+            return 0 if self._stopped else max(window - (self.frame - self.acked), 0)
+
+    def seek(self, frame: int):
+        """ Skips ahead within the buffered frames, or discards them and moves the runner to frame """
+        with self._ready:
+            if self.frame <= frame <= self.frame + len(self._frames):
+                for _ in range(frame - self.frame): self._frames.popleft()
+                self.frame = self.acked = frame
+                self._ready.notify_all()
+                return
+        with self._runner_lock:
+            self.runner.seek(frame)
+            with self._ready:
+                self._frames.clear()
+                self.frame = self.acked = self.runner.frame
+                self._ready.notify_all()
+
+    def memory_bytes(self) -> int:
+        """ Bytes held by the runner and by the frames buffered ahead """
+        with self._ready:
+            buffered = sum(p.nbytes + m.nbytes + sum(row.nbytes for row in rows if row is not None) for p, m, *rows in self._frames)
+        return self.runner.memory_bytes() + buffered
+
+    def save_checkpoint(self, directory: str, prefix: str):
+        """ Checkpoints the runner where it stands, past the buffered frames, to <prefix>_<frame>.ckpt in
+            directory. Returns the checkpoint's name and frame. """
+        with self._runner_lock:
+            name = f"{prefix}_{self.runner.frame:08d}"
+            self.runner.save_checkpoint(os.path.join(directory, f"{name}.ckpt"))
+            return name, self.runner.frame
+
+    @contextlib.contextmanager
+    def paused(self):
+        """ Holds the worker between chunks and yields the runner, which stands at the end of the buffered frames """
+        with self._runner_lock:
+            yield self.runner
+
+    def stop(self):
+        with self._ready:
+            self._stopped = True
+            self._ready.notify_all()
+        self._thread.join()
@@ -9,172 +9,1942 @@ class BodyState:
     mom: Vec3
     mass: float
     inv_mass: float
+    radius: float # Collision radius; -1 once the body has been merged into another
 
 class SimConfig:
     G: float
     dt: float
     epsilon_sq: float
     num_bodies: int
+    integrator: int # 0 = symplectic Euler, 1 = RK4, 2 = leapfrog (KDK), 3 = Yoshida 4th order, 4 = Forest-Ruth, 5 = Dormand-Prince 5(4), 6 = block timestep leapfrog, 7 = Wisdom-Holman
+    gradient_mode: int # 0 = one forward-mode pass per partial, 1 = reverse mode, 2 = one vector forward-mode pass per term
+    force_method: int # 0 = direct pair sum, 1 = Barnes-Hut octree, 2 = fast multipole method
+    theta: float # Opening angle; Barnes-Hut opens a cell unless width < theta * distance, FMM a cell pair unless (r_a + r_b) < theta * distance
+    fmm_order: int # FMM expansion order (1 = monopole forces), at most 16
+    tolerance: float # Per-step error target of the adaptive integrator, relative to each position and velocity component
+    max_block_level: int # Block timesteps go down to dt / 2^max_block_level
+    block_eta: float # A body's block step is at most block_eta times the shortest timescale sqrt(d^3 / (G m_j)) of its pulls
+    test_particle_mass: float # Bodies lighter than this are test particles: they feel the massive bodies but pull on nothing
+    collision_mode: int # 0 = none, 1 = merge, 2 = bounce, 3 = flag only
+    restitution: float # Fraction of the approach speed a bounce gives back, 1 = elastic
+    layout: int # 0 = direct sum over the BodyState array, 1 = over the structure-of-arrays copy in ForceWorkspace
+    variational: int # 1 = step a tangent vector alongside the state and record chaos indicators in VariationalWorkspace
 
 # New struct to hold derivatives for RK4
 class BodyDerivative:
     d_pos: Vec3 # Represents velocity (dr/dt)
     d_mom: Vec3 # Represents force (dp/dt)
 
+# One cell of the Barnes-Hut octree. Children are stored as 8 consecutive nodes,
+# and a leaf keeps its bodies as a linked list through ForceWorkspace.body_next.
+class OctreeNode:
+    center: Vec3
+    half_size: float
+    com: Vec3 # Center of mass of everything below this cell
+    mass: float
+    radius: float # Distance from com to the farthest body below this cell
+    first_child: int # -1 for a leaf
+    first_body: int # -1 for an empty leaf or an internal node
+    num_bodies: int # Bodies in a leaf's list
+
+# Scratch space for the tree force methods, allocated by the host
+class ForceWorkspace:
+    nodes: Array[OctreeNode]
+    body_next: Array[int]
+    max_nodes: int
+    num_nodes: int
+    leaf_capacity: int # A leaf is split once it holds this many bodies
+    # FMM expansions, num_coeffs per node, and their multi-index tables
+    multipoles: Array[float]
+    locals: Array[float]
+    kernel: Array[float] # (fmm_order + 1) * num_coeffs entries of the derivative recurrence
+    coeff_x: Array[int]
+    coeff_y: Array[int]
+    coeff_z: Array[int]
+    coeff_deg: Array[int]
+    coeff_index: Array[int] # (a, b, c) -> coefficient, (fmm_order + 1)^3 entries
+    inv_fact: Array[float]
+    coeff_sign: Array[float] # (-1)^|a|
+    # Kernel recurrence per coefficient a: step along axis rec_dir from a - e and (a_dir - 1) times a - 2e
+    rec_dir: Array[int]
+    rec_prev: Array[int]
+    rec_prev2: Array[int]
+    rec_mul: Array[int]
+    # For each coefficient b, every a with |a| + |b| <= fmm_order and the index of a + b,
+    # in pair_other/pair_sum[pair_start[b]..pair_start[b + 1])
+    pair_start: Array[int]
+    pair_other: Array[int]
+    pair_sum: Array[int]
+    m2l_sources: Array[float] # 2 * num_coeffs of M2L scratch
+    num_coeffs: int
+    # Bodies split by config.test_particle_mass, num_bodies entries each
+    massive: Array[int]
+    num_massive: int
+    tests: Array[int]
+    num_tests: int
+    # Structure-of-arrays copy of the live bodies for the direct sum, massive bodies first, num_bodies entries each
+    soa_x: Array[float]
+    soa_y: Array[float]
+    soa_z: Array[float]
+    soa_mass: Array[float]
+    soa_ax: Array[float]
+    soa_ay: Array[float]
+    soa_az: Array[float]
+
+# State of the adaptive integrators, allocated by the host: the extra Dormand-Prince stages
+# and the step size it carries from frame to frame, and the per-body block timestep levels
+class AdaptiveWorkspace:
+    k5: Array[BodyDerivative]
+    k6: Array[BodyDerivative]
+    k7: Array[BodyDerivative]
+    dt: float # Next trial step; 0 starts from SimConfig.dt
+    accepted_steps: int
+    rejected_steps: int
+    levels: Array[int] # Block timestep level per body, stepping with dt / 2^level
+    force_evaluations: int # Single-body force evaluations of the block timestep integrator
+
+# Spatial hash and event log of the collision check, allocated by the host
+class CollisionWorkspace:
+    heads: Array[int] # First body of every hash bucket, -1 if empty
+    body_next: Array[int]
+    cell_x: Array[int]
+    cell_y: Array[int]
+    cell_z: Array[int]
+    table_size: int # A prime, so the folded cell keys spread over every bucket
+    # Contacts as (body, body, frame); for a merger the first body is the survivor
+    event_i: Array[int]
+    event_j: Array[int]
+    event_frame: Array[int]
+    max_events: int
+    num_events: int # Keeps counting past max_events, which only limits what is stored
+    num_resolved: int # Mergers and bounces, which invalidate the forces an integrator carries
+
+# Tangent vector of the variational equations and its chaos indicator sums, allocated by the host
+class VariationalWorkspace:
+    tangent: Array[BodyDerivative] # (delta r, delta p) per body
+    tangent_force: Array[BodyDerivative] # d_mom = (dF/dr) delta r for the current tangent, carried between steps
+    time: float # Years since the tangent was seeded
+    log_growth: float # Sum of log |delta| over the renormalizations
+    megno_sum: float # Integral of 2 t (delta' . delta) / |delta|^2 dt
+    megno_mean_sum: float # Integral of megno_sum / t dt
+    frame_indicators: Array[float] # [frame][2]: Lyapunov exponent (1/year) and mean MEGNO after each frame
+
 # --- Hamiltonian Function (3D) ---
-def n_body_hamiltonian(states: In[Array[BodyState, 20]], 
+# H is a sum of per-body kinetic and per-pair potential terms. The gradient is
+# accumulated term by term, so nothing in the kernel is sized by the body count.
+def body_kinetic_energy(b: In[BodyState]) -> float:
+    return (b.mom.x*b.mom.x + b.mom.y*b.mom.y + b.mom.z*b.mom.z) * b.inv_mass * 0.5
+
+def pair_potential_energy(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig]) -> float:
+    dx: float = bj.pos.x - bi.pos.x; dy: float = bj.pos.y - bi.pos.y; dz: float = bj.pos.z - bi.pos.z
+    dist_sq: float = dx*dx + dy*dy + dz*dz
+    inv_dist_soft: float = 1.0 / sqrt(dist_sq + config.epsilon_sq)
+    return 0.0 - config.G * bi.mass * bj.mass * inv_dist_soft
+
+def n_body_hamiltonian(states: In[Array[BodyState]], 
                        config: In[SimConfig]) -> float:
     total_kinetic_energy: float = 0.0; total_potential_energy: float = 0.0; i: int = 0; j: int = 0
-    dx: float; dy: float; dz: float; dist_sq: float; inv_dist_soft: float
-    s_i_pos_x: float; s_i_pos_y: float; s_i_pos_z: float; s_j_pos_x: float; s_j_pos_y: float; s_j_pos_z: float 
-    s_i_mom_x: float; s_i_mom_y: float; s_i_mom_z: float; s_i_inv_mass: float; s_i_mass: float; s_j_mass: float
-    i = 0
-    while (i < config.num_bodies, max_iter := 20):
-        s_i_mom_x = states[i].mom.x; s_i_mom_y = states[i].mom.y; s_i_mom_z = states[i].mom.z
-        s_i_inv_mass = states[i].inv_mass
-        total_kinetic_energy = total_kinetic_energy + (s_i_mom_x*s_i_mom_x + s_i_mom_y*s_i_mom_y + s_i_mom_z*s_i_mom_z) * s_i_inv_mass * 0.5
-        i = i + 1
     i = 0
-    while (i < config.num_bodies, max_iter := 20):
-        s_i_pos_x = states[i].pos.x; s_i_pos_y = states[i].pos.y; s_i_pos_z = states[i].pos.z
-        s_i_mass = states[i].mass
+    while (i < config.num_bodies, max_iter := 100000):
+        total_kinetic_energy = total_kinetic_energy + body_kinetic_energy(states[i])
         j = i + 1
-        while (j < config.num_bodies, max_iter := 20):
-            s_j_pos_x = states[j].pos.x; s_j_pos_y = states[j].pos.y; s_j_pos_z = states[j].pos.z
-            s_j_mass = states[j].mass
-            dx = s_j_pos_x - s_i_pos_x; dy = s_j_pos_y - s_i_pos_y; dz = s_j_pos_z - s_i_pos_z
-            dist_sq = dx*dx + dy*dy + dz*dz
-            inv_dist_soft = 1.0 / sqrt(dist_sq + config.epsilon_sq)
-            total_potential_energy = total_potential_energy - config.G * s_i_mass * s_j_mass * inv_dist_soft
+        while (j < config.num_bodies, max_iter := 100000):
+            total_potential_energy = total_potential_energy + pair_potential_energy(states[i], states[j], config)
             j = j + 1
         i = i + 1
     return total_kinetic_energy + total_potential_energy
 
-d_n_body_hamiltonian = fwd_diff(n_body_hamiltonian)
-
-def get_dH_dr_k_alpha(states_val: In[Array[BodyState, 20]], config_val: In[SimConfig], k: In[int], alpha: In[int]) -> float:
-    d_states: Array[Diff[BodyState], 20]; d_config: Diff[SimConfig]; idx: int = 0
-    while(idx < 20, max_iter := 20): 
-        if idx < config_val.num_bodies:
-            d_states[idx].pos.x.val = states_val[idx].pos.x; d_states[idx].pos.y.val = states_val[idx].pos.y; d_states[idx].pos.z.val = states_val[idx].pos.z
-            d_states[idx].mom.x.val = states_val[idx].mom.x; d_states[idx].mom.y.val = states_val[idx].mom.y; d_states[idx].mom.z.val = states_val[idx].mom.z
-            d_states[idx].mass.val = states_val[idx].mass; d_states[idx].inv_mass.val = states_val[idx].inv_mass
-        else: 
-            d_states[idx].pos.x.val = 0.0; d_states[idx].pos.y.val = 0.0; d_states[idx].pos.z.val = 0.0 
-            d_states[idx].mom.x.val = 0.0; d_states[idx].mom.y.val = 0.0; d_states[idx].mom.z.val = 0.0 
-            d_states[idx].mass.val = 1.0; d_states[idx].inv_mass.val = 1.0
-        d_states[idx].pos.x.dval = 0.0; d_states[idx].pos.y.dval = 0.0; d_states[idx].pos.z.dval = 0.0 
-        d_states[idx].mom.x.dval = 0.0; d_states[idx].mom.y.dval = 0.0; d_states[idx].mom.z.dval = 0.0 
-        d_states[idx].mass.dval = 0.0; d_states[idx].inv_mass.dval = 0.0
-        idx = idx + 1
-    d_config.G.val = config_val.G; d_config.G.dval = 0.0; d_config.dt.val = config_val.dt; d_config.dt.dval = 0.0; d_config.epsilon_sq.val = config_val.epsilon_sq; d_config.epsilon_sq.dval = 0.0; d_config.num_bodies = config_val.num_bodies 
-    if k < config_val.num_bodies: 
-        if alpha == 0: d_states[k].pos.x.dval = 1.0
-        elif alpha == 1: d_states[k].pos.y.dval = 1.0
-        else: d_states[k].pos.z.dval = 1.0 
-    return d_n_body_hamiltonian(d_states, d_config).dval
-
-def get_dH_dp_k_alpha(states_val: In[Array[BodyState, 20]], config_val: In[SimConfig], k: In[int], alpha: In[int]) -> float:
-    d_states: Array[Diff[BodyState], 20]; d_config: Diff[SimConfig]; idx: int = 0
-    while(idx < 20, max_iter := 20): 
-        if idx < config_val.num_bodies:
-            d_states[idx].pos.x.val = states_val[idx].pos.x; d_states[idx].pos.y.val = states_val[idx].pos.y; d_states[idx].pos.z.val = states_val[idx].pos.z
-            d_states[idx].mom.x.val = states_val[idx].mom.x; d_states[idx].mom.y.val = states_val[idx].mom.y; d_states[idx].mom.z.val = states_val[idx].mom.z
-            d_states[idx].mass.val = states_val[idx].mass; d_states[idx].inv_mass.val = states_val[idx].inv_mass
-        else: 
-            d_states[idx].pos.x.val = 0.0; d_states[idx].pos.y.val = 0.0; d_states[idx].pos.z.val = 0.0
-            d_states[idx].mom.x.val = 0.0; d_states[idx].mom.y.val = 0.0; d_states[idx].mom.z.val = 0.0
-            d_states[idx].mass.val = 1.0; d_states[idx].inv_mass.val = 1.0
-        d_states[idx].pos.x.dval = 0.0; d_states[idx].pos.y.dval = 0.0; d_states[idx].pos.z.dval = 0.0
-        d_states[idx].mom.x.dval = 0.0; d_states[idx].mom.y.dval = 0.0; d_states[idx].mom.z.dval = 0.0
-        d_states[idx].mass.dval = 0.0; d_states[idx].inv_mass.dval = 0.0
-        idx = idx + 1
-    d_config.G.val = config_val.G; d_config.G.dval = 0.0; d_config.dt.val = config_val.dt; d_config.dt.dval = 0.0; d_config.epsilon_sq.val = config_val.epsilon_sq; d_config.epsilon_sq.dval = 0.0; d_config.num_bodies = config_val.num_bodies
-    if k < config_val.num_bodies: 
-        if alpha == 0: d_states[k].mom.x.dval = 1.0
-        elif alpha == 1: d_states[k].mom.y.dval = 1.0
-        else: d_states[k].mom.z.dval = 1.0
-    return d_n_body_hamiltonian(d_states, d_config).dval
+d_body_kinetic_energy = fwd_diff(body_kinetic_energy)
+d_pair_potential_energy = fwd_diff(pair_potential_energy)
+# Vector forward mode: lanes 0-2 seed mom.x/y/z of the body
+d3_body_kinetic_energy = fwd_diff(body_kinetic_energy, width = 3)
+# Vector forward mode: lanes 0-2 seed bi.pos.x/y/z and lanes 3-5 seed bj.pos.x/y/z
+d6_pair_potential_energy = fwd_diff(pair_potential_energy, width = 6)
+d_rev_body_kinetic_energy = rev_diff(body_kinetic_energy)
+d_rev_pair_potential_energy = rev_diff(pair_potential_energy)
+
+# dK/dp of one body, one function per gradient mode so each call only sets up its own differentials
+def kinetic_energy_gradient_rev(b: In[BodyState], dK_dp: Out[Vec3]):
+    d_b: BodyState
+    d_rev_body_kinetic_energy(b, d_b, 1.0)
+    dK_dp.x = d_b.mom.x; dK_dp.y = d_b.mom.y; dK_dp.z = d_b.mom.z
+
+def kinetic_energy_gradient_fwd_vector(b: In[BodyState], dK_dp: Out[Vec3]):
+    d_b: Diff[BodyState, 3]; d_K: Diff[float, 3]
+    d_b.mom.x.val = b.mom.x; d_b.mom.y.val = b.mom.y; d_b.mom.z.val = b.mom.z; d_b.inv_mass.val = b.inv_mass
+    d_b.mom.x.dval[0] = 1.0; d_b.mom.y.dval[1] = 1.0; d_b.mom.z.dval[2] = 1.0
+    d_K = d3_body_kinetic_energy(d_b)
+    dK_dp.x = d_K.dval[0]; dK_dp.y = d_K.dval[1]; dK_dp.z = d_K.dval[2]
+
+def kinetic_energy_gradient_fwd(b: In[BodyState], dK_dp: Out[Vec3]):
+    d_b: Diff[BodyState]
+    d_b.mom.x.val = b.mom.x; d_b.mom.y.val = b.mom.y; d_b.mom.z.val = b.mom.z; d_b.inv_mass.val = b.inv_mass
+    d_b.mom.x.dval = 1.0
+    dK_dp.x = d_body_kinetic_energy(d_b).dval
+    d_b.mom.x.dval = 0.0; d_b.mom.y.dval = 1.0
+    dK_dp.y = d_body_kinetic_energy(d_b).dval
+    d_b.mom.y.dval = 0.0; d_b.mom.z.dval = 1.0
+    dK_dp.z = d_body_kinetic_energy(d_b).dval
+
+def kinetic_energy_gradient(b: In[BodyState], config: In[SimConfig], dK_dp: Out[Vec3]):
+    if config.gradient_mode == 1:
+        kinetic_energy_gradient_rev(b, dK_dp)
+    elif config.gradient_mode == 2:
+        kinetic_energy_gradient_fwd_vector(b, dK_dp)
+    else:
+        kinetic_energy_gradient_fwd(b, dK_dp)
+
+# dV/dr_i and dV/dr_j of one pair term
+def pair_potential_gradient_rev(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], dV_dri: Out[Vec3], dV_drj: Out[Vec3]):
+    d_bi: BodyState; d_bj: BodyState; d_config: SimConfig
+    d_rev_pair_potential_energy(bi, d_bi, bj, d_bj, config, d_config, 1.0)
+    dV_dri.x = d_bi.pos.x; dV_dri.y = d_bi.pos.y; dV_dri.z = d_bi.pos.z
+    dV_drj.x = d_bj.pos.x; dV_drj.y = d_bj.pos.y; dV_drj.z = d_bj.pos.z
+
+def pair_potential_gradient_fwd_vector(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], dV_dri: Out[Vec3], dV_drj: Out[Vec3]):
+    d_bi: Diff[BodyState, 6]; d_bj: Diff[BodyState, 6]; d_config: Diff[SimConfig, 6]; d_V: Diff[float, 6]
+    d_bi.pos.x.val = bi.pos.x; d_bi.pos.y.val = bi.pos.y; d_bi.pos.z.val = bi.pos.z; d_bi.mass.val = bi.mass
+    d_bj.pos.x.val = bj.pos.x; d_bj.pos.y.val = bj.pos.y; d_bj.pos.z.val = bj.pos.z; d_bj.mass.val = bj.mass
+    d_config.G.val = config.G; d_config.epsilon_sq.val = config.epsilon_sq
+    d_bi.pos.x.dval[0] = 1.0; d_bi.pos.y.dval[1] = 1.0; d_bi.pos.z.dval[2] = 1.0
+    d_bj.pos.x.dval[3] = 1.0; d_bj.pos.y.dval[4] = 1.0; d_bj.pos.z.dval[5] = 1.0
+    d_V = d6_pair_potential_energy(d_bi, d_bj, d_config)
+    dV_dri.x = d_V.dval[0]; dV_dri.y = d_V.dval[1]; dV_dri.z = d_V.dval[2]
+    dV_drj.x = d_V.dval[3]; dV_drj.y = d_V.dval[4]; dV_drj.z = d_V.dval[5]
+
+def pair_potential_gradient_fwd(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], dV_dri: Out[Vec3], dV_drj: Out[Vec3]):
+    d_bi: Diff[BodyState]; d_bj: Diff[BodyState]; d_config: Diff[SimConfig]
+    d_bi.pos.x.val = bi.pos.x; d_bi.pos.y.val = bi.pos.y; d_bi.pos.z.val = bi.pos.z; d_bi.mass.val = bi.mass
+    d_bj.pos.x.val = bj.pos.x; d_bj.pos.y.val = bj.pos.y; d_bj.pos.z.val = bj.pos.z; d_bj.mass.val = bj.mass
+    d_config.G.val = config.G; d_config.epsilon_sq.val = config.epsilon_sq
+    d_bi.pos.x.dval = 1.0
+    dV_dri.x = d_pair_potential_energy(d_bi, d_bj, d_config).dval
+    d_bi.pos.x.dval = 0.0; d_bi.pos.y.dval = 1.0
+    dV_dri.y = d_pair_potential_energy(d_bi, d_bj, d_config).dval
+    d_bi.pos.y.dval = 0.0; d_bi.pos.z.dval = 1.0
+    dV_dri.z = d_pair_potential_energy(d_bi, d_bj, d_config).dval
+    d_bi.pos.z.dval = 0.0; d_bj.pos.x.dval = 1.0
+    dV_drj.x = d_pair_potential_energy(d_bi, d_bj, d_config).dval
+    d_bj.pos.x.dval = 0.0; d_bj.pos.y.dval = 1.0
+    dV_drj.y = d_pair_potential_energy(d_bi, d_bj, d_config).dval
+    d_bj.pos.y.dval = 0.0; d_bj.pos.z.dval = 1.0
+    dV_drj.z = d_pair_potential_energy(d_bi, d_bj, d_config).dval
+
+def pair_potential_gradient(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], dV_dri: Out[Vec3], dV_drj: Out[Vec3]):
+    if config.gradient_mode == 1:
+        pair_potential_gradient_rev(bi, bj, config, dV_dri, dV_drj)
+    elif config.gradient_mode == 2:
+        pair_potential_gradient_fwd_vector(bi, bj, config, dV_dri, dV_drj)
+    else:
+        pair_potential_gradient_fwd(bi, bj, config, dV_dri, dV_drj)
+
+# d_pos = dH/dp for every body
+def get_velocities(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]]):
+    k: int = 0; dK_dp: Vec3
+    while (k < config.num_bodies, max_iter := 100000):
+        kinetic_energy_gradient(states[k], config, dK_dp)
+        derivs[k].d_pos.x = dK_dp.x; derivs[k].d_pos.y = dK_dp.y; derivs[k].d_pos.z = dK_dp.z
+        k = k + 1
+
+# Sorts body indices into ws.massive and ws.tests, each in index order. Merged bodies are in neither.
+def partition_test_particles(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace]):
+    k: int = 0
+    ws.num_massive = 0; ws.num_tests = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        if states[k].radius >= 0.0:
+            if states[k].mass < config.test_particle_mass:
+                ws.tests[ws.num_tests] = k
+                ws.num_tests = ws.num_tests + 1
+            else:
+                ws.massive[ws.num_massive] = k
+                ws.num_massive = ws.num_massive + 1
+        k = k + 1
+
+# --- Barnes-Hut Octree ---
+# Index of the child of an internal node whose octant contains p
+def octree_child(node: In[OctreeNode], p: In[Vec3]) -> int:
+    c: int = 0
+    if p.x > node.center.x:
+        c = c + 1
+    if p.y > node.center.y:
+        c = c + 2
+    if p.z > node.center.z:
+        c = c + 4
+    return node.first_child + c
+
+def octree_contains(node: In[OctreeNode], p: In[Vec3]) -> int:
+    inside: int = 1; h: float = node.half_size
+    if p.x < node.center.x - h or p.x > node.center.x + h:
+        inside = 0
+    if p.y < node.center.y - h or p.y > node.center.y + h:
+        inside = 0
+    if p.z < node.center.z - h or p.z > node.center.z + h:
+        inside = 0
+    return inside
+
+def octree_split(ws: Out[ForceWorkspace], node: In[int]):
+    c: int = 0; first: int = ws.num_nodes; h: float = ws.nodes[node].half_size * 0.5
+    while (c < 8, max_iter := 8):
+        ws.nodes[first + c].center.x = ws.nodes[node].center.x - h
+        ws.nodes[first + c].center.y = ws.nodes[node].center.y - h
+        ws.nodes[first + c].center.z = ws.nodes[node].center.z - h
+        if c - (c / 2) * 2 == 1:
+            ws.nodes[first + c].center.x = ws.nodes[node].center.x + h
+        if (c / 2) - (c / 4) * 2 == 1:
+            ws.nodes[first + c].center.y = ws.nodes[node].center.y + h
+        if c / 4 == 1:
+            ws.nodes[first + c].center.z = ws.nodes[node].center.z + h
+        ws.nodes[first + c].half_size = h
+        ws.nodes[first + c].mass = 0.0
+        ws.nodes[first + c].first_child = -1
+        ws.nodes[first + c].first_body = -1
+        ws.nodes[first + c].num_bodies = 0
+        c = c + 1
+    ws.num_nodes = first + 8
+    ws.nodes[node].first_child = first
+
+# Walks body b down from the root and drops it into a leaf, splitting full leaves
+# on the way. Past depth 20, or once the node pool is full, leaves just grow.
+def octree_insert(states: In[Array[BodyState]], ws: Out[ForceWorkspace], b: In[int]):
+    node: int = 0; depth: int = 0; placed: int = 0; moved: int = 0; next_moved: int = 0; child: int = 0
+    while (placed == 0, max_iter := 64):
+        if ws.nodes[node].first_child >= 0:
+            node = octree_child(ws.nodes[node], states[b].pos)
+            depth = depth + 1
+        elif (ws.nodes[node].num_bodies < ws.leaf_capacity or depth >= 20) or ws.num_nodes + 8 > ws.max_nodes:
+            ws.body_next[b] = ws.nodes[node].first_body
+            ws.nodes[node].first_body = b
+            ws.nodes[node].num_bodies = ws.nodes[node].num_bodies + 1
+            placed = 1
+        else:
+            octree_split(ws, node)
+            moved = ws.nodes[node].first_body
+            ws.nodes[node].first_body = -1
+            while (moved >= 0, max_iter := 100000):
+                next_moved = ws.body_next[moved]
+                child = octree_child(ws.nodes[node], states[moved].pos)
+                ws.body_next[moved] = ws.nodes[child].first_body
+                ws.nodes[child].first_body = moved
+                ws.nodes[child].num_bodies = ws.nodes[child].num_bodies + 1
+                moved = next_moved
+            ws.nodes[node].num_bodies = 0
+
+# Only the massive bodies go into the tree; test particles walk it without being part of it
+def build_octree(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace]):
+    k: int = 0; q: int = 0; n: int = 0; c: int = 0; child: int = 0
+    min_x: float = 0.0; min_y: float = 0.0; min_z: float = 0.0
+    max_x: float = 0.0; max_y: float = 0.0; max_z: float = 0.0
+    size: float = 0.0; m: float = 0.0; mx: float = 0.0; my: float = 0.0; mz: float = 0.0; r: float = 0.0; dx: float = 0.0; dy: float = 0.0; dz: float = 0.0
+    partition_test_particles(states, config, ws)
+    # Bounding cube of the massive bodies
+    k = ws.massive[0]
+    min_x = states[k].pos.x; min_y = states[k].pos.y; min_z = states[k].pos.z
+    max_x = states[k].pos.x; max_y = states[k].pos.y; max_z = states[k].pos.z
+    q = 1
+    while (q < ws.num_massive, max_iter := 100000):
+        k = ws.massive[q]
+        if states[k].pos.x < min_x:
+            min_x = states[k].pos.x
+        if states[k].pos.x > max_x:
+            max_x = states[k].pos.x
+        if states[k].pos.y < min_y:
+            min_y = states[k].pos.y
+        if states[k].pos.y > max_y:
+            max_y = states[k].pos.y
+        if states[k].pos.z < min_z:
+            min_z = states[k].pos.z
+        if states[k].pos.z > max_z:
+            max_z = states[k].pos.z
+        q = q + 1
+    size = max_x - min_x
+    if max_y - min_y > size:
+        size = max_y - min_y
+    if max_z - min_z > size:
+        size = max_z - min_z
+    ws.nodes[0].center.x = (min_x + max_x) * 0.5; ws.nodes[0].center.y = (min_y + max_y) * 0.5; ws.nodes[0].center.z = (min_z + max_z) * 0.5
+    ws.nodes[0].half_size = size * 0.5001 + 1e-6
+    ws.nodes[0].first_child = -1; ws.nodes[0].first_body = -1; ws.nodes[0].num_bodies = 0
+    ws.num_nodes = 1
+    q = 0
+    while (q < ws.num_massive, max_iter := 100000):
+        octree_insert(states, ws, ws.massive[q])
+        q = q + 1
+    # Children are always created after their parent, so a reverse sweep sees them first
+    n = ws.num_nodes - 1
+    while (n >= 0, max_iter := 10000000):
+        m = 0.0; mx = 0.0; my = 0.0; mz = 0.0
+        if ws.nodes[n].first_child >= 0:
+            c = 0
+            while (c < 8, max_iter := 8):
+                child = ws.nodes[n].first_child + c
+                m = m + ws.nodes[child].mass
+                mx = mx + ws.nodes[child].com.x * ws.nodes[child].mass; my = my + ws.nodes[child].com.y * ws.nodes[child].mass; mz = mz + ws.nodes[child].com.z * ws.nodes[child].mass
+                c = c + 1
+        else:
+            k = ws.nodes[n].first_body
+            while (k >= 0, max_iter := 100000):
+                m = m + states[k].mass
+                mx = mx + states[k].pos.x * states[k].mass; my = my + states[k].pos.y * states[k].mass; mz = mz + states[k].pos.z * states[k].mass
+                k = ws.body_next[k]
+        ws.nodes[n].mass = m
+        ws.nodes[n].com.x = ws.nodes[n].center.x; ws.nodes[n].com.y = ws.nodes[n].center.y; ws.nodes[n].com.z = ws.nodes[n].center.z
+        if m > 0.0:
+            ws.nodes[n].com.x = mx / m; ws.nodes[n].com.y = my / m; ws.nodes[n].com.z = mz / m
+        ws.nodes[n].radius = 0.0
+        if ws.nodes[n].first_child >= 0:
+            c = 0
+            while (c < 8, max_iter := 8):
+                child = ws.nodes[n].first_child + c
+                if ws.nodes[child].mass > 0.0:
+                    dx = ws.nodes[child].com.x - ws.nodes[n].com.x; dy = ws.nodes[child].com.y - ws.nodes[n].com.y; dz = ws.nodes[child].com.z - ws.nodes[n].com.z
+                    r = sqrt(dx*dx + dy*dy + dz*dz) + ws.nodes[child].radius
+                    if r > ws.nodes[n].radius:
+                        ws.nodes[n].radius = r
+                c = c + 1
+        else:
+            k = ws.nodes[n].first_body
+            while (k >= 0, max_iter := 100000):
+                dx = states[k].pos.x - ws.nodes[n].com.x; dy = states[k].pos.y - ws.nodes[n].com.y; dz = states[k].pos.z - ws.nodes[n].com.z
+                r = sqrt(dx*dx + dy*dy + dz*dz)
+                if r > ws.nodes[n].radius:
+                    ws.nodes[n].radius = r
+                k = ws.body_next[k]
+        n = n - 1
+
+# -dV/dr_i of body i against the octree. A far enough cell acts as a single pseudo-body
+# at its center of mass, so the same pair_potential_gradient (and gradient_mode) applies.
+def octree_force_on_body(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace], i: In[int], force: Out[Vec3]):
+    stack: Array[int, 256]; sp: int = 0; node: int = 0; b: int = 0; c: int = 0
+    dx: float = 0.0; dy: float = 0.0; dz: float = 0.0; width: float = 0.0
+    cell: BodyState; dV_dri: Vec3; dV_drj: Vec3
+    force.x = 0.0; force.y = 0.0; force.z = 0.0
+    # Depth is capped at 20, so the stack never holds more than 7 * 20 + 8 entries
+    stack[0] = 0; sp = 1
+    while (sp > 0, max_iter := 10000000):
+        sp = sp - 1
+        node = stack[sp]
+        if ws.nodes[node].mass > 0.0:
+            if ws.nodes[node].first_child < 0:
+                b = ws.nodes[node].first_body
+                while (b >= 0, max_iter := 100000):
+                    if b < i or b > i:
+                        pair_potential_gradient(states[i], states[b], config, dV_dri, dV_drj)
+                        force.x = force.x - dV_dri.x; force.y = force.y - dV_dri.y; force.z = force.z - dV_dri.z
+                    b = ws.body_next[b]
+            else:
+                dx = ws.nodes[node].com.x - states[i].pos.x; dy = ws.nodes[node].com.y - states[i].pos.y; dz = ws.nodes[node].com.z - states[i].pos.z
+                width = 2.0 * ws.nodes[node].half_size
+                if width * width < config.theta * config.theta * (dx*dx + dy*dy + dz*dz) and octree_contains(ws.nodes[node], states[i].pos) == 0:
+                    cell.pos.x = ws.nodes[node].com.x; cell.pos.y = ws.nodes[node].com.y; cell.pos.z = ws.nodes[node].com.z
+                    cell.mass = ws.nodes[node].mass
+                    pair_potential_gradient(states[i], cell, config, dV_dri, dV_drj)
+                    force.x = force.x - dV_dri.x; force.y = force.y - dV_dri.y; force.z = force.z - dV_dri.z
+                else:
+                    c = 0
+                    while (c < 8, max_iter := 8):
+                        stack[sp] = ws.nodes[node].first_child + c
+                        sp = sp + 1
+                        c = c + 1
+
+# Potential of body i against the octree, opening cells as octree_force_on_body does
+def octree_potential_on_body(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace], i: In[int], potential: Out[float]):
+    stack: Array[int, 256]; sp: int = 0; node: int = 0; b: int = 0; c: int = 0
+    dx: float = 0.0; dy: float = 0.0; dz: float = 0.0; width: float = 0.0
+    cell: BodyState
+    potential = 0.0
+    stack[0] = 0; sp = 1
+    while (sp > 0, max_iter := 10000000):
+        sp = sp - 1
+        node = stack[sp]
+        if ws.nodes[node].mass > 0.0:
+            if ws.nodes[node].first_child < 0:
+                b = ws.nodes[node].first_body
+                while (b >= 0, max_iter := 100000):
+                    if b < i or b > i:
+                        potential = potential + pair_potential_energy(states[i], states[b], config)
+                    b = ws.body_next[b]
+            else:
+                dx = ws.nodes[node].com.x - states[i].pos.x; dy = ws.nodes[node].com.y - states[i].pos.y; dz = ws.nodes[node].com.z - states[i].pos.z
+                width = 2.0 * ws.nodes[node].half_size
+                if width * width < config.theta * config.theta * (dx*dx + dy*dy + dz*dz) and octree_contains(ws.nodes[node], states[i].pos) == 0:
+                    cell.pos.x = ws.nodes[node].com.x; cell.pos.y = ws.nodes[node].com.y; cell.pos.z = ws.nodes[node].com.z
+                    cell.mass = ws.nodes[node].mass
+                    potential = potential + pair_potential_energy(states[i], cell, config)
+                else:
+                    c = 0
+                    while (c < 8, max_iter := 8):
+                        stack[sp] = ws.nodes[node].first_child + c
+                        sp = sp + 1
+                        c = c + 1
+
+# --- Fast Multipole Method ---
+# Cartesian expansions on the Barnes-Hut octree, truncated at total order config.fmm_order:
+#   M_a = sum_j m_j (x_j - c)^a / a!                               (multipole about the cell's center of mass)
+#   L_b = sum_a (-1)^|a| M_a D^(a+b) g(z - c),  |a| + |b| <= order  (local about the target's center of mass)
+# with g the softened kernel 1/sqrt(r^2 + epsilon^2), so order 1 gives monopole forces.
+# Both are stored scaled by the cell's half size h, M_a / h^|a| and L_b * h^|b|, and the kernel is
+# evaluated on the unit separation, so nothing leaves single precision range at high order.
+# Coefficients are ordered by total degree, which lets every sum over |a| <= d run over a prefix.
+def fmm_num_coeffs(degree: In[int]) -> int:
+    return (degree + 1) * (degree + 2) * (degree + 3) / 6
+
+def fmm_index(coeff_index: In[Array[int]], order: In[int], a: In[int], b: In[int], c: In[int]) -> int:
+    return coeff_index[(a * (order + 1) + b) * (order + 1) + c]
+
+def fmm_init_tables(config: In[SimConfig], ws: Out[ForceWorkspace]):
+    p: int = config.fmm_order; n: int = 0; a: int = 0; b: int = 0; k: int = 0; q: int = 0; e: int = 0; count: int = 0; fact: Array[float, 32]
+    fact[0] = 1.0; q = 1
+    while (q <= p, max_iter := 31):
+        fact[q] = fact[q - 1] * q
+        q = q + 1
+    q = 0
+    while (q < (p + 1) * (p + 1) * (p + 1), max_iter := 100000):
+        ws.coeff_index[q] = -1
+        q = q + 1
+    while (n <= p, max_iter := 32):
+        a = n
+        while (a >= 0, max_iter := 32):
+            b = n - a
+            while (b >= 0, max_iter := 32):
+                ws.coeff_x[k] = a; ws.coeff_y[k] = b; ws.coeff_z[k] = n - a - b; ws.coeff_deg[k] = n
+                ws.coeff_index[(a * (p + 1) + b) * (p + 1) + n - a - b] = k
+                ws.inv_fact[k] = 1.0 / (fact[a] * fact[b] * fact[n - a - b])
+                k = k + 1
+                b = b - 1
+            a = a - 1
+        n = n + 1
+    ws.num_coeffs = k
+    k = 0
+    while (k < ws.num_coeffs, max_iter := 100000):
+        a = ws.coeff_x[k]; b = ws.coeff_y[k]; n = ws.coeff_z[k]
+        ws.coeff_sign[k] = 1.0
+        if ws.coeff_deg[k] - (ws.coeff_deg[k] / 2) * 2 == 1:
+            ws.coeff_sign[k] = -1.0
+        ws.rec_prev2[k] = 0; ws.rec_mul[k] = 0
+        if a > 0:
+            ws.rec_dir[k] = 0; ws.rec_prev[k] = fmm_index(ws.coeff_index, p, a - 1, b, n)
+            if a > 1:
+                ws.rec_prev2[k] = fmm_index(ws.coeff_index, p, a - 2, b, n); ws.rec_mul[k] = a - 1
+        elif b > 0:
+            ws.rec_dir[k] = 1; ws.rec_prev[k] = fmm_index(ws.coeff_index, p, a, b - 1, n)
+            if b > 1:
+                ws.rec_prev2[k] = fmm_index(ws.coeff_index, p, a, b - 2, n); ws.rec_mul[k] = b - 1
+        elif n > 0:
+            ws.rec_dir[k] = 2; ws.rec_prev[k] = fmm_index(ws.coeff_index, p, a, b, n - 1)
+            if n > 1:
+                ws.rec_prev2[k] = fmm_index(ws.coeff_index, p, a, b, n - 2); ws.rec_mul[k] = n - 1
+        ws.pair_start[k] = e
+        count = fmm_num_coeffs(p - ws.coeff_deg[k])
+        q = 0
+        while (q < count, max_iter := 100000):
+            ws.pair_other[e] = q
+            ws.pair_sum[e] = fmm_index(ws.coeff_index, p, a + ws.coeff_x[q], b + ws.coeff_y[q], n + ws.coeff_z[q])
+            e = e + 1
+            q = q + 1
+        k = k + 1
+    ws.pair_start[ws.num_coeffs] = e
+
+# mono[k] = d^a / a! for every coefficient a
+def fmm_monomials(d: In[Vec3], config: In[SimConfig], ws: Out[ForceWorkspace], mono: Out[Array[float]]):
+    k: int = 0; q: int = 1; px: Array[float, 32]; py: Array[float, 32]; pz: Array[float, 32]
+    px[0] = 1.0; py[0] = 1.0; pz[0] = 1.0
+    while (q <= config.fmm_order, max_iter := 32):
+        px[q] = px[q - 1] * d.x; py[q] = py[q - 1] * d.y; pz[q] = pz[q - 1] * d.z
+        q = q + 1
+    while (k < ws.num_coeffs, max_iter := 100000):
+        mono[k] = px[ws.coeff_x[k]] * py[ws.coeff_y[k]] * pz[ws.coeff_z[k]] * ws.inv_fact[k]
+        k = k + 1
+
+# powers[n] = x^n for n <= order
+def fmm_scale_powers(x: In[float], order: In[int], powers: Out[Array[float]]):
+    n: int = 1
+    powers[0] = 1.0
+    while (n <= order, max_iter := 32):
+        powers[n] = powers[n - 1] * x
+        n = n + 1
+
+# D^a g(u) for |a| <= order into ws.kernel[0..num_coeffs), with u a unit vector and g softened by eps_sq,
+# via the Hermite recurrence
+#   R^(n)_0 = (-1)^n (2n-1)!! s^-(2n+1)/2,   R^(n)_(a+e_x) = a_x R^(n+1)_(a-e_x) + u_x R^(n+1)_a
+# where s = 1 + eps_sq, and D^a g = R^(0)_a.
+def fmm_kernel(u: In[Vec3], eps_sq: In[float], config: In[SimConfig], ws: Out[ForceWorkspace]):
+    p: int = config.fmm_order; K: int = ws.num_coeffs; n: int = 0; k: int = 0; count: int = 0
+    base: int = 0; up: int = 0; uv: Array[float, 3]
+    inv_s: float = 1.0 / (u.x*u.x + u.y*u.y + u.z*u.z + eps_sq)
+    uv[0] = u.x; uv[1] = u.y; uv[2] = u.z
+    ws.kernel[0] = sqrt(inv_s)
+    n = 1
+    while (n <= p, max_iter := 32):
+        ws.kernel[n * K] = (1 - 2 * n) * ws.kernel[(n - 1) * K] * inv_s
+        n = n + 1
+    n = p - 1
+    while (n >= 0, max_iter := 32):
+        base = n * K; up = (n + 1) * K
+        count = fmm_num_coeffs(p - n)
+        k = 1
+        while (k < count, max_iter := 100000):
+            ws.kernel[base + k] = uv[ws.rec_dir[k]] * ws.kernel[up + ws.rec_prev[k]] + ws.rec_mul[k] * ws.kernel[up + ws.rec_prev2[k]]
+            k = k + 1
+        n = n - 1
+
+# P2M at the leaves and M2M into every parent. Children always come after their
+# parent in the node pool, so a reverse sweep is a bottom-up pass.
+def fmm_upward(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace]):
+    K: int = ws.num_coeffs; n: int = 0; k: int = 0; q: int = 0; c: int = 0; child: int = 0; b: int = 0
+    base: int = 0; cbase: int = 0; e: int = 0; kk: int = 0; mq: float = 0.0; inv_h: float = 0.0
+    d: Vec3; mono: Array[float, 1024]; ratio: Array[float, 32]
+    # Every child is half the size of its parent
+    fmm_scale_powers(0.5, config.fmm_order, ratio)
+    n = ws.num_nodes - 1
+    while (n >= 0, max_iter := 10000000):
+        base = n * K
+        inv_h = 1.0 / ws.nodes[n].half_size
+        k = 0
+        while (k < K, max_iter := 100000):
+            ws.multipoles[base + k] = 0.0
+            k = k + 1
+        if ws.nodes[n].mass > 0.0:
+            if ws.nodes[n].first_child >= 0:
+                c = 0
+                while (c < 8, max_iter := 8):
+                    child = ws.nodes[n].first_child + c
+                    if ws.nodes[child].mass > 0.0:
+                        d.x = (ws.nodes[child].com.x - ws.nodes[n].com.x) * inv_h; d.y = (ws.nodes[child].com.y - ws.nodes[n].com.y) * inv_h; d.z = (ws.nodes[child].com.z - ws.nodes[n].com.z) * inv_h
+                        fmm_monomials(d, config, ws, mono)
+                        cbase = child * K
+                        # M_(g+h) += M_g(child) d^h / h!
+                        q = 0
+                        while (q < K, max_iter := 100000):
+                            mq = ws.multipoles[cbase + q] * ratio[ws.coeff_deg[q]]
+                            e = ws.pair_start[q]
+                            while (e < ws.pair_start[q + 1], max_iter := 1000000):
+                                kk = base + ws.pair_sum[e]
+                                ws.multipoles[kk] = ws.multipoles[kk] + mq * mono[ws.pair_other[e]]
+                                e = e + 1
+                            q = q + 1
+                    c = c + 1
+            else:
+                b = ws.nodes[n].first_body
+                while (b >= 0, max_iter := 100000):
+                    d.x = (states[b].pos.x - ws.nodes[n].com.x) * inv_h; d.y = (states[b].pos.y - ws.nodes[n].com.y) * inv_h; d.z = (states[b].pos.z - ws.nodes[n].com.z) * inv_h
+                    fmm_monomials(d, config, ws, mono)
+                    k = 0
+                    while (k < K, max_iter := 100000):
+                        ws.multipoles[base + k] = ws.multipoles[base + k] + states[b].mass * mono[k]
+                        k = k + 1
+                    b = ws.body_next[b]
+        n = n - 1
+
+# M2L in both directions for a well-separated pair of cells. With everything scaled by the
+# distance R, L_b(a) h_a^|b| = (1/R) sum_a (h_a/R)^|b| (h_b/R)^|a| (-1)^|a| M_a(b) / h_b^|a| D^(a+b) g(u)
+def fmm_m2l(config: In[SimConfig], ws: Out[ForceWorkspace], a: In[int], b: In[int]):
+    K: int = ws.num_coeffs; ka: int = 0; kb: int = 0; e: int = 0; end: int = 0
+    abase: int = a * K; bbase: int = b * K
+    acc_a: float = 0.0; acc_b: float = 0.0; D: float = 0.0; dist: float = 0.0; inv_dist: float = 0.0; u: Vec3
+    scale_a: Array[float, 32]; scale_b: Array[float, 32]
+    u.x = ws.nodes[a].com.x - ws.nodes[b].com.x; u.y = ws.nodes[a].com.y - ws.nodes[b].com.y; u.z = ws.nodes[a].com.z - ws.nodes[b].com.z
+    dist = sqrt(u.x*u.x + u.y*u.y + u.z*u.z); inv_dist = 1.0 / dist
+    u.x = u.x * inv_dist; u.y = u.y * inv_dist; u.z = u.z * inv_dist
+    fmm_kernel(u, config.epsilon_sq * inv_dist * inv_dist, config, ws)
+    fmm_scale_powers(ws.nodes[a].half_size * inv_dist, config.fmm_order, scale_a)
+    fmm_scale_powers(ws.nodes[b].half_size * inv_dist, config.fmm_order, scale_b)
+    # Scaled source moments, with the (-1)^|a| for the a <- b direction folded in
+    ka = 0
+    while (ka < K, max_iter := 100000):
+        ws.m2l_sources[ka] = ws.coeff_sign[ka] * ws.multipoles[bbase + ka] * scale_b[ws.coeff_deg[ka]]
+        ws.m2l_sources[K + ka] = ws.multipoles[abase + ka] * scale_a[ws.coeff_deg[ka]]
+        ka = ka + 1
+    kb = 0
+    while (kb < K, max_iter := 100000):
+        acc_a = 0.0; acc_b = 0.0
+        e = ws.pair_start[kb]; end = ws.pair_start[kb + 1]
+        while (e < end, max_iter := 1000000):
+            ka = ws.pair_other[e]
+            D = ws.kernel[ws.pair_sum[e]]
+            acc_a = acc_a + ws.m2l_sources[ka] * D
+            acc_b = acc_b + ws.m2l_sources[K + ka] * D
+            e = e + 1
+        # D^n g(-u) = (-1)^|n| D^n g(u), so the reverse direction only flips signs
+        ws.locals[abase + kb] = ws.locals[abase + kb] + acc_a * scale_a[ws.coeff_deg[kb]] * inv_dist
+        ws.locals[bbase + kb] = ws.locals[bbase + kb] + ws.coeff_sign[kb] * acc_b * scale_b[ws.coeff_deg[kb]] * inv_dist
+        kb = kb + 1
+
+# Direct interactions between the bodies of two leaves, or within one leaf if a == b
+def fmm_p2p(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace], a: In[int], b: In[int]):
+    i: int = ws.nodes[a].first_body; j: int = 0; dV_dri: Vec3; dV_drj: Vec3
+    while (i >= 0, max_iter := 100000):
+        j = ws.nodes[b].first_body
+        if a == b:
+            j = ws.body_next[i]
+        while (j >= 0, max_iter := 100000):
+            pair_potential_gradient(states[i], states[j], config, dV_dri, dV_drj)
+            derivs[i].d_mom.x = derivs[i].d_mom.x - dV_dri.x; derivs[i].d_mom.y = derivs[i].d_mom.y - dV_dri.y; derivs[i].d_mom.z = derivs[i].d_mom.z - dV_dri.z
+            derivs[j].d_mom.x = derivs[j].d_mom.x - dV_drj.x; derivs[j].d_mom.y = derivs[j].d_mom.y - dV_drj.y; derivs[j].d_mom.z = derivs[j].d_mom.z - dV_drj.z
+            j = ws.body_next[j]
+        i = ws.body_next[i]
+
+# Dual tree walk: a pair of cells interacts through M2L once (r_a + r_b) < theta * distance,
+# otherwise the larger cell is opened. Leaf pairs that never separate are summed directly.
+def fmm_interact(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    stack_a: Array[int, 4096]; stack_b: Array[int, 4096]; sp: int = 0; a: int = 0; b: int = 0; c: int = 0; c2: int = 0
+    dx: float = 0.0; dy: float = 0.0; dz: float = 0.0; ra: float = 0.0; rb: float = 0.0
+    # Depth is capped at 20; a self pair pushes 36 pairs and a cross pair 8, which stays far below the stack size
+    stack_a[0] = 0; stack_b[0] = 0; sp = 1
+    while (sp > 0, max_iter := 100000000):
+        sp = sp - 1
+        a = stack_a[sp]; b = stack_b[sp]
+        if ws.nodes[a].mass > 0.0 and ws.nodes[b].mass > 0.0:
+            if a == b:
+                if ws.nodes[a].first_child < 0:
+                    fmm_p2p(states, config, derivs, ws, a, a)
+                else:
+                    c = 0
+                    while (c < 8, max_iter := 8):
+                        c2 = c
+                        while (c2 < 8, max_iter := 8):
+                            stack_a[sp] = ws.nodes[a].first_child + c; stack_b[sp] = ws.nodes[a].first_child + c2
+                            sp = sp + 1
+                            c2 = c2 + 1
+                        c = c + 1
+            else:
+                dx = ws.nodes[a].com.x - ws.nodes[b].com.x; dy = ws.nodes[a].com.y - ws.nodes[b].com.y; dz = ws.nodes[a].com.z - ws.nodes[b].com.z
+                ra = ws.nodes[a].radius; rb = ws.nodes[b].radius
+                if (ra + rb) * (ra + rb) < config.theta * config.theta * (dx*dx + dy*dy + dz*dz):
+                    fmm_m2l(config, ws, a, b)
+                elif ws.nodes[a].first_child < 0 and ws.nodes[b].first_child < 0:
+                    fmm_p2p(states, config, derivs, ws, a, b)
+                else:
+                    # Open the larger cell, or whichever one is not a leaf
+                    if ws.nodes[b].first_child < 0 or (ws.nodes[a].first_child >= 0 and ra >= rb):
+                        c = 0
+                        while (c < 8, max_iter := 8):
+                            stack_a[sp] = ws.nodes[a].first_child + c; stack_b[sp] = b
+                            sp = sp + 1
+                            c = c + 1
+                    else:
+                        c = 0
+                        while (c < 8, max_iter := 8):
+                            stack_a[sp] = a; stack_b[sp] = ws.nodes[b].first_child + c
+                            sp = sp + 1
+                            c = c + 1
+
+# L2L into every child and L2P at the leaves, top-down
+def fmm_downward(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    p: int = config.fmm_order; K: int = ws.num_coeffs; n: int = 0; k: int = 0; q: int = 0; c: int = 0; child: int = 0; b: int = 0
+    base: int = 0; cbase: int = 0; count: int = 0; e: int = 0; gx: int = 0; gy: int = 0; gz: int = 0
+    acc: float = 0.0; gmx: float = 0.0; gmy: float = 0.0; gmz: float = 0.0; inv_h: float = 0.0
+    d: Vec3; mono: Array[float, 1024]; ratio: Array[float, 32]
+    fmm_scale_powers(0.5, config.fmm_order, ratio)
+    while (n < ws.num_nodes, max_iter := 10000000):
+        base = n * K
+        inv_h = 1.0 / ws.nodes[n].half_size
+        if ws.nodes[n].mass > 0.0:
+            if ws.nodes[n].first_child >= 0:
+                c = 0
+                while (c < 8, max_iter := 8):
+                    child = ws.nodes[n].first_child + c
+                    if ws.nodes[child].mass > 0.0:
+                        d.x = (ws.nodes[child].com.x - ws.nodes[n].com.x) * inv_h; d.y = (ws.nodes[child].com.y - ws.nodes[n].com.y) * inv_h; d.z = (ws.nodes[child].com.z - ws.nodes[n].com.z) * inv_h
+                        fmm_monomials(d, config, ws, mono)
+                        cbase = child * K
+                        # L_b(child) += sum_g L_(b+g) d^g / g!
+                        k = 0
+                        while (k < K, max_iter := 100000):
+                            acc = 0.0
+                            e = ws.pair_start[k]
+                            while (e < ws.pair_start[k + 1], max_iter := 1000000):
+                                acc = acc + ws.locals[base + ws.pair_sum[e]] * mono[ws.pair_other[e]]
+                                e = e + 1
+                            ws.locals[cbase + k] = ws.locals[cbase + k] + acc * ratio[ws.coeff_deg[k]]
+                            k = k + 1
+                    c = c + 1
+            else:
+                # Force on a body is G m_i grad(sum_b y^b / b! L_b) at y = x_i - z
+                count = fmm_num_coeffs(p - 1)
+                b = ws.nodes[n].first_body
+                while (b >= 0, max_iter := 100000):
+                    d.x = (states[b].pos.x - ws.nodes[n].com.x) * inv_h; d.y = (states[b].pos.y - ws.nodes[n].com.y) * inv_h; d.z = (states[b].pos.z - ws.nodes[n].com.z) * inv_h
+                    fmm_monomials(d, config, ws, mono)
+                    gmx = 0.0; gmy = 0.0; gmz = 0.0
+                    q = 0
+                    while (q < count, max_iter := 100000):
+                        gx = ws.coeff_x[q]; gy = ws.coeff_y[q]; gz = ws.coeff_z[q]
+                        gmx = gmx + mono[q] * ws.locals[base + fmm_index(ws.coeff_index, p, gx + 1, gy, gz)]
+                        gmy = gmy + mono[q] * ws.locals[base + fmm_index(ws.coeff_index, p, gx, gy + 1, gz)]
+                        gmz = gmz + mono[q] * ws.locals[base + fmm_index(ws.coeff_index, p, gx, gy, gz + 1)]
+                        q = q + 1
+                    derivs[b].d_mom.x = derivs[b].d_mom.x + config.G * states[b].mass * gmx * inv_h
+                    derivs[b].d_mom.y = derivs[b].d_mom.y + config.G * states[b].mass * gmy * inv_h
+                    derivs[b].d_mom.z = derivs[b].d_mom.z + config.G * states[b].mass * gmz * inv_h
+                    b = ws.body_next[b]
+        n = n + 1
+
+def fmm_forces(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    k: int = 0; force: Vec3
+    while (k < config.num_bodies, max_iter := 100000):
+        derivs[k].d_mom.x = 0.0; derivs[k].d_mom.y = 0.0; derivs[k].d_mom.z = 0.0
+        k = k + 1
+    fmm_init_tables(config, ws)
+    build_octree(states, config, ws)
+    fmm_upward(states, config, ws)
+    k = 0
+    while (k < ws.num_nodes * ws.num_coeffs, max_iter := 100000000):
+        ws.locals[k] = 0.0
+        k = k + 1
+    fmm_interact(states, config, derivs, ws)
+    fmm_downward(states, config, derivs, ws)
+    # Test particles are not in the tree, so they take the Barnes-Hut walk instead of the expansions
+    k = 0
+    while (k < ws.num_tests, max_iter := 100000):
+        octree_force_on_body(states, config, ws, ws.tests[k], force)
+        derivs[ws.tests[k]].d_mom.x = force.x; derivs[ws.tests[k]].d_mom.y = force.y; derivs[ws.tests[k]].d_mom.z = force.z
+        k = k + 1
+
+# --- Structure of Arrays ---
+# Copies positions and masses into contiguous arrays, massive bodies first and then test particles
+# in the order partition_test_particles lists them, and clears the accelerations
+def gather_soa(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace]):
+    k: int = 0; b: int = 0
+    partition_test_particles(states, config, ws)
+    while (k < ws.num_massive + ws.num_tests, max_iter := 100000):
+        if k < ws.num_massive:
+            b = ws.massive[k]
+        else:
+            b = ws.tests[k - ws.num_massive]
+        ws.soa_x[k] = states[b].pos.x; ws.soa_y[k] = states[b].pos.y; ws.soa_z[k] = states[b].pos.z
+        ws.soa_mass[k] = states[b].mass
+        ws.soa_ax[k] = 0.0; ws.soa_ay[k] = 0.0; ws.soa_az[k] = 0.0
+        k = k + 1
+
+# Adds the pull of a body of mass gm / G at (sx, sy, sz) to the accelerations of bodies [start, end).
+# Every iteration touches only body t through plain array arguments, so the C compiler vectorizes the loop.
+def soa_pull(x: In[Array[float]], y: In[Array[float]], z: In[Array[float]], ax: Out[Array[float]], ay: Out[Array[float]], az: Out[Array[float]],
+             sx: In[float], sy: In[float], sz: In[float], gm: In[float], eps_sq: In[float], start: In[int], end: In[int]):
+    t: int = start; dx: float; dy: float; dz: float; inv_dist: float; w: float
+    while (t < end, max_iter := 100000):
+        dx = sx - x[t]; dy = sy - y[t]; dz = sz - z[t]
+        inv_dist = 1.0 / sqrt(dx*dx + dy*dy + dz*dz + eps_sq)
+        w = gm * inv_dist * inv_dist * inv_dist
+        ax[t] = ax[t] + w * dx; ay[t] = ay[t] + w * dy; az[t] = az[t] + w * dz
+        t = t + 1
+
+# The direct sum over the SoA copy: each massive body pulls on every other live body.
+# This is the full N_massive * N ordered pairs rather than half of them, traded for loops without
+# a reduction, and the forces are the closed-form gradient rather than autodiff of pair_potential_energy.
+def soa_direct_forces(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    s: int = 0; k: int = 0; b: int = 0; n: int = 0; gm: float
+    gather_soa(states, config, ws)
+    n = ws.num_massive + ws.num_tests
+    while (s < ws.num_massive, max_iter := 100000):
+        gm = config.G * ws.soa_mass[s]
+        soa_pull(ws.soa_x, ws.soa_y, ws.soa_z, ws.soa_ax, ws.soa_ay, ws.soa_az, ws.soa_x[s], ws.soa_y[s], ws.soa_z[s], gm, config.epsilon_sq, 0, s)
+        soa_pull(ws.soa_x, ws.soa_y, ws.soa_z, ws.soa_ax, ws.soa_ay, ws.soa_az, ws.soa_x[s], ws.soa_y[s], ws.soa_z[s], gm, config.epsilon_sq, s + 1, n)
+        s = s + 1
+    while (k < n, max_iter := 100000):
+        if k < ws.num_massive:
+            b = ws.massive[k]
+        else:
+            b = ws.tests[k - ws.num_massive]
+        derivs[b].d_mom.x = ws.soa_mass[k] * ws.soa_ax[k]; derivs[b].d_mom.y = ws.soa_mass[k] * ws.soa_ay[k]; derivs[b].d_mom.z = ws.soa_mass[k] * ws.soa_az[k]
+        k = k + 1
+
+# d_mom = -dH/dr for every body, accumulated pair by pair,
+# or against a Barnes-Hut octree / FMM expansions rebuilt from the current positions.
+# Test particles only take the pull of the massive bodies, so the direct sum costs
+# O(N_massive^2 + N_massive * N_test) pair terms.
+def get_forces(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    i: int = 0; j: int = 0; t: int = 0; dV_dri: Vec3; dV_drj: Vec3; force: Vec3
+    if config.force_method == 2:
+        fmm_forces(states, config, derivs, ws)
+    elif config.force_method == 1:
+        build_octree(states, config, ws)
+        while (i < config.num_bodies, max_iter := 100000):
+            octree_force_on_body(states, config, ws, i, force)
+            derivs[i].d_mom.x = force.x; derivs[i].d_mom.y = force.y; derivs[i].d_mom.z = force.z
+            i = i + 1
+    else:
+        while (i < config.num_bodies, max_iter := 100000):
+            derivs[i].d_mom.x = 0.0; derivs[i].d_mom.y = 0.0; derivs[i].d_mom.z = 0.0
+            i = i + 1
+        if config.layout == 1:
+            soa_direct_forces(states, config, derivs, ws)
+        else:
+            partition_test_particles(states, config, ws)
+            i = 0
+            while (i < ws.num_massive, max_iter := 100000):
+                j = i + 1
+                while (j < ws.num_massive, max_iter := 100000):
+                    pair_potential_gradient(states[ws.massive[i]], states[ws.massive[j]], config, dV_dri, dV_drj)
+                    derivs[ws.massive[i]].d_mom.x = derivs[ws.massive[i]].d_mom.x - dV_dri.x; derivs[ws.massive[i]].d_mom.y = derivs[ws.massive[i]].d_mom.y - dV_dri.y; derivs[ws.massive[i]].d_mom.z = derivs[ws.massive[i]].d_mom.z - dV_dri.z
+                    derivs[ws.massive[j]].d_mom.x = derivs[ws.massive[j]].d_mom.x - dV_drj.x; derivs[ws.massive[j]].d_mom.y = derivs[ws.massive[j]].d_mom.y - dV_drj.y; derivs[ws.massive[j]].d_mom.z = derivs[ws.massive[j]].d_mom.z - dV_drj.z
+                    j = j + 1
+                i = i + 1
+            t = 0
+            while (t < ws.num_tests, max_iter := 100000):
+                j = 0
+                while (j < ws.num_massive, max_iter := 100000):
+                    pair_potential_gradient(states[ws.tests[t]], states[ws.massive[j]], config, dV_dri, dV_drj)
+                    derivs[ws.tests[t]].d_mom.x = derivs[ws.tests[t]].d_mom.x - dV_dri.x; derivs[ws.tests[t]].d_mom.y = derivs[ws.tests[t]].d_mom.y - dV_dri.y; derivs[ws.tests[t]].d_mom.z = derivs[ws.tests[t]].d_mom.z - dV_dri.z
+                    j = j + 1
+                t = t + 1
+
+# Hamilton's equations for every body: d_pos = dH/dp, d_mom = -dH/dr
+def get_derivatives(states: In[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    get_velocities(states, config, derivs)
+    get_forces(states, config, derivs, ws)
+
 # Symplectic Euler Integrator
-def time_step_system(current_states: In[Array[BodyState, 20]], config: In[SimConfig], next_states: Out[Array[BodyState, 20]]): 
-    k: int = 0; dH_dr_kx: float; dH_dr_ky: float; dH_dr_kz: float; dH_dp_kx: float; dH_dp_ky: float; dH_dp_kz: float 
+def time_step_system(current_states: In[Array[BodyState]], config: In[SimConfig], next_states: Out[Array[BodyState]],
+                     derivs: Out[Array[BodyDerivative]],
+                     ws: Out[ForceWorkspace]): 
+    k: int = 0
+    get_forces(current_states, config, derivs, ws)
     k = 0
-    while(k < config.num_bodies, max_iter := 20): 
-        dH_dr_kx = get_dH_dr_k_alpha(current_states, config, k, 0); dH_dr_ky = get_dH_dr_k_alpha(current_states, config, k, 1); dH_dr_kz = get_dH_dr_k_alpha(current_states, config, k, 2)
-        next_states[k].mom.x = current_states[k].mom.x - config.dt * dH_dr_kx; next_states[k].mom.y = current_states[k].mom.y - config.dt * dH_dr_ky; next_states[k].mom.z = current_states[k].mom.z - config.dt * dH_dr_kz
+    while(k < config.num_bodies, max_iter := 100000): 
+        next_states[k].mom.x = current_states[k].mom.x + config.dt * derivs[k].d_mom.x; next_states[k].mom.y = current_states[k].mom.y + config.dt * derivs[k].d_mom.y; next_states[k].mom.z = current_states[k].mom.z + config.dt * derivs[k].d_mom.z
         next_states[k].pos.x = current_states[k].pos.x; next_states[k].pos.y = current_states[k].pos.y; next_states[k].pos.z = current_states[k].pos.z
-        next_states[k].mass = current_states[k].mass; next_states[k].inv_mass = current_states[k].inv_mass
+        next_states[k].mass = current_states[k].mass; next_states[k].inv_mass = current_states[k].inv_mass; next_states[k].radius = current_states[k].radius
         k = k + 1
+    get_velocities(next_states, config, derivs)
     k = 0
-    while(k < config.num_bodies, max_iter := 20): 
-        dH_dp_kx = get_dH_dp_k_alpha(next_states, config, k, 0); dH_dp_ky = get_dH_dp_k_alpha(next_states, config, k, 1); dH_dp_kz = get_dH_dp_k_alpha(next_states, config, k, 2)
-        next_states[k].pos.x = next_states[k].pos.x + config.dt * dH_dp_kx; next_states[k].pos.y = next_states[k].pos.y + config.dt * dH_dp_ky; next_states[k].pos.z = next_states[k].pos.z + config.dt * dH_dp_kz
+    while(k < config.num_bodies, max_iter := 100000): 
+        next_states[k].pos.x = next_states[k].pos.x + config.dt * derivs[k].d_pos.x; next_states[k].pos.y = next_states[k].pos.y + config.dt * derivs[k].d_pos.y; next_states[k].pos.z = next_states[k].pos.z + config.dt * derivs[k].d_pos.z
         k = k + 1
 
 # --- RK4 Integrator ---
-def time_step_system_rk4(current_states: In[Array[BodyState, 20]], 
+def time_step_system_rk4(current_states: In[Array[BodyState]], 
                          config: In[SimConfig], 
-                         next_states: Out[Array[BodyState, 20]],
+                         next_states: Out[Array[BodyState]],
                          # Scratch space arrays passed in to avoid compiler bug
-                         k1: Out[Array[BodyDerivative, 20]], 
-                         k2: Out[Array[BodyDerivative, 20]], 
-                         k3: Out[Array[BodyDerivative, 20]], 
-                         k4: Out[Array[BodyDerivative, 20]],
-                         intermediate_states: Out[Array[BodyState, 20]]):
+                         k1: Out[Array[BodyDerivative]], 
+                         k2: Out[Array[BodyDerivative]], 
+                         k3: Out[Array[BodyDerivative]], 
+                         k4: Out[Array[BodyDerivative]],
+                         intermediate_states: Out[Array[BodyState]],
+                         ws: Out[ForceWorkspace]):
     k: int = 0; dt: float = config.dt; dt_half: float = dt * 0.5; dt_sixth: float = dt / 6.0
 
     # k1 = f(y_n)
-    k = 0
-    while (k < config.num_bodies, max_iter := 20):
-        k1[k].d_pos.x = get_dH_dp_k_alpha(current_states, config, k, 0); k1[k].d_pos.y = get_dH_dp_k_alpha(current_states, config, k, 1); k1[k].d_pos.z = get_dH_dp_k_alpha(current_states, config, k, 2)
-        k1[k].d_mom.x = -get_dH_dr_k_alpha(current_states, config, k, 0); k1[k].d_mom.y = -get_dH_dr_k_alpha(current_states, config, k, 1); k1[k].d_mom.z = -get_dH_dr_k_alpha(current_states, config, k, 2)
-        k = k + 1
+    get_derivatives(current_states, config, k1, ws)
     
     # k2 = f(y_n + dt*k1/2)
     k = 0
-    while (k < config.num_bodies, max_iter := 20):
+    while (k < config.num_bodies, max_iter := 100000):
         intermediate_states[k].pos.x = current_states[k].pos.x + k1[k].d_pos.x * dt_half; intermediate_states[k].pos.y = current_states[k].pos.y + k1[k].d_pos.y * dt_half; intermediate_states[k].pos.z = current_states[k].pos.z + k1[k].d_pos.z * dt_half
         intermediate_states[k].mom.x = current_states[k].mom.x + k1[k].d_mom.x * dt_half; intermediate_states[k].mom.y = current_states[k].mom.y + k1[k].d_mom.y * dt_half; intermediate_states[k].mom.z = current_states[k].mom.z + k1[k].d_mom.z * dt_half
-        intermediate_states[k].mass = current_states[k].mass; intermediate_states[k].inv_mass = current_states[k].inv_mass
-        k = k + 1
-    k = 0
-    while (k < config.num_bodies, max_iter := 20):
-        k2[k].d_pos.x = get_dH_dp_k_alpha(intermediate_states, config, k, 0); k2[k].d_pos.y = get_dH_dp_k_alpha(intermediate_states, config, k, 1); k2[k].d_pos.z = get_dH_dp_k_alpha(intermediate_states, config, k, 2)
-        k2[k].d_mom.x = -get_dH_dr_k_alpha(intermediate_states, config, k, 0); k2[k].d_mom.y = -get_dH_dr_k_alpha(intermediate_states, config, k, 1); k2[k].d_mom.z = -get_dH_dr_k_alpha(intermediate_states, config, k, 2)
+        intermediate_states[k].mass = current_states[k].mass; intermediate_states[k].inv_mass = current_states[k].inv_mass; intermediate_states[k].radius = current_states[k].radius
         k = k + 1
+    get_derivatives(intermediate_states, config, k2, ws)
 
     # k3 = f(y_n + dt*k2/2)
     k = 0
-    while (k < config.num_bodies, max_iter := 20):
+    while (k < config.num_bodies, max_iter := 100000):
         intermediate_states[k].pos.x = current_states[k].pos.x + k2[k].d_pos.x * dt_half; intermediate_states[k].pos.y = current_states[k].pos.y + k2[k].d_pos.y * dt_half; intermediate_states[k].pos.z = current_states[k].pos.z + k2[k].d_pos.z * dt_half
         intermediate_states[k].mom.x = current_states[k].mom.x + k2[k].d_mom.x * dt_half; intermediate_states[k].mom.y = current_states[k].mom.y + k2[k].d_mom.y * dt_half; intermediate_states[k].mom.z = current_states[k].mom.z + k2[k].d_mom.z * dt_half
         k = k + 1
-    k = 0
-    while (k < config.num_bodies, max_iter := 20):
-        k3[k].d_pos.x = get_dH_dp_k_alpha(intermediate_states, config, k, 0); k3[k].d_pos.y = get_dH_dp_k_alpha(intermediate_states, config, k, 1); k3[k].d_pos.z = get_dH_dp_k_alpha(intermediate_states, config, k, 2)
-        k3[k].d_mom.x = -get_dH_dr_k_alpha(intermediate_states, config, k, 0); k3[k].d_mom.y = -get_dH_dr_k_alpha(intermediate_states, config, k, 1); k3[k].d_mom.z = -get_dH_dr_k_alpha(intermediate_states, config, k, 2)
-        k = k + 1
+    get_derivatives(intermediate_states, config, k3, ws)
     
     # k4 = f(y_n + dt*k3)
     k = 0
-    while (k < config.num_bodies, max_iter := 20):
+    while (k < config.num_bodies, max_iter := 100000):
         intermediate_states[k].pos.x = current_states[k].pos.x + k3[k].d_pos.x * dt; intermediate_states[k].pos.y = current_states[k].pos.y + k3[k].d_pos.y * dt; intermediate_states[k].pos.z = current_states[k].pos.z + k3[k].d_pos.z * dt
         intermediate_states[k].mom.x = current_states[k].mom.x + k3[k].d_mom.x * dt; intermediate_states[k].mom.y = current_states[k].mom.y + k3[k].d_mom.y * dt; intermediate_states[k].mom.z = current_states[k].mom.z + k3[k].d_mom.z * dt
         k = k + 1
-    k = 0
-    while (k < config.num_bodies, max_iter := 20):
-        k4[k].d_pos.x = get_dH_dp_k_alpha(intermediate_states, config, k, 0); k4[k].d_pos.y = get_dH_dp_k_alpha(intermediate_states, config, k, 1); k4[k].d_pos.z = get_dH_dp_k_alpha(intermediate_states, config, k, 2)
-        k4[k].d_mom.x = -get_dH_dr_k_alpha(intermediate_states, config, k, 0); k4[k].d_mom.y = -get_dH_dr_k_alpha(intermediate_states, config, k, 1); k4[k].d_mom.z = -get_dH_dr_k_alpha(intermediate_states, config, k, 2)
-        k = k + 1
+    get_derivatives(intermediate_states, config, k4, ws)
 
     # y_{n+1} = y_n + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
     k = 0
-    while (k < config.num_bodies, max_iter := 20):
+    while (k < config.num_bodies, max_iter := 100000):
         next_states[k].pos.x = current_states[k].pos.x + (k1[k].d_pos.x + 2.0*k2[k].d_pos.x + 2.0*k3[k].d_pos.x + k4[k].d_pos.x) * dt_sixth
         next_states[k].pos.y = current_states[k].pos.y + (k1[k].d_pos.y + 2.0*k2[k].d_pos.y + 2.0*k3[k].d_pos.y + k4[k].d_pos.y) * dt_sixth
         next_states[k].pos.z = current_states[k].pos.z + (k1[k].d_pos.z + 2.0*k2[k].d_pos.z + 2.0*k3[k].d_pos.z + k4[k].d_pos.z) * dt_sixth
         next_states[k].mom.x = current_states[k].mom.x + (k1[k].d_mom.x + 2.0*k2[k].d_mom.x + 2.0*k3[k].d_mom.x + k4[k].d_mom.x) * dt_sixth
         next_states[k].mom.y = current_states[k].mom.y + (k1[k].d_mom.y + 2.0*k2[k].d_mom.y + 2.0*k3[k].d_mom.y + k4[k].d_mom.y) * dt_sixth
         next_states[k].mom.z = current_states[k].mom.z + (k1[k].d_mom.z + 2.0*k2[k].d_mom.z + 2.0*k3[k].d_mom.z + k4[k].d_mom.z) * dt_sixth
-        next_states[k].mass = current_states[k].mass; next_states[k].inv_mass = current_states[k].inv_mass
-        k = k + 1
\ No newline at end of file
+        next_states[k].mass = current_states[k].mass; next_states[k].inv_mass = current_states[k].inv_mass; next_states[k].radius = current_states[k].radius
+        k = k + 1
+
+# --- Symplectic Compositions ---
+def copy_states(src: In[Array[BodyState]], config: In[SimConfig], dst: Out[Array[BodyState]]):
+    k: int = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        dst[k].pos.x = src[k].pos.x; dst[k].pos.y = src[k].pos.y; dst[k].pos.z = src[k].pos.z
+        dst[k].mom.x = src[k].mom.x; dst[k].mom.y = src[k].mom.y; dst[k].mom.z = src[k].mom.z
+        dst[k].mass = src[k].mass; dst[k].inv_mass = src[k].inv_mass; dst[k].radius = src[k].radius
+        k = k + 1
+
+def copy_derivs(src: In[Array[BodyDerivative]], config: In[SimConfig], dst: Out[Array[BodyDerivative]]):
+    k: int = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        dst[k].d_pos.x = src[k].d_pos.x; dst[k].d_pos.y = src[k].d_pos.y; dst[k].d_pos.z = src[k].d_pos.z
+        dst[k].d_mom.x = src[k].d_mom.x; dst[k].d_mom.y = src[k].d_mom.y; dst[k].d_mom.z = src[k].d_mom.z
+        k = k + 1
+
+# Drift: pos += h * dH/dp, in place
+def drift_states(states: Out[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], h: In[float]):
+    k: int = 0
+    get_velocities(states, config, derivs)
+    while (k < config.num_bodies, max_iter := 100000):
+        states[k].pos.x = states[k].pos.x + h * derivs[k].d_pos.x; states[k].pos.y = states[k].pos.y + h * derivs[k].d_pos.y; states[k].pos.z = states[k].pos.z + h * derivs[k].d_pos.z
+        k = k + 1
+
+# Kick: mom += h * d_mom, with the forces already in derivs
+def kick_states(states: Out[Array[BodyState]], config: In[SimConfig], derivs: In[Array[BodyDerivative]], h: In[float]):
+    k: int = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        states[k].mom.x = states[k].mom.x + h * derivs[k].d_mom.x; states[k].mom.y = states[k].mom.y + h * derivs[k].d_mom.y; states[k].mom.z = states[k].mom.z + h * derivs[k].d_mom.z
+        k = k + 1
+
+# One kick-drift-kick leapfrog step of size h, in place. derivs must hold the forces at
+# states on entry and holds the forces at the new states on return (first same as last),
+# so a run of steps costs one force evaluation each.
+def leapfrog_substep(states: Out[Array[BodyState]], config: In[SimConfig], derivs: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace], h: In[float]):
+    kick_states(states, config, derivs, 0.5 * h)
+    drift_states(states, config, derivs, h)
+    get_forces(states, config, derivs, ws)
+    kick_states(states, config, derivs, 0.5 * h)
+
+# Leapfrog (2nd order), or Yoshida's 4th order triple jump of three leapfrog steps
+# with weights w1, w0, w1, where w1 = 1 / (2 - 2^(1/3)) and w0 = 1 - 2 * w1.
+# Same FSAL contract on derivs as leapfrog_substep.
+def time_step_system_kdk(current_states: In[Array[BodyState]], config: In[SimConfig], next_states: Out[Array[BodyState]],
+                         derivs: Out[Array[BodyDerivative]],
+                         ws: Out[ForceWorkspace]):
+    w1: float = 0.0; w0: float = 0.0
+    copy_states(current_states, config, next_states)
+    if config.integrator == 3:
+        w1 = 1.0 / (2.0 - pow(2.0, 1.0 / 3.0)); w0 = 1.0 - 2.0 * w1
+        leapfrog_substep(next_states, config, derivs, ws, w1 * config.dt)
+        leapfrog_substep(next_states, config, derivs, ws, w0 * config.dt)
+        leapfrog_substep(next_states, config, derivs, ws, w1 * config.dt)
+    else:
+        leapfrog_substep(next_states, config, derivs, ws, config.dt)
+
+# Forest-Ruth (4th order) in its position-first form: four drifts around three force
+# evaluations, theta = 1 / (2 - 2^(1/3)). The forces are taken mid-step, so derivs needs
+# no valid forces on entry.
+def time_step_system_forest_ruth(current_states: In[Array[BodyState]], config: In[SimConfig], next_states: Out[Array[BodyState]],
+                                 derivs: Out[Array[BodyDerivative]],
+                                 ws: Out[ForceWorkspace]):
+    fr_theta: float = 1.0 / (2.0 - pow(2.0, 1.0 / 3.0)); dt: float = config.dt
+    copy_states(current_states, config, next_states)
+    drift_states(next_states, config, derivs, 0.5 * fr_theta * dt)
+    get_forces(next_states, config, derivs, ws)
+    kick_states(next_states, config, derivs, fr_theta * dt)
+    drift_states(next_states, config, derivs, 0.5 * (1.0 - fr_theta) * dt)
+    get_forces(next_states, config, derivs, ws)
+    kick_states(next_states, config, derivs, (1.0 - 2.0 * fr_theta) * dt)
+    drift_states(next_states, config, derivs, 0.5 * (1.0 - fr_theta) * dt)
+    get_forces(next_states, config, derivs, ws)
+    kick_states(next_states, config, derivs, fr_theta * dt)
+    drift_states(next_states, config, derivs, 0.5 * fr_theta * dt)
+
+# --- Block Timesteps ---
+# Body i steps with dt / 2^level_i on a grid of 2^max_block_level ticks per dt. Every body drifts
+# every tick, but only the bodies whose step ends at a tick get new forces, each as its own
+# kick-drift-kick, so a step costs force evaluations in proportion to the fast bodies. All bodies
+# are in sync again at the end of every dt.
+
+# Force on body i alone; the tree methods walk an octree already built from states
+def body_force(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace], i: In[int], force: Out[Vec3]):
+    j: int = 0; dV_dri: Vec3; dV_drj: Vec3
+    if config.force_method >= 1:
+        octree_force_on_body(states, config, ws, i, force)
+    else:
+        force.x = 0.0; force.y = 0.0; force.z = 0.0
+        while (j < config.num_bodies, max_iter := 100000):
+            if (j < i or j > i) and (states[j].mass >= config.test_particle_mass and states[j].radius >= 0.0):
+                pair_potential_gradient(states[i], states[j], config, dV_dri, dV_drj)
+                force.x = force.x - dV_dri.x; force.y = force.y - dV_dri.y; force.z = force.z - dV_dri.z
+            j = j + 1
+
+# Smallest level whose step dt / 2^level is within block_eta * min_j sqrt(d^3 / (G m_j)), the
+# shortest timescale on which another body pulls body i (d the softened distance), capped at
+# max_block_level. A heavy body orbited by light ones is not held to their steps.
+def block_level(states: In[Array[BodyState]], config: In[SimConfig], i: In[int]) -> int:
+    j: int = 0; dx: float = 0.0; dy: float = 0.0; dz: float = 0.0; d: float = 0.0; t_sq: float = 0.0
+    min_t_sq: float = -1.0; level: int = 0; h: float = config.dt
+    while (j < config.num_bodies, max_iter := 100000):
+        if (j < i or j > i) and (states[j].mass > 0.0 and states[j].mass >= config.test_particle_mass):
+            dx = states[j].pos.x - states[i].pos.x; dy = states[j].pos.y - states[i].pos.y; dz = states[j].pos.z - states[i].pos.z
+            d = sqrt(dx*dx + dy*dy + dz*dz + config.epsilon_sq)
+            t_sq = d * d * d / (config.G * states[j].mass)
+            if min_t_sq < 0.0 or t_sq < min_t_sq:
+                min_t_sq = t_sq
+        j = j + 1
+    if min_t_sq >= 0.0:
+        while (h * h > config.block_eta * config.block_eta * min_t_sq and level < config.max_block_level, max_iter := 64):
+            h = h * 0.5; level = level + 1
+    return level
+
+# Ticks per step at a level
+def block_stride(config: In[SimConfig], level: In[int]) -> int:
+    stride: int = 1; l: int = level
+    while (l < config.max_block_level, max_iter := 64):
+        stride = stride * 2; l = l + 1
+    return stride
+
+# One dt of block timestep leapfrog. derivs[k].d_mom must hold the force on body k from the end
+# of its last step, which it holds again on return, and aws.levels the current levels. Between
+# two ticks at which some step ends, all bodies drift in one go. A body moves to a finer level
+# at the end of any of its steps, and to the next coarser one only when that level's step ends
+# at the same tick.
+def time_step_system_block(current_states: In[Array[BodyState]], config: In[SimConfig], next_states: Out[Array[BodyState]],
+                           derivs: Out[Array[BodyDerivative]],
+                           ws: Out[ForceWorkspace],
+                           aws: Out[AdaptiveWorkspace]):
+    n_ticks: int = block_stride(config, 0); tau: float = config.dt / int2float(n_ticks)
+    tick: int = 0; next_tick: int = 0; step_end: int = 0; k: int = 0; stride: int = 0; new_level: int = 0; tree_built: int = 0
+    h_half: float = 0.0; h_drift: float = 0.0; force: Vec3; dK_dp: Vec3
+    copy_states(current_states, config, next_states)
+    while (tick < n_ticks, max_iter := 100000000):
+        # Opening half kicks for the bodies whose step starts at this tick, and the first tick a step ends.
+        # Momenta only change in kicks, so only kicked bodies need their dH/dp (in d_pos) again.
+        next_tick = n_ticks
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            stride = block_stride(config, aws.levels[k])
+            if tick - (tick / stride) * stride == 0:
+                h_half = 0.5 * int2float(stride) * tau
+                next_states[k].mom.x = next_states[k].mom.x + h_half * derivs[k].d_mom.x; next_states[k].mom.y = next_states[k].mom.y + h_half * derivs[k].d_mom.y; next_states[k].mom.z = next_states[k].mom.z + h_half * derivs[k].d_mom.z
+                kinetic_energy_gradient(next_states[k], config, dK_dp)
+                derivs[k].d_pos.x = dK_dp.x; derivs[k].d_pos.y = dK_dp.y; derivs[k].d_pos.z = dK_dp.z
+            step_end = (tick / stride + 1) * stride
+            if step_end < next_tick:
+                next_tick = step_end
+            k = k + 1
+        h_drift = int2float(next_tick - tick) * tau
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            next_states[k].pos.x = next_states[k].pos.x + h_drift * derivs[k].d_pos.x; next_states[k].pos.y = next_states[k].pos.y + h_drift * derivs[k].d_pos.y; next_states[k].pos.z = next_states[k].pos.z + h_drift * derivs[k].d_pos.z
+            k = k + 1
+        # New forces and closing half kicks for the bodies whose step ends there
+        tree_built = 0
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            stride = block_stride(config, aws.levels[k])
+            if next_tick - (next_tick / stride) * stride == 0:
+                if config.force_method >= 1 and tree_built == 0:
+                    build_octree(next_states, config, ws)
+                    tree_built = 1
+                body_force(next_states, config, ws, k, force)
+                aws.force_evaluations = aws.force_evaluations + 1
+                derivs[k].d_mom.x = force.x; derivs[k].d_mom.y = force.y; derivs[k].d_mom.z = force.z
+                h_half = 0.5 * int2float(stride) * tau
+                next_states[k].mom.x = next_states[k].mom.x + h_half * force.x; next_states[k].mom.y = next_states[k].mom.y + h_half * force.y; next_states[k].mom.z = next_states[k].mom.z + h_half * force.z
+                new_level = block_level(next_states, config, k)
+                if new_level > aws.levels[k]:
+                    aws.levels[k] = new_level
+                elif new_level < aws.levels[k] and next_tick - (next_tick / (2 * stride)) * (2 * stride) == 0:
+                    aws.levels[k] = aws.levels[k] - 1
+            k = k + 1
+        tick = next_tick
+
+# --- Collisions ---
+# Two bodies touch once their centers are closer than the sum of their radii. Candidate pairs
+# come from a spatial hash of cubic cells as wide as twice the largest radius, so touching bodies
+# always share a cell or sit in neighbouring ones and a check costs O(N) however the bodies
+# are spread. A body merged into another keeps its slot with no mass and radius -1, and the
+# host drops it between calls.
+
+# Cell coordinate along one axis, counted from 1 so every neighbour is non-negative. Far cells
+# are clamped together, which costs extra candidates but never misses a contact.
+def collision_cell(x: In[float], min_x: In[float], inv_h: In[float]) -> int:
+    f: float = (x - min_x) * inv_h
+    if f > 1000000000.0:
+        f = 1000000000.0
+    return 1 + float2int(f)
+
+# Hash bucket of a cell, with every coordinate folded to 10 bits
+def collision_bucket(cx: In[int], cy: In[int], cz: In[int], table_size: In[int]) -> int:
+    key: int = ((cx - (cx / 1024) * 1024) * 1024 + (cy - (cy / 1024) * 1024)) * 1024 + (cz - (cz / 1024) * 1024)
+    return key - (key / table_size) * table_size
+
+def record_collision(cws: Out[CollisionWorkspace], i: In[int], j: In[int], frame: In[int]):
+    if cws.num_events < cws.max_events:
+        cws.event_i[cws.num_events] = i; cws.event_j[cws.num_events] = j; cws.event_frame[cws.num_events] = frame
+    cws.num_events = cws.num_events + 1
+
+# Applies config.collision_mode to a touching pair, h after the last check. A merger conserves
+# mass, momentum and the center of mass, and keeps the volume; the heavier body (the lower index
+# on a tie) survives. A bounce needs the pair to still be approaching and takes (1 + restitution)
+# times the approach speed out along the line of centers. A flag needs the pair to have been
+# apart h ago, going by the current velocities, so each contact is logged once.
+def resolve_collision(states: Out[Array[BodyState]], config: In[SimConfig], cws: Out[CollisionWorkspace], i: In[int], j: In[int], h: In[float], frame: In[int]):
+    a: int = i; b: int = j; m: float = 0.0; n: Vec3; v: Vec3; d: float = 0.0; vn: float = 0.0; w: float = 0.0; impulse: float = 0.0
+    px: float = 0.0; py: float = 0.0; pz: float = 0.0; rr: float = states[i].radius + states[j].radius
+    if config.collision_mode == 1:
+        if states[j].mass > states[i].mass:
+            a = j; b = i
+        m = states[a].mass + states[b].mass
+        if m > 0.0:
+            states[a].pos.x = (states[a].mass * states[a].pos.x + states[b].mass * states[b].pos.x) / m
+            states[a].pos.y = (states[a].mass * states[a].pos.y + states[b].mass * states[b].pos.y) / m
+            states[a].pos.z = (states[a].mass * states[a].pos.z + states[b].mass * states[b].pos.z) / m
+            states[a].inv_mass = 1.0 / m
+        states[a].mom.x = states[a].mom.x + states[b].mom.x; states[a].mom.y = states[a].mom.y + states[b].mom.y; states[a].mom.z = states[a].mom.z + states[b].mom.z
+        states[a].mass = m
+        states[a].radius = pow(states[a].radius * states[a].radius * states[a].radius + states[b].radius * states[b].radius * states[b].radius, 1.0 / 3.0)
+        states[b].mass = 0.0; states[b].inv_mass = 0.0; states[b].radius = 0.0 - 1.0
+        states[b].mom.x = 0.0; states[b].mom.y = 0.0; states[b].mom.z = 0.0
+        record_collision(cws, a, b, frame)
+        cws.num_resolved = cws.num_resolved + 1
+    else:
+        n.x = states[j].pos.x - states[i].pos.x; n.y = states[j].pos.y - states[i].pos.y; n.z = states[j].pos.z - states[i].pos.z
+        v.x = states[j].mom.x * states[j].inv_mass - states[i].mom.x * states[i].inv_mass
+        v.y = states[j].mom.y * states[j].inv_mass - states[i].mom.y * states[i].inv_mass
+        v.z = states[j].mom.z * states[j].inv_mass - states[i].mom.z * states[i].inv_mass
+        d = sqrt(n.x*n.x + n.y*n.y + n.z*n.z)
+        if config.collision_mode == 2:
+            w = states[i].inv_mass + states[j].inv_mass
+            if d > 0.0:
+                n.x = n.x / d; n.y = n.y / d; n.z = n.z / d
+                vn = v.x * n.x + v.y * n.y + v.z * n.z
+            if vn < 0.0 and w > 0.0:
+                record_collision(cws, i, j, frame)
+                impulse = (1.0 + config.restitution) * vn / w
+                states[i].mom.x = states[i].mom.x + impulse * n.x; states[i].mom.y = states[i].mom.y + impulse * n.y; states[i].mom.z = states[i].mom.z + impulse * n.z
+                states[j].mom.x = states[j].mom.x - impulse * n.x; states[j].mom.y = states[j].mom.y - impulse * n.y; states[j].mom.z = states[j].mom.z - impulse * n.z
+                cws.num_resolved = cws.num_resolved + 1
+        else:
+            px = n.x - h * v.x; py = n.y - h * v.y; pz = n.z - h * v.z
+            if px*px + py*py + pz*pz >= rr * rr:
+                record_collision(cws, i, j, frame)
+
+def detect_collisions(states: Out[Array[BodyState]], config: In[SimConfig], cws: Out[CollisionWorkspace], h: In[float], frame: In[int]):
+    k: int = 0; i: int = 0; j: int = 0; b: int = 0; ox: int = 0; oy: int = 0; oz: int = 0; first: int = 1
+    max_r: float = 0.0; inv_h: float = 0.0; min_x: float = 0.0; min_y: float = 0.0; min_z: float = 0.0
+    dx: float = 0.0; dy: float = 0.0; dz: float = 0.0; rr: float = 0.0
+    # Cell size and origin from the bodies still in play
+    while (k < config.num_bodies, max_iter := 100000):
+        if states[k].radius >= 0.0:
+            if states[k].radius > max_r:
+                max_r = states[k].radius
+            if first == 1 or states[k].pos.x < min_x:
+                min_x = states[k].pos.x
+            if first == 1 or states[k].pos.y < min_y:
+                min_y = states[k].pos.y
+            if first == 1 or states[k].pos.z < min_z:
+                min_z = states[k].pos.z
+            first = 0
+        k = k + 1
+    if max_r > 0.0:
+        inv_h = 0.5 / max_r
+        k = 0
+        while (k < cws.table_size, max_iter := 1000000):
+            cws.heads[k] = -1
+            k = k + 1
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            if states[k].radius >= 0.0:
+                cws.cell_x[k] = collision_cell(states[k].pos.x, min_x, inv_h)
+                cws.cell_y[k] = collision_cell(states[k].pos.y, min_y, inv_h)
+                cws.cell_z[k] = collision_cell(states[k].pos.z, min_z, inv_h)
+                b = collision_bucket(cws.cell_x[k], cws.cell_y[k], cws.cell_z[k], cws.table_size)
+                cws.body_next[k] = cws.heads[b]
+                cws.heads[b] = k
+            k = k + 1
+        # Every pair i < j is met once, from i, in the one neighbouring cell that holds j
+        while (i < config.num_bodies, max_iter := 100000):
+            if states[i].radius >= 0.0:
+                ox = -1
+                while (ox <= 1, max_iter := 3):
+                    oy = -1
+                    while (oy <= 1, max_iter := 3):
+                        oz = -1
+                        while (oz <= 1, max_iter := 3):
+                            j = cws.heads[collision_bucket(cws.cell_x[i] + ox, cws.cell_y[i] + oy, cws.cell_z[i] + oz, cws.table_size)]
+                            while (j >= 0, max_iter := 100000):
+                                if j > i and ((cws.cell_x[j] == cws.cell_x[i] + ox and cws.cell_y[j] == cws.cell_y[i] + oy) and cws.cell_z[j] == cws.cell_z[i] + oz):
+                                    if states[i].radius >= 0.0 and states[j].radius >= 0.0:
+                                        dx = states[j].pos.x - states[i].pos.x; dy = states[j].pos.y - states[i].pos.y; dz = states[j].pos.z - states[i].pos.z
+                                        rr = states[i].radius + states[j].radius
+                                        if dx*dx + dy*dy + dz*dz < rr * rr:
+                                            resolve_collision(states, config, cws, i, j, h, frame)
+                                j = cws.body_next[j]
+                            oz = oz + 1
+                        oy = oy + 1
+                    ox = ox + 1
+            i = i + 1
+
+# Evaluates what the integrators carry between steps for states: the kick-drift-kick forces,
+# the Dormand-Prince FSAL derivatives, or the block timestep forces and levels
+def prime_integrator(states: In[Array[BodyState]], config: In[SimConfig], k1: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace], aws: Out[AdaptiveWorkspace]):
+    k: int = 0
+    if config.integrator == 2 or config.integrator == 3:
+        get_forces(states, config, k1, ws)
+    elif config.integrator == 5:
+        get_derivatives(states, config, k1, ws)
+    elif config.integrator == 6:
+        get_forces(states, config, k1, ws)
+        while (k < config.num_bodies, max_iter := 100000):
+            aws.levels[k] = block_level(states, config, k)
+            k = k + 1
+
+# Collision check on the newest states after a step of h, re-priming the integrator if it changed them
+def check_collisions(states: Out[Array[BodyState]], config: In[SimConfig], k1: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace], aws: Out[AdaptiveWorkspace],
+                     cws: Out[CollisionWorkspace], h: In[float], frame: In[int]):
+    resolved: int = cws.num_resolved
+    detect_collisions(states, config, cws, h, frame)
+    if cws.num_resolved > resolved:
+        prime_integrator(states, config, k1, ws, aws)
+
+# --- Adaptive Dormand-Prince 5(4) ---
+# states += h * derivs, in place
+def add_scaled_derivs(states: Out[Array[BodyState]], config: In[SimConfig], derivs: In[Array[BodyDerivative]], h: In[float]):
+    k: int = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        states[k].pos.x = states[k].pos.x + h * derivs[k].d_pos.x; states[k].pos.y = states[k].pos.y + h * derivs[k].d_pos.y; states[k].pos.z = states[k].pos.z + h * derivs[k].d_pos.z
+        states[k].mom.x = states[k].mom.x + h * derivs[k].d_mom.x; states[k].mom.y = states[k].mom.y + h * derivs[k].d_mom.y; states[k].mom.z = states[k].mom.z + h * derivs[k].d_mom.z
+        k = k + 1
+
+def abs_float(x: In[float]) -> float:
+    r: float = x
+    if x < 0.0:
+        r = 0.0 - x
+    return r
+
+# Contribution of one component to the squared error norm, scaled by tol * (1 + max(|y0|, |y1|))
+def scaled_error_sq(err: In[float], y0: In[float], y1: In[float], tol: In[float]) -> float:
+    y_max: float = abs_float(y0); sc: float = 0.0; r: float = 0.0
+    if abs_float(y1) > y_max:
+        y_max = abs_float(y1)
+    sc = tol * (1.0 + y_max)
+    r = err / sc
+    return r * r
+
+# RMS over every position and velocity component of (5th - 4th order solution) / scale.
+# The momentum error is measured as a velocity error so light bodies count as much as heavy ones.
+def dopri_error_norm(y0: In[Array[BodyState]], y1: In[Array[BodyState]], config: In[SimConfig],
+                     k1: In[Array[BodyDerivative]], k3: In[Array[BodyDerivative]], k4: In[Array[BodyDerivative]],
+                     k5: In[Array[BodyDerivative]], k6: In[Array[BodyDerivative]], k7: In[Array[BodyDerivative]],
+                     h: In[float]) -> float:
+    k: int = 0; total: float = 0.0; im: float = 0.0
+    e1: float = 71.0 / 57600.0; e3: float = 0.0 - 71.0 / 16695.0; e4: float = 71.0 / 1920.0
+    e5: float = 0.0 - 17253.0 / 339200.0; e6: float = 22.0 / 525.0; e7: float = 0.0 - 1.0 / 40.0
+    while (k < config.num_bodies, max_iter := 100000):
+        im = y0[k].inv_mass
+        total = total + scaled_error_sq(h * (e1 * k1[k].d_pos.x + e3 * k3[k].d_pos.x + e4 * k4[k].d_pos.x + e5 * k5[k].d_pos.x + e6 * k6[k].d_pos.x + e7 * k7[k].d_pos.x), y0[k].pos.x, y1[k].pos.x, config.tolerance)
+        total = total + scaled_error_sq(h * (e1 * k1[k].d_pos.y + e3 * k3[k].d_pos.y + e4 * k4[k].d_pos.y + e5 * k5[k].d_pos.y + e6 * k6[k].d_pos.y + e7 * k7[k].d_pos.y), y0[k].pos.y, y1[k].pos.y, config.tolerance)
+        total = total + scaled_error_sq(h * (e1 * k1[k].d_pos.z + e3 * k3[k].d_pos.z + e4 * k4[k].d_pos.z + e5 * k5[k].d_pos.z + e6 * k6[k].d_pos.z + e7 * k7[k].d_pos.z), y0[k].pos.z, y1[k].pos.z, config.tolerance)
+        total = total + scaled_error_sq(im * h * (e1 * k1[k].d_mom.x + e3 * k3[k].d_mom.x + e4 * k4[k].d_mom.x + e5 * k5[k].d_mom.x + e6 * k6[k].d_mom.x + e7 * k7[k].d_mom.x), im * y0[k].mom.x, im * y1[k].mom.x, config.tolerance)
+        total = total + scaled_error_sq(im * h * (e1 * k1[k].d_mom.y + e3 * k3[k].d_mom.y + e4 * k4[k].d_mom.y + e5 * k5[k].d_mom.y + e6 * k6[k].d_mom.y + e7 * k7[k].d_mom.y), im * y0[k].mom.y, im * y1[k].mom.y, config.tolerance)
+        total = total + scaled_error_sq(im * h * (e1 * k1[k].d_mom.z + e3 * k3[k].d_mom.z + e4 * k4[k].d_mom.z + e5 * k5[k].d_mom.z + e6 * k6[k].d_mom.z + e7 * k7[k].d_mom.z), im * y0[k].mom.z, im * y1[k].mom.z, config.tolerance)
+        k = k + 1
+    return sqrt(total / int2float(6 * config.num_bodies))
+
+# Advances states by exactly frame_time with Dormand-Prince 5(4) steps, choosing each step
+# from the embedded error estimate. k1 must hold the derivatives at states on entry and holds
+# them at the new states on return (first same as last). The step size carries over in aws.dt,
+# and a step shortened to land on the frame boundary does not shrink it.
+def advance_frame_adaptive(states: Out[Array[BodyState]],
+                           trial_states: Out[Array[BodyState]],
+                           config: In[SimConfig],
+                           frame_time: In[float],
+                           k1: Out[Array[BodyDerivative]],
+                           k2: Out[Array[BodyDerivative]],
+                           k3: Out[Array[BodyDerivative]],
+                           k4: Out[Array[BodyDerivative]],
+                           stage_states: Out[Array[BodyState]],
+                           ws: Out[ForceWorkspace],
+                           aws: Out[AdaptiveWorkspace],
+                           cws: Out[CollisionWorkspace],
+                           frame: In[int]):
+    t: float = 0.0; h: float = 0.0; err: float = 0.0; fac: float = 0.0; min_h: float = frame_time * 0.000000001
+    last: int = 0; done: int = 0
+    if aws.dt <= 0.0:
+        aws.dt = config.dt
+    while (done == 0, max_iter := 10000000):
+        h = aws.dt; last = 0
+        if h > frame_time:
+            h = frame_time
+        if t + h >= frame_time:
+            h = frame_time - t; last = 1
+        # Stages 2-6
+        copy_states(states, config, stage_states)
+        add_scaled_derivs(stage_states, config, k1, h / 5.0)
+        get_derivatives(stage_states, config, k2, ws)
+        copy_states(states, config, stage_states)
+        add_scaled_derivs(stage_states, config, k1, h * 3.0 / 40.0); add_scaled_derivs(stage_states, config, k2, h * 9.0 / 40.0)
+        get_derivatives(stage_states, config, k3, ws)
+        copy_states(states, config, stage_states)
+        add_scaled_derivs(stage_states, config, k1, h * 44.0 / 45.0); add_scaled_derivs(stage_states, config, k2, 0.0 - h * 56.0 / 15.0)
+        add_scaled_derivs(stage_states, config, k3, h * 32.0 / 9.0)
+        get_derivatives(stage_states, config, k4, ws)
+        copy_states(states, config, stage_states)
+        add_scaled_derivs(stage_states, config, k1, h * 19372.0 / 6561.0); add_scaled_derivs(stage_states, config, k2, 0.0 - h * 25360.0 / 2187.0)
+        add_scaled_derivs(stage_states, config, k3, h * 64448.0 / 6561.0); add_scaled_derivs(stage_states, config, k4, 0.0 - h * 212.0 / 729.0)
+        get_derivatives(stage_states, config, aws.k5, ws)
+        copy_states(states, config, stage_states)
+        add_scaled_derivs(stage_states, config, k1, h * 9017.0 / 3168.0); add_scaled_derivs(stage_states, config, k2, 0.0 - h * 355.0 / 33.0)
+        add_scaled_derivs(stage_states, config, k3, h * 46732.0 / 5247.0); add_scaled_derivs(stage_states, config, k4, h * 49.0 / 176.0)
+        add_scaled_derivs(stage_states, config, aws.k5, 0.0 - h * 5103.0 / 18656.0)
+        get_derivatives(stage_states, config, aws.k6, ws)
+        # 5th order solution, and stage 7 at it
+        copy_states(states, config, trial_states)
+        add_scaled_derivs(trial_states, config, k1, h * 35.0 / 384.0); add_scaled_derivs(trial_states, config, k3, h * 500.0 / 1113.0)
+        add_scaled_derivs(trial_states, config, k4, h * 125.0 / 192.0); add_scaled_derivs(trial_states, config, aws.k5, 0.0 - h * 2187.0 / 6784.0)
+        add_scaled_derivs(trial_states, config, aws.k6, h * 11.0 / 84.0)
+        get_derivatives(trial_states, config, aws.k7, ws)
+        err = dopri_error_norm(states, trial_states, config, k1, k3, k4, aws.k5, aws.k6, aws.k7, h)
+
+        # Step size factor 0.9 * err^(-1/5), within [0.2, 5]; a NaN error takes the smallest
+        fac = 0.2
+        if err <= 0.0:
+            fac = 5.0
+        elif err > 0.0:
+            fac = 0.9 * pow(err, 0.0 - 0.2)
+            if fac > 5.0:
+                fac = 5.0
+            elif fac < 0.2:
+                fac = 0.2
+        if err <= 1.0 or h <= min_h:
+            copy_states(trial_states, config, states)
+            copy_derivs(aws.k7, config, k1)
+            t = t + h
+            aws.accepted_steps = aws.accepted_steps + 1
+            if config.collision_mode > 0:
+                check_collisions(states, config, k1, ws, aws, cws, h, frame)
+            if last == 1:
+                done = 1
+                if fac < 1.0:
+                    aws.dt = h * fac
+            else:
+                aws.dt = h * fac
+        else:
+            aws.rejected_steps = aws.rejected_steps + 1
+            aws.dt = h * fac
+        if aws.dt < min_h:
+            aws.dt = min_h
+
+# --- Wisdom-Holman ---
+# Democratic heliocentric splitting around the central mass, body 0: heliocentric positions
+# Q_i = r_i - r_0 and barycentric momenta P_i = p_i - m_i V_cm for i >= 1, with body 0's slot
+# holding the barycenter and total momentum. H = sum_i Kepler(Q_i, P_i; G m_0) + interaction
+# + |sum_i P_i|^2 / (2 m_0). The interaction holds the softened planet-planet pairs and the
+# difference between the softened and the Keplerian central pull, so this integrates the same
+# Hamiltonian as the other integrators while only the interaction needs small steps.
+
+# Stumpff functions c_k(z), c_k(z) = 1 / k! - z / (k + 2)! + ...
+class Stumpff:
+    c0: float
+    c1: float
+    c2: float
+    c3: float
+
+def stumpff(z: In[float], c: Out[Stumpff]):
+    x: float = 0.0
+    if z > 1.0:
+        x = sqrt(z)
+        c.c0 = cos(x); c.c1 = sin(x) / x
+    elif z < 0.0 - 1.0:
+        x = sqrt(0.0 - z)
+        c.c0 = 0.5 * (exp(x) + exp(0.0 - x)); c.c1 = 0.5 * (exp(x) - exp(0.0 - x)) / x
+    if z > 1.0 or z < 0.0 - 1.0:
+        c.c2 = (1.0 - c.c0) / z; c.c3 = (1.0 - c.c1) / z
+    else:
+        # The closed forms cancel badly near 0, so |z| <= 1 uses the series
+        c.c2 = 0.5 * (1.0 - z / 12.0 * (1.0 - z / 30.0 * (1.0 - z / 56.0 * (1.0 - z / 90.0 * (1.0 - z / 132.0 * (1.0 - z / 182.0))))))
+        c.c3 = (1.0 - z / 20.0 * (1.0 - z / 42.0 * (1.0 - z / 72.0 * (1.0 - z / 110.0 * (1.0 - z / 156.0 * (1.0 - z / 210.0)))))) / 6.0
+        c.c0 = 1.0 - z * c.c2; c.c1 = 1.0 - z * c.c3
+
+# Advances a Kepler orbit about mass parameter mu by dt in universal variables: Halley iterations
+# on r0 G1 + eta0 G2 + mu G3 = dt for the universal anomaly s, G_k = s^k c_k(beta s^2), then the
+# f and g functions. Works for elliptic, parabolic and hyperbolic orbits alike.
+def kepler_drift(pos: Out[Vec3], vel: Out[Vec3], mu: In[float], dt: In[float]):
+    r0: float = sqrt(pos.x*pos.x + pos.y*pos.y + pos.z*pos.z)
+    eta0: float = pos.x*vel.x + pos.y*vel.y + pos.z*vel.z
+    beta: float = 2.0 * mu / r0 - (vel.x*vel.x + vel.y*vel.y + vel.z*vel.z)
+    zeta0: float = mu - beta * r0
+    s: float = dt / r0; ds: float = 0.0; f: float = 0.0; r: float = 0.0; it: int = 0
+    g1: float = 0.0; g2: float = 0.0; g3: float = 0.0
+    kf: float = 0.0; kg: float = 0.0; kfdot: float = 0.0; kgdot: float = 0.0; x: float = 0.0; y: float = 0.0; z: float = 0.0
+    c: Stumpff
+    while (it < 12, max_iter := 12):
+        stumpff(beta * s * s, c)
+        g1 = s * c.c1; g2 = s * s * c.c2; g3 = s * s * s * c.c3
+        f = r0 * g1 + eta0 * g2 + mu * g3 - dt
+        r = r0 * c.c0 + eta0 * g1 + mu * g2
+        ds = 0.0 - f / (r - 0.5 * f * (eta0 * c.c0 + zeta0 * g1) / r)
+        s = s + ds
+        if abs_float(ds) <= 0.000000000000001 * abs_float(s):
+            it = 12
+        it = it + 1
+    stumpff(beta * s * s, c)
+    g1 = s * c.c1; g2 = s * s * c.c2; g3 = s * s * s * c.c3
+    r = r0 * c.c0 + eta0 * g1 + mu * g2
+    kf = 1.0 - mu * g2 / r0; kg = dt - mu * g3
+    kfdot = 0.0 - mu * g1 / (r0 * r); kgdot = 1.0 - mu * g2 / r
+    x = kf * pos.x + kg * vel.x; y = kf * pos.y + kg * vel.y; z = kf * pos.z + kg * vel.z
+    vel.x = kfdot * pos.x + kgdot * vel.x; vel.y = kfdot * pos.y + kgdot * vel.y; vel.z = kfdot * pos.z + kgdot * vel.z
+    pos.x = x; pos.y = y; pos.z = z
+
+def to_democratic_heliocentric(src: In[Array[BodyState]], config: In[SimConfig], dst: Out[Array[BodyState]]):
+    k: int = 0; total_mass: float = 0.0
+    copy_states(src, config, dst)
+    dst[0].pos.x = 0.0; dst[0].pos.y = 0.0; dst[0].pos.z = 0.0; dst[0].mom.x = 0.0; dst[0].mom.y = 0.0; dst[0].mom.z = 0.0
+    while (k < config.num_bodies, max_iter := 100000):
+        total_mass = total_mass + src[k].mass
+        dst[0].pos.x = dst[0].pos.x + src[k].mass * src[k].pos.x; dst[0].pos.y = dst[0].pos.y + src[k].mass * src[k].pos.y; dst[0].pos.z = dst[0].pos.z + src[k].mass * src[k].pos.z
+        dst[0].mom.x = dst[0].mom.x + src[k].mom.x; dst[0].mom.y = dst[0].mom.y + src[k].mom.y; dst[0].mom.z = dst[0].mom.z + src[k].mom.z
+        k = k + 1
+    dst[0].pos.x = dst[0].pos.x / total_mass; dst[0].pos.y = dst[0].pos.y / total_mass; dst[0].pos.z = dst[0].pos.z / total_mass
+    k = 1
+    while (k < config.num_bodies, max_iter := 100000):
+        dst[k].pos.x = src[k].pos.x - src[0].pos.x; dst[k].pos.y = src[k].pos.y - src[0].pos.y; dst[k].pos.z = src[k].pos.z - src[0].pos.z
+        dst[k].mom.x = src[k].mom.x - src[k].mass * dst[0].mom.x / total_mass; dst[k].mom.y = src[k].mom.y - src[k].mass * dst[0].mom.y / total_mass; dst[k].mom.z = src[k].mom.z - src[k].mass * dst[0].mom.z / total_mass
+        k = k + 1
+
+# Inverse of to_democratic_heliocentric, in place
+def from_democratic_heliocentric(states: Out[Array[BodyState]], config: In[SimConfig]):
+    k: int = 0; total_mass: float = 0.0; r0: Vec3; p_tot: Vec3
+    while (k < config.num_bodies, max_iter := 100000):
+        total_mass = total_mass + states[k].mass
+        k = k + 1
+    r0.x = states[0].pos.x; r0.y = states[0].pos.y; r0.z = states[0].pos.z
+    p_tot.x = states[0].mom.x; p_tot.y = states[0].mom.y; p_tot.z = states[0].mom.z
+    k = 1
+    while (k < config.num_bodies, max_iter := 100000):
+        r0.x = r0.x - states[k].mass * states[k].pos.x / total_mass; r0.y = r0.y - states[k].mass * states[k].pos.y / total_mass; r0.z = r0.z - states[k].mass * states[k].pos.z / total_mass
+        k = k + 1
+    states[0].pos.x = r0.x; states[0].pos.y = r0.y; states[0].pos.z = r0.z
+    k = 1
+    while (k < config.num_bodies, max_iter := 100000):
+        states[k].pos.x = states[k].pos.x + r0.x; states[k].pos.y = states[k].pos.y + r0.y; states[k].pos.z = states[k].pos.z + r0.z
+        states[k].mom.x = states[k].mom.x + states[k].mass * p_tot.x / total_mass; states[k].mom.y = states[k].mom.y + states[k].mass * p_tot.y / total_mass; states[k].mom.z = states[k].mom.z + states[k].mass * p_tot.z / total_mass
+        states[0].mom.x = states[0].mom.x - states[k].mom.x; states[0].mom.y = states[0].mom.y - states[k].mom.y; states[0].mom.z = states[0].mom.z - states[k].mom.z
+        k = k + 1
+
+# Interaction kick on democratic heliocentric coordinates: P_i -= h dH_int/dQ_i
+def wh_interaction_kick(states: Out[Array[BodyState]], config: In[SimConfig], h: In[float]):
+    i: int = 1; j: int = 0; dV_dri: Vec3; dV_drj: Vec3; central: BodyState; q3: float = 0.0; kep: float = 0.0
+    central.mass = states[0].mass; central.inv_mass = states[0].inv_mass
+    while (i < config.num_bodies, max_iter := 100000):
+        j = i + 1
+        while (j < config.num_bodies, max_iter := 100000):
+            # A test particle only feels the pair, and a pair of test particles is skipped
+            if (states[i].mass >= config.test_particle_mass or states[j].mass >= config.test_particle_mass) and (states[i].radius >= 0.0 and states[j].radius >= 0.0):
+                pair_potential_gradient(states[i], states[j], config, dV_dri, dV_drj)
+                if states[j].mass >= config.test_particle_mass:
+                    states[i].mom.x = states[i].mom.x - h * dV_dri.x; states[i].mom.y = states[i].mom.y - h * dV_dri.y; states[i].mom.z = states[i].mom.z - h * dV_dri.z
+                if states[i].mass >= config.test_particle_mass:
+                    states[j].mom.x = states[j].mom.x - h * dV_drj.x; states[j].mom.y = states[j].mom.y - h * dV_drj.y; states[j].mom.z = states[j].mom.z - h * dV_drj.z
+            j = j + 1
+        # Softened central pull minus the Keplerian one, G m_0 m_i Q / |Q|^3, which the drift already holds
+        pair_potential_gradient(states[i], central, config, dV_dri, dV_drj)
+        q3 = states[i].pos.x*states[i].pos.x + states[i].pos.y*states[i].pos.y + states[i].pos.z*states[i].pos.z
+        q3 = q3 * sqrt(q3)
+        kep = config.G * states[0].mass * states[i].mass / q3
+        states[i].mom.x = states[i].mom.x - h * (dV_dri.x - kep * states[i].pos.x); states[i].mom.y = states[i].mom.y - h * (dV_dri.y - kep * states[i].pos.y); states[i].mom.z = states[i].mom.z - h * (dV_dri.z - kep * states[i].pos.z)
+        i = i + 1
+
+# Central-body kinetic term: Q_i += h * sum_j P_j / m_0, summed over the massive bodies j
+def wh_jump(states: Out[Array[BodyState]], config: In[SimConfig], h: In[float]):
+    k: int = 1; p: Vec3
+    p.x = 0.0; p.y = 0.0; p.z = 0.0
+    while (k < config.num_bodies, max_iter := 100000):
+        if states[k].mass >= config.test_particle_mass:
+            p.x = p.x + states[k].mom.x; p.y = p.y + states[k].mom.y; p.z = p.z + states[k].mom.z
+        k = k + 1
+    k = 1
+    while (k < config.num_bodies, max_iter := 100000):
+        states[k].pos.x = states[k].pos.x + h * p.x * states[0].inv_mass; states[k].pos.y = states[k].pos.y + h * p.y * states[0].inv_mass; states[k].pos.z = states[k].pos.z + h * p.z * states[0].inv_mass
+        k = k + 1
+
+# Second order Wisdom-Holman step: half kick, half jump, Kepler drift, half jump, half kick.
+# The planet-planet interaction is summed directly whatever config.force_method says.
+def time_step_system_wisdom_holman(current_states: In[Array[BodyState]], config: In[SimConfig], next_states: Out[Array[BodyState]]):
+    k: int = 1; total_mass: float = 0.0; vel: Vec3
+    to_democratic_heliocentric(current_states, config, next_states)
+    wh_interaction_kick(next_states, config, 0.5 * config.dt)
+    wh_jump(next_states, config, 0.5 * config.dt)
+    while (k < config.num_bodies, max_iter := 100000):
+        if next_states[k].radius >= 0.0:
+            vel.x = next_states[k].mom.x * next_states[k].inv_mass; vel.y = next_states[k].mom.y * next_states[k].inv_mass; vel.z = next_states[k].mom.z * next_states[k].inv_mass
+            kepler_drift(next_states[k].pos, vel, config.G * next_states[0].mass, config.dt)
+            next_states[k].mom.x = vel.x * next_states[k].mass; next_states[k].mom.y = vel.y * next_states[k].mass; next_states[k].mom.z = vel.z * next_states[k].mass
+        k = k + 1
+    wh_jump(next_states, config, 0.5 * config.dt)
+    wh_interaction_kick(next_states, config, 0.5 * config.dt)
+    # The barycenter moves uniformly
+    k = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        total_mass = total_mass + next_states[k].mass
+        k = k + 1
+    next_states[0].pos.x = next_states[0].pos.x + config.dt * next_states[0].mom.x / total_mass; next_states[0].pos.y = next_states[0].pos.y + config.dt * next_states[0].mom.y / total_mass; next_states[0].pos.z = next_states[0].pos.z + config.dt * next_states[0].mom.z / total_mass
+    from_democratic_heliocentric(next_states, config)
+
+# --- Diagnostics ---
+# Quantities every integrator should conserve, in out[base .. base + 10): the energy, the total
+# linear momentum, the angular momentum about the origin and the center of mass. The energy is
+# n_body_hamiltonian without the pairs of test particles, which pull on nothing; with a tree
+# force method its potential comes from the same octree walk, in O(N log N).
+def conservation_diagnostics(states: In[Array[BodyState]], config: In[SimConfig], ws: Out[ForceWorkspace], out: Out[Array[float]], base: In[int]):
+    k: int = 0; i: int = 0; j: int = 0; kinetic: float = 0.0; pair_sum: float = 0.0; single_sum: float = 0.0; phi: float = 0.0; mass: float = 0.0
+    row: float = 0.0
+    k = 0
+    while (k < 10, max_iter := 10):
+        out[base + k] = 0.0
+        k = k + 1
+    k = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        kinetic = kinetic + body_kinetic_energy(states[k])
+        out[base + 1] = out[base + 1] + states[k].mom.x; out[base + 2] = out[base + 2] + states[k].mom.y; out[base + 3] = out[base + 3] + states[k].mom.z
+        out[base + 4] = out[base + 4] + states[k].pos.y * states[k].mom.z - states[k].pos.z * states[k].mom.y
+        out[base + 5] = out[base + 5] + states[k].pos.z * states[k].mom.x - states[k].pos.x * states[k].mom.z
+        out[base + 6] = out[base + 6] + states[k].pos.x * states[k].mom.y - states[k].pos.y * states[k].mom.x
+        out[base + 7] = out[base + 7] + states[k].mass * states[k].pos.x; out[base + 8] = out[base + 8] + states[k].mass * states[k].pos.y; out[base + 9] = out[base + 9] + states[k].mass * states[k].pos.z
+        mass = mass + states[k].mass
+        k = k + 1
+    if mass > 0.0:
+        out[base + 7] = out[base + 7] / mass; out[base + 8] = out[base + 8] / mass; out[base + 9] = out[base + 9] / mass
+    if config.force_method >= 1:
+        # Massive-massive pairs come up from both ends, test-massive ones only from the test particle
+        build_octree(states, config, ws)
+        while (i < ws.num_massive, max_iter := 100000):
+            octree_potential_on_body(states, config, ws, ws.massive[i], phi)
+            pair_sum = pair_sum + phi
+            i = i + 1
+        i = 0
+        while (i < ws.num_tests, max_iter := 100000):
+            octree_potential_on_body(states, config, ws, ws.tests[i], phi)
+            single_sum = single_sum + phi
+            i = i + 1
+        out[base] = kinetic + 0.5 * pair_sum + single_sum
+    else:
+        # Summed a body at a time, which keeps single precision round-off to that of the tree walk
+        partition_test_particles(states, config, ws)
+        while (i < ws.num_massive, max_iter := 100000):
+            row = 0.0
+            j = i + 1
+            while (j < ws.num_massive, max_iter := 100000):
+                row = row + pair_potential_energy(states[ws.massive[i]], states[ws.massive[j]], config)
+                j = j + 1
+            single_sum = single_sum + row
+            i = i + 1
+        i = 0
+        while (i < ws.num_tests, max_iter := 100000):
+            row = 0.0
+            j = 0
+            while (j < ws.num_massive, max_iter := 100000):
+                row = row + pair_potential_energy(states[ws.tests[i]], states[ws.massive[j]], config)
+                j = j + 1
+            single_sum = single_sum + row
+            i = i + 1
+        out[base] = kinetic + single_sum
+
+# --- Sensitivities ---
+# lam_i . F_i + lam_j . F_j for the pair force F_i = -dV/dr_i = -F_j of pair_potential_energy.
+# Its reverse-mode derivative with respect to the positions is the pair's block of the
+# transposed force Jacobian applied to (lam_i, lam_j).
+def pair_force_dot(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], lam_i: In[Vec3], lam_j: In[Vec3]) -> float:
+    dx: float = bj.pos.x - bi.pos.x; dy: float = bj.pos.y - bi.pos.y; dz: float = bj.pos.z - bi.pos.z
+    inv_dist: float = 1.0 / sqrt(dx*dx + dy*dy + dz*dz + config.epsilon_sq)
+    w: float = config.G * bi.mass * bj.mass * inv_dist * inv_dist * inv_dist
+    return w * ((lam_i.x - lam_j.x) * dx + (lam_i.y - lam_j.y) * dy + (lam_i.z - lam_j.z) * dz)
+
+d_rev_pair_force_dot = rev_diff(pair_force_dot)
+
+def pair_force_vjp(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], lam_i: In[Vec3], lam_j: In[Vec3], gi: Out[Vec3], gj: Out[Vec3]):
+    d_bi: BodyState; d_bj: BodyState; d_config: SimConfig; d_lam_i: Vec3; d_lam_j: Vec3
+    d_rev_pair_force_dot(bi, d_bi, bj, d_bj, config, d_config, lam_i, d_lam_i, lam_j, d_lam_j, 1.0)
+    gi.x = d_bi.pos.x; gi.y = d_bi.pos.y; gi.z = d_bi.pos.z
+    gj.x = d_bj.pos.x; gj.y = d_bj.pos.y; gj.z = d_bj.pos.z
+
+# out[k].d_pos = (dF/dr)^T lam for the direct forces, with lam[k].d_mom the adjoint of body k's force.
+# Same pairs as get_forces: massive-massive both ways, and each test particle against the massive bodies.
+def force_vjp(states: In[Array[BodyState]], config: In[SimConfig], lam: In[Array[BodyDerivative]], out: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    i: int = 0; j: int = 0; a: int = 0; b: int = 0; lam_a: Vec3; lam_b: Vec3; ga: Vec3; gb: Vec3
+    while (i < config.num_bodies, max_iter := 100000):
+        out[i].d_pos.x = 0.0; out[i].d_pos.y = 0.0; out[i].d_pos.z = 0.0
+        i = i + 1
+    partition_test_particles(states, config, ws)
+    i = 0
+    while (i < ws.num_massive + ws.num_tests, max_iter := 100000):
+        if i < ws.num_massive:
+            a = ws.massive[i]
+            j = i + 1
+        else:
+            a = ws.tests[i - ws.num_massive]
+            j = 0
+        lam_a.x = lam[a].d_mom.x; lam_a.y = lam[a].d_mom.y; lam_a.z = lam[a].d_mom.z
+        while (j < ws.num_massive, max_iter := 100000):
+            b = ws.massive[j]
+            # A test particle does not pull back, so the massive body's force adjoint plays no part
+            if i < ws.num_massive:
+                lam_b.x = lam[b].d_mom.x; lam_b.y = lam[b].d_mom.y; lam_b.z = lam[b].d_mom.z
+            else:
+                lam_b.x = 0.0; lam_b.y = 0.0; lam_b.z = 0.0
+            pair_force_vjp(states[a], states[b], config, lam_a, lam_b, ga, gb)
+            out[a].d_pos.x = out[a].d_pos.x + ga.x; out[a].d_pos.y = out[a].d_pos.y + ga.y; out[a].d_pos.z = out[a].d_pos.z + ga.z
+            out[b].d_pos.x = out[b].d_pos.x + gb.x; out[b].d_pos.y = out[b].d_pos.y + gb.y; out[b].d_pos.z = out[b].d_pos.z + gb.z
+            j = j + 1
+        i = i + 1
+
+# Reverse-mode pass through one fixed step from states with symplectic Euler (integrator 0) or
+# leapfrog (2) and direct forces. On entry adj holds the adjoint of the state after the step
+# (d_pos for the positions, d_mom for the momenta), on exit that of states.
+#   Euler:    p' = p + h F(r), r' = r + h p' / m
+#   Leapfrog: p1 = p + h/2 F(r), r' = r + h p1 / m, p' = p1 + h/2 F(r')
+def step_adjoint(states: In[Array[BodyState]], config: In[SimConfig], adj: Out[Array[BodyDerivative]],
+                 next_states: Out[Array[BodyState]], derivs: Out[Array[BodyDerivative]], vjp: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    k: int = 0; h: float = config.dt
+    if config.integrator == 2:
+        # The second half kick's force depends on the drifted positions, which are recomputed here
+        get_forces(states, config, derivs, ws)
+        copy_states(states, config, next_states)
+        while (k < config.num_bodies, max_iter := 100000):
+            next_states[k].pos.x = states[k].pos.x + h * (states[k].mom.x + 0.5 * h * derivs[k].d_mom.x) * states[k].inv_mass
+            next_states[k].pos.y = states[k].pos.y + h * (states[k].mom.y + 0.5 * h * derivs[k].d_mom.y) * states[k].inv_mass
+            next_states[k].pos.z = states[k].pos.z + h * (states[k].mom.z + 0.5 * h * derivs[k].d_mom.z) * states[k].inv_mass
+            k = k + 1
+        force_vjp(next_states, config, adj, vjp, ws)
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            adj[k].d_pos.x = adj[k].d_pos.x + 0.5 * h * vjp[k].d_pos.x; adj[k].d_pos.y = adj[k].d_pos.y + 0.5 * h * vjp[k].d_pos.y; adj[k].d_pos.z = adj[k].d_pos.z + 0.5 * h * vjp[k].d_pos.z
+            adj[k].d_mom.x = adj[k].d_mom.x + h * states[k].inv_mass * adj[k].d_pos.x; adj[k].d_mom.y = adj[k].d_mom.y + h * states[k].inv_mass * adj[k].d_pos.y; adj[k].d_mom.z = adj[k].d_mom.z + h * states[k].inv_mass * adj[k].d_pos.z
+            k = k + 1
+        force_vjp(states, config, adj, vjp, ws)
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            adj[k].d_pos.x = adj[k].d_pos.x + 0.5 * h * vjp[k].d_pos.x; adj[k].d_pos.y = adj[k].d_pos.y + 0.5 * h * vjp[k].d_pos.y; adj[k].d_pos.z = adj[k].d_pos.z + 0.5 * h * vjp[k].d_pos.z
+            k = k + 1
+    else:
+        while (k < config.num_bodies, max_iter := 100000):
+            adj[k].d_mom.x = adj[k].d_mom.x + h * states[k].inv_mass * adj[k].d_pos.x; adj[k].d_mom.y = adj[k].d_mom.y + h * states[k].inv_mass * adj[k].d_pos.y; adj[k].d_mom.z = adj[k].d_mom.z + h * states[k].inv_mass * adj[k].d_pos.z
+            k = k + 1
+        force_vjp(states, config, adj, vjp, ws)
+        k = 0
+        while (k < config.num_bodies, max_iter := 100000):
+            adj[k].d_pos.x = adj[k].d_pos.x + h * vjp[k].d_pos.x; adj[k].d_pos.y = adj[k].d_pos.y + h * vjp[k].d_pos.y; adj[k].d_pos.z = adj[k].d_pos.z + h * vjp[k].d_pos.z
+            k = k + 1
+
+# --- Chaos Indicators ---
+# F_i of the pair term of pair_potential_energy, where F_j = -F_i. Its forward-mode derivative
+# along (delta r_i, delta r_j) is the pair's block of the force Jacobian applied to the tangent.
+def pair_force(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], force: Out[Vec3]):
+    dx: float = bj.pos.x - bi.pos.x; dy: float = bj.pos.y - bi.pos.y; dz: float = bj.pos.z - bi.pos.z
+    inv_dist: float = 1.0 / sqrt(dx*dx + dy*dy + dz*dz + config.epsilon_sq)
+    w: float = config.G * bi.mass * bj.mass * inv_dist * inv_dist * inv_dist
+    force.x = w * dx; force.y = w * dy; force.z = w * dz
+
+d_pair_force = fwd_diff(pair_force)
+
+def pair_force_jvp(bi: In[BodyState], bj: In[BodyState], config: In[SimConfig], ti: In[Vec3], tj: In[Vec3], df: Out[Vec3]):
+    d_bi: Diff[BodyState]; d_bj: Diff[BodyState]; d_config: Diff[SimConfig]; d_f: Diff[Vec3]
+    d_bi.pos.x.val = bi.pos.x; d_bi.pos.y.val = bi.pos.y; d_bi.pos.z.val = bi.pos.z; d_bi.mass.val = bi.mass
+    d_bj.pos.x.val = bj.pos.x; d_bj.pos.y.val = bj.pos.y; d_bj.pos.z.val = bj.pos.z; d_bj.mass.val = bj.mass
+    d_config.G.val = config.G; d_config.epsilon_sq.val = config.epsilon_sq
+    d_bi.pos.x.dval = ti.x; d_bi.pos.y.dval = ti.y; d_bi.pos.z.dval = ti.z
+    d_bj.pos.x.dval = tj.x; d_bj.pos.y.dval = tj.y; d_bj.pos.z.dval = tj.z
+    d_pair_force(d_bi, d_bj, d_config, d_f)
+    df.x = d_f.x.dval; df.y = d_f.y.dval; df.z = d_f.z.dval
+
+# out[k].d_mom = (dF/dr) tangent for the direct forces, with tangent[k].d_pos the position offset of body k.
+# Same pairs as get_forces: each massive pair once, and each test particle against the massive bodies.
+def force_jvp(states: In[Array[BodyState]], config: In[SimConfig], tangent: In[Array[BodyDerivative]], out: Out[Array[BodyDerivative]], ws: Out[ForceWorkspace]):
+    i: int = 0; j: int = 0; a: int = 0; b: int = 0; ta: Vec3; tb: Vec3; df: Vec3
+    while (i < config.num_bodies, max_iter := 100000):
+        out[i].d_mom.x = 0.0; out[i].d_mom.y = 0.0; out[i].d_mom.z = 0.0
+        i = i + 1
+    partition_test_particles(states, config, ws)
+    i = 0
+    while (i < ws.num_massive + ws.num_tests, max_iter := 100000):
+        if i < ws.num_massive:
+            a = ws.massive[i]
+            j = i + 1
+        else:
+            a = ws.tests[i - ws.num_massive]
+            j = 0
+        ta.x = tangent[a].d_pos.x; ta.y = tangent[a].d_pos.y; ta.z = tangent[a].d_pos.z
+        while (j < ws.num_massive, max_iter := 100000):
+            b = ws.massive[j]
+            tb.x = tangent[b].d_pos.x; tb.y = tangent[b].d_pos.y; tb.z = tangent[b].d_pos.z
+            pair_force_jvp(states[a], states[b], config, ta, tb, df)
+            out[a].d_mom.x = out[a].d_mom.x + df.x; out[a].d_mom.y = out[a].d_mom.y + df.y; out[a].d_mom.z = out[a].d_mom.z + df.z
+            # A test particle does not pull back
+            if i < ws.num_massive:
+                out[b].d_mom.x = out[b].d_mom.x - df.x; out[b].d_mom.y = out[b].d_mom.y - df.y; out[b].d_mom.z = out[b].d_mom.z - df.z
+            j = j + 1
+        i = i + 1
+
+# Tangent map of one step from states to next_states with symplectic Euler (integrator 0) or leapfrog (2),
+# the linearization of step_system, so the tangent follows the discrete trajectory exactly.
+# vws.tangent_force holds (dF/dr) delta r at states on entry and at next_states on exit.
+#   Euler:    dp' = dp + h J dr, dr' = dr + h dp' / m
+#   Leapfrog: dp1 = dp + h/2 J dr, dr' = dr + h dp1 / m, dp' = dp1 + h/2 J' dr'
+# Then adds the step to the MEGNO integrals with the variational flow delta' = (dv, J' dr' / m)
+# at next_states, measuring delta = (dr, dv) in AU and AU/year.
+def variational_step(next_states: In[Array[BodyState]], config: In[SimConfig], vws: Out[VariationalWorkspace], ws: Out[ForceWorkspace]):
+    k: int = 0; h: float = config.dt; kick: float = config.dt; dvx: float = 0.0; dvy: float = 0.0; dvz: float = 0.0
+    flow_dot: float = 0.0; norm_sq: float = 0.0
+    if config.integrator == 2:
+        kick = 0.5 * config.dt
+    while (k < config.num_bodies, max_iter := 100000):
+        vws.tangent[k].d_mom.x = vws.tangent[k].d_mom.x + kick * vws.tangent_force[k].d_mom.x
+        vws.tangent[k].d_mom.y = vws.tangent[k].d_mom.y + kick * vws.tangent_force[k].d_mom.y
+        vws.tangent[k].d_mom.z = vws.tangent[k].d_mom.z + kick * vws.tangent_force[k].d_mom.z
+        vws.tangent[k].d_pos.x = vws.tangent[k].d_pos.x + h * vws.tangent[k].d_mom.x * next_states[k].inv_mass
+        vws.tangent[k].d_pos.y = vws.tangent[k].d_pos.y + h * vws.tangent[k].d_mom.y * next_states[k].inv_mass
+        vws.tangent[k].d_pos.z = vws.tangent[k].d_pos.z + h * vws.tangent[k].d_mom.z * next_states[k].inv_mass
+        k = k + 1
+    force_jvp(next_states, config, vws.tangent, vws.tangent_force, ws)
+    k = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        if config.integrator == 2:
+            vws.tangent[k].d_mom.x = vws.tangent[k].d_mom.x + kick * vws.tangent_force[k].d_mom.x
+            vws.tangent[k].d_mom.y = vws.tangent[k].d_mom.y + kick * vws.tangent_force[k].d_mom.y
+            vws.tangent[k].d_mom.z = vws.tangent[k].d_mom.z + kick * vws.tangent_force[k].d_mom.z
+        dvx = vws.tangent[k].d_mom.x * next_states[k].inv_mass; dvy = vws.tangent[k].d_mom.y * next_states[k].inv_mass; dvz = vws.tangent[k].d_mom.z * next_states[k].inv_mass
+        flow_dot = flow_dot + vws.tangent[k].d_pos.x * dvx + vws.tangent[k].d_pos.y * dvy + vws.tangent[k].d_pos.z * dvz
+        flow_dot = flow_dot + (dvx * vws.tangent_force[k].d_mom.x + dvy * vws.tangent_force[k].d_mom.y + dvz * vws.tangent_force[k].d_mom.z) * next_states[k].inv_mass
+        norm_sq = norm_sq + vws.tangent[k].d_pos.x * vws.tangent[k].d_pos.x + vws.tangent[k].d_pos.y * vws.tangent[k].d_pos.y + vws.tangent[k].d_pos.z * vws.tangent[k].d_pos.z
+        norm_sq = norm_sq + dvx * dvx + dvy * dvy + dvz * dvz
+        k = k + 1
+    vws.time = vws.time + h
+    vws.megno_sum = vws.megno_sum + 2.0 * vws.time * flow_dot / norm_sq * h
+    vws.megno_mean_sum = vws.megno_mean_sum + vws.megno_sum / vws.time * h
+
+# Rescales the tangent to unit length, adding the log of its growth to vws.log_growth, and writes the
+# Lyapunov exponent log_growth / time and the mean MEGNO megno_mean_sum / time to frame_indicators.
+# The indicators only see ratios of tangents, so rescaling once a frame keeps them exact without overflow.
+def record_chaos_indicators(states: In[Array[BodyState]], config: In[SimConfig], vws: Out[VariationalWorkspace], frame: In[int]):
+    k: int = 0; norm_sq: float = 0.0; dvx: float = 0.0; dvy: float = 0.0; dvz: float = 0.0; scale: float = 0.0
+    while (k < config.num_bodies, max_iter := 100000):
+        dvx = vws.tangent[k].d_mom.x * states[k].inv_mass; dvy = vws.tangent[k].d_mom.y * states[k].inv_mass; dvz = vws.tangent[k].d_mom.z * states[k].inv_mass
+        norm_sq = norm_sq + vws.tangent[k].d_pos.x * vws.tangent[k].d_pos.x + vws.tangent[k].d_pos.y * vws.tangent[k].d_pos.y + vws.tangent[k].d_pos.z * vws.tangent[k].d_pos.z
+        norm_sq = norm_sq + dvx * dvx + dvy * dvy + dvz * dvz
+        k = k + 1
+    vws.log_growth = vws.log_growth + 0.5 * log(norm_sq)
+    scale = 1.0 / sqrt(norm_sq)
+    k = 0
+    while (k < config.num_bodies, max_iter := 100000):
+        vws.tangent[k].d_pos.x = vws.tangent[k].d_pos.x * scale; vws.tangent[k].d_pos.y = vws.tangent[k].d_pos.y * scale; vws.tangent[k].d_pos.z = vws.tangent[k].d_pos.z * scale
+        vws.tangent[k].d_mom.x = vws.tangent[k].d_mom.x * scale; vws.tangent[k].d_mom.y = vws.tangent[k].d_mom.y * scale; vws.tangent[k].d_mom.z = vws.tangent[k].d_mom.z * scale
+        vws.tangent_force[k].d_mom.x = vws.tangent_force[k].d_mom.x * scale; vws.tangent_force[k].d_mom.y = vws.tangent_force[k].d_mom.y * scale; vws.tangent_force[k].d_mom.z = vws.tangent_force[k].d_mom.z * scale
+        k = k + 1
+    if vws.time > 0.0:
+        vws.frame_indicators[frame * 2] = vws.log_growth / vws.time
+        vws.frame_indicators[frame * 2 + 1] = vws.megno_mean_sum / vws.time
+    else:
+        vws.frame_indicators[frame * 2] = 0.0
+        vws.frame_indicators[frame * 2 + 1] = 0.0
+
+# --- Frame Driver ---
+def step_system(current_states: In[Array[BodyState]],
+                config: In[SimConfig],
+                next_states: Out[Array[BodyState]],
+                k1: Out[Array[BodyDerivative]],
+                k2: Out[Array[BodyDerivative]],
+                k3: Out[Array[BodyDerivative]],
+                k4: Out[Array[BodyDerivative]],
+                intermediate_states: Out[Array[BodyState]],
+                ws: Out[ForceWorkspace],
+                aws: Out[AdaptiveWorkspace]):
+    if config.integrator == 1:
+        time_step_system_rk4(current_states, config, next_states, k1, k2, k3, k4, intermediate_states, ws)
+    elif config.integrator == 2 or config.integrator == 3:
+        time_step_system_kdk(current_states, config, next_states, k1, ws)
+    elif config.integrator == 4:
+        time_step_system_forest_ruth(current_states, config, next_states, k1, ws)
+    elif config.integrator == 6:
+        time_step_system_block(current_states, config, next_states, k1, ws, aws)
+    elif config.integrator == 7:
+        time_step_system_wisdom_holman(current_states, config, next_states)
+    else:
+        time_step_system(current_states, config, next_states, k1, ws)
+
+# Advances n_frames * steps_per_frame steps in one call, ping-ponging between
+# states and scratch_states. On return, states holds the final state.
+# The adaptive integrator instead covers each frame's years_per_frame in steps of its own choosing.
+# The kick-drift-kick integrators carry their forces from step to step in k1,
+# so those (and the block timestep levels) are evaluated once up front for the incoming states.
+# If config.collision_mode > 0, collisions are checked after every step and logged in cws
+# with the frame they happened in.
+# If record_frames > 0, the positions at the start of every frame are
+# written to frame_positions as [frame][body][xyz], and if record_diagnostics > 0,
+# the conservation_diagnostics there to frame_diagnostics as [frame][10].
+# If config.variational > 0, the tangent in vws is stepped alongside the states and the chaos
+# indicators after every frame are written to vws.frame_indicators.
+def advance_frames(states: Out[Array[BodyState]],
+                   scratch_states: Out[Array[BodyState]],
+                   config: In[SimConfig],
+                   n_frames: In[int],
+                   steps_per_frame: In[int],
+                   record_frames: In[int],
+                   frame_positions: Out[Array[float]],
+                   record_diagnostics: In[int],
+                   frame_diagnostics: Out[Array[float]],
+                   k1: Out[Array[BodyDerivative]],
+                   k2: Out[Array[BodyDerivative]],
+                   k3: Out[Array[BodyDerivative]],
+                   k4: Out[Array[BodyDerivative]],
+                   intermediate_states: Out[Array[BodyState]],
+                   ws: Out[ForceWorkspace],
+                   aws: Out[AdaptiveWorkspace],
+                   cws: Out[CollisionWorkspace],
+                   vws: Out[VariationalWorkspace]):
+    frame: int = 0; s: int = 0; k: int = 0; out_idx: int = 0
+    prime_integrator(states, config, k1, ws, aws)
+    if config.variational > 0:
+        force_jvp(states, config, vws.tangent, vws.tangent_force, ws)
+    while (frame < n_frames, max_iter := 100000):
+        if record_frames > 0:
+            k = 0
+            while (k < config.num_bodies, max_iter := 100000):
+                out_idx = (frame * config.num_bodies + k) * 3
+                frame_positions[out_idx] = states[k].pos.x; frame_positions[out_idx + 1] = states[k].pos.y; frame_positions[out_idx + 2] = states[k].pos.z
+                k = k + 1
+        if record_diagnostics > 0:
+            conservation_diagnostics(states, config, ws, frame_diagnostics, frame * 10)
+        if config.integrator == 5:
+            # The frame is as long as steps_per_frame fixed steps; the adaptive integrator picks its own
+            advance_frame_adaptive(states, scratch_states, config, config.dt * int2float(steps_per_frame), k1, k2, k3, k4, intermediate_states, ws, aws, cws, frame)
+        else:
+            s = 0
+            while (s < steps_per_frame, max_iter := 100000):
+                if s - (s / 2) * 2 == 0:
+                    step_system(states, config, scratch_states, k1, k2, k3, k4, intermediate_states, ws, aws)
+                    if config.collision_mode > 0:
+                        check_collisions(scratch_states, config, k1, ws, aws, cws, config.dt, frame)
+                    if config.variational > 0:
+                        variational_step(scratch_states, config, vws, ws)
+                else:
+                    step_system(scratch_states, config, states, k1, k2, k3, k4, intermediate_states, ws, aws)
+                    if config.collision_mode > 0:
+                        check_collisions(states, config, k1, ws, aws, cws, config.dt, frame)
+                    if config.variational > 0:
+                        variational_step(states, config, vws, ws)
+                s = s + 1
+            # An odd step count leaves the newest state in the scratch buffer
+            if steps_per_frame - (steps_per_frame / 2) * 2 == 1:
+                copy_states(scratch_states, config, states)
+        if config.variational > 0:
+            record_chaos_indicators(states, config, vws, frame)
+        frame = frame + 1
+
+# --- Ensemble ---
+# One independent system of an ensemble: every buffer advance_frames needs, allocated by the host
+class EnsembleMember:
+    states: Array[BodyState]
+    scratch_states: Array[BodyState]
+    frame_positions: Array[float]
+    frame_diagnostics: Array[float]
+    k1: Array[BodyDerivative]
+    k2: Array[BodyDerivative]
+    k3: Array[BodyDerivative]
+    k4: Array[BodyDerivative]
+    intermediate_states: Array[BodyState]
+    ws: ForceWorkspace
+    aws: AdaptiveWorkspace
+    cws: CollisionWorkspace
+    vws: VariationalWorkspace
+
+# Advances every member by n_frames under one shared config, one member per work item.
+# Members share nothing, so the host may run disjoint ranges of them on separate threads.
+@simd
+def advance_ensemble(members: Out[Array[EnsembleMember]], config: In[SimConfig], n_frames: In[int], steps_per_frame: In[int], record_diagnostics: In[int]):
+    m: int = thread_id()
+    advance_frames(members[m].states, members[m].scratch_states, config, n_frames, steps_per_frame, 1, members[m].frame_positions,
+                   record_diagnostics, members[m].frame_diagnostics,
+                   members[m].k1, members[m].k2, members[m].k3, members[m].k4, members[m].intermediate_states, members[m].ws, members[m].aws, members[m].cws, members[m].vws)
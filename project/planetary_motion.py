@@ -1,4 +1,6 @@
 # planetory_motion.py (Python Host Code with Scenarios)
+import concurrent.futures
+import dataclasses
 import math
 import os
 import sys
@@ -11,7 +13,8 @@ import compiler
 import ctypes
 from config import SolarSystemConfig, BodyState 
 import utils 
-from typing import TextIO
+import checkpoint
+from typing import List, Optional, TextIO
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
 
@@ -19,7 +22,22 @@ LOMA_CODE_SUBDIR = 'loma_code'
 COMPILED_CODE_SUBDIR = '_code' 
 LOMA_CODE_3D_FILENAME = 'planetary_motion_3d_loma.py'
 COMPILED_LIB_NAME_PREFIX_3D = 'n_planets_lib_3d_v2' 
-MAX_N_BODIES_CONST = 20                    
+INTEGRATOR_IDS = {'symplectic_euler': 0, 'rk4': 1, 'leapfrog': 2, 'yoshida4': 3, 'forest_ruth': 4, 'dopri5': 5, 'block_leapfrog': 6, 'wisdom_holman': 7} # Must match SimConfig.integrator in the loma code
+GRADIENT_MODE_IDS = {'forward': 0, 'reverse': 1, 'forward_vector': 2} # Must match SimConfig.gradient_mode in the loma code
+FORCE_METHOD_IDS = {'direct': 0, 'barnes_hut': 1, 'fmm': 2} # Must match SimConfig.force_method in the loma code
+LAYOUT_IDS = {'aos': 0, 'soa': 1} # Must match SimConfig.layout in the loma code
+COLLISION_MODE_IDS = {'none': 0, 'merge': 1, 'bounce': 2, 'flag': 3} # Must match SimConfig.collision_mode in the loma code
+MAX_COLLISION_EVENTS = 1024 # Contacts logged per native call; any beyond are counted but not stored
+DIAGNOSTIC_FIELDS = ('energy', 'px', 'py', 'pz', 'lx', 'ly', 'lz', 'com_x', 'com_y', 'com_z') # Per frame, as written by conservation_diagnostics
+MAX_FMM_ORDER = 12 # The loma code supports up to 16; past ~10 single precision gains nothing
+FLOAT_CTYPES = {'single': ctypes.c_float, 'double': ctypes.c_double} # Host buffers handed to the loma code as Array[float]
+MIN_SINGLE_TOLERANCE = 1e-6 # Float32 round-off swamps any smaller per-step error target
+MAX_BLOCK_LEVEL = 20 # 2^20 ticks per step already resolves a million-fold spread of timescales
+SEEK_CHUNK_FRAMES = 1024 # Frames per native call while seeking, which records nothing
+SENSITIVITY_SNAPSHOTS = 64 # States trajectory_gradient keeps at once; 10^4 steps then recompute each step at most 3 times
+SENSITIVITY_INTEGRATORS = ('symplectic_euler', 'leapfrog') # Integrators step_adjoint can reverse
+CHAOS_FIELDS = ('lyapunov', 'megno') # Per frame, as written by record_chaos_indicators
+VARIATIONAL_INTEGRATORS = ('symplectic_euler', 'leapfrog') # Integrators variational_step linearizes
 
 G_val = (2.0 * math.pi)**2 
 logging.info(f"Using G_val: {G_val:.4f} AU^3 M☉^-1 year^-2 (for Solar Masses, AU, Years)")
@@ -82,11 +100,14 @@ def setup_jupiter_system_scenario() -> SolarSystemConfig:
             vy_init =  pos_x / current_r_xy * v_mag_desired
             vz_init = (np.random.rand() - 0.5) * 0.05 * v_mag_desired
         initial_bodies.append(BodyState(name=moon_def['name'], mass=moon_def['mass_solar'], pos=moon_def['pos_au'], vel=(vx_init, vy_init, vz_init)))
-    logging.info(f"Setting up Jupiter System with integrator: rk4")
+    logging.info(f"Setting up Jupiter System with integrator: block_leapfrog")
+    # Io needs far shorter steps than the outer moons, so every body gets its own power-of-two step within the frame.
+    # MoonX1/MoonX2 are test particles.
     system_config = SolarSystemConfig(
         name="Jupiter System (Solar Masses)", current_n_bodies=len(initial_bodies),
-        epsilon=0.00005, years_per_frame=0.0005, fps=fps, sim_steps_per_frame=256,
-        initial_bodies_data=initial_bodies, dimensions=3, loma_code_file=LOMA_CODE_3D_FILENAME, integrator='rk4'
+        epsilon=0.00005, years_per_frame=0.0005, fps=fps, sim_steps_per_frame=1,
+        initial_bodies_data=initial_bodies, dimensions=3, loma_code_file=LOMA_CODE_3D_FILENAME, integrator='block_leapfrog',
+        max_block_level=10, test_particle_mass=1e-9
     )
     return system_config
 
@@ -98,68 +119,487 @@ def setup_true_chaotic_scenario() -> SolarSystemConfig:
         BodyState(name="StarB", mass=1.0, pos=(-0.7, -0.4, -0.02), vel=(-0.08, -0.15, 0.04)),
         BodyState(name="StarC", mass=0.9, pos=(0.2, -0.8, 0.1), vel=(0.18, 0.05, 0.08))
     ]
-    logging.info(f"Setting up True Chaotic Scenario with integrator: rk4")
+    logging.info(f"Setting up True Chaotic Scenario with integrator: dopri5")
+    # Close approaches need tiny steps and the quiet stretches between them do not, so the step size is adaptive
     system_config = SolarSystemConfig(
         name=f"True Chaotic System ({len(initial_bodies)}-Body)", current_n_bodies=len(initial_bodies),
         epsilon=0.02, years_per_frame=0.0015, fps=fps, sim_steps_per_frame=768,
-        initial_bodies_data=initial_bodies, dimensions=3, loma_code_file=LOMA_CODE_3D_FILENAME, integrator='rk4'
+        initial_bodies_data=initial_bodies, dimensions=3, loma_code_file=LOMA_CODE_3D_FILENAME, integrator='dopri5',
+        tolerance=1e-10, precision='double'
     )
     return system_config
 
-def compile_loma_code(loma_fp: str, output_lib_prefix: str):
+def setup_star_cluster_scenario(n_bodies: int = 2000) -> SolarSystemConfig:
+    # Plummer sphere (Aarseth, Henon & Wielen 1974): a centrally concentrated cluster for the tree force methods
+    fps = 60
+    total_mass, scale_radius = 0.5 * n_bodies, 100.0 # Solar masses, AU
+    initial_bodies = []
+    for i in range(n_bodies):
+        r = scale_radius / math.sqrt(np.random.uniform(1e-6, 1.0)**(-2.0/3.0) - 1.0)
+        direction = np.random.normal(size=3); direction /= np.linalg.norm(direction)
+        # Speed as a fraction q of the local escape speed, drawn from g(q) = q^2 (1 - q^2)^3.5 by rejection
+        q, g = 0.0, 0.1
+        while g > q**2 * (1.0 - q**2)**3.5:
+            q, g = np.random.uniform(0.0, 1.0), np.random.uniform(0.0, 0.1)
+        v_escape = math.sqrt(2.0 * G_val * total_mass) * (r**2 + scale_radius**2)**(-0.25)
+        v_direction = np.random.normal(size=3); v_direction /= np.linalg.norm(v_direction)
+        initial_bodies.append(BodyState(name=f"Star{i}", mass=total_mass / n_bodies,
+                                        pos=tuple((r * direction).tolist()), vel=tuple((q * v_escape * v_direction).tolist())))
+    logging.info(f"Setting up Star Cluster with {n_bodies} bodies and force method: fmm")
+    system_config = SolarSystemConfig(
+        name=f"Star Cluster ({n_bodies}-Body Plummer Sphere)", current_n_bodies=len(initial_bodies),
+        epsilon=1.0, years_per_frame=0.05, fps=fps, sim_steps_per_frame=4,
+        initial_bodies_data=initial_bodies, dimensions=3, loma_code_file=LOMA_CODE_3D_FILENAME, integrator='symplectic_euler',
+        force_method='fmm', theta=0.5, fmm_order=4
+    )
+    return system_config
+
+def compile_loma_code(loma_fp: str, output_lib_prefix: str, precision: str = 'single'):
     script_dir = os.path.dirname(os.path.realpath(__file__))
     loma_source_full_path = os.path.join(script_dir, LOMA_CODE_SUBDIR, loma_fp)
     compiled_output_dir = os.path.join(script_dir, COMPILED_CODE_SUBDIR)
     if not os.path.exists(compiled_output_dir): os.makedirs(compiled_output_dir); logging.info(f"Created dir: {compiled_output_dir}")
-    compiled_lib_path_prefix = os.path.join(compiled_output_dir, output_lib_prefix) 
+    # Each precision gets its own library so a double session never reloads over a single one
+    compiled_lib_path_prefix = os.path.join(compiled_output_dir, output_lib_prefix + ('_f64' if precision == 'double' else '')) 
     if not os.path.exists(loma_source_full_path): logging.error(f"Loma src not found: {loma_source_full_path}"); return None,None
     with open(loma_source_full_path, 'r') as f: loma_code_str = f.read()
     try:
-        structs, lib = compiler.compile(loma_code_str,target='c',output_filename=compiled_lib_path_prefix)
+        structs, lib = compiler.compile(loma_code_str,target='c',output_filename=compiled_lib_path_prefix,precision=precision,vectorize=True)
         logging.info(f"Successfully compiled Loma code: {loma_fp} to {compiled_lib_path_prefix}"); return structs,lib
     except Exception as e: logging.error(f"Compile error {loma_fp}: {e}",exc_info=True); return None,None
 
-def get_simulation_runner(cfg: SolarSystemConfig):    
-    structs, lib = compile_loma_code(cfg.loma_code_file, COMPILED_LIB_NAME_PREFIX_3D)
-    if not structs or not lib: logging.error("Sim runner setup failed: no structs/lib."); return lambda _: [] 
-
-    VecND = structs['Vec3']
-    BodyStateLoma, SimConfigLoma = structs['BodyState'], structs['SimConfig']
-    BodyStateArray = BodyStateLoma * MAX_N_BODIES_CONST 
-    current_body_states, next_body_states_buffer = BodyStateArray(), BodyStateArray()
-
-    # Allocate scratch space for RK4 if needed
-    k1_buffer, k2_buffer, k3_buffer, k4_buffer, intermediate_states_buffer_rk4 = (None,)*5
-    if cfg.integrator == 'rk4':
-        BodyDerivative = structs['BodyDerivative']
-        BodyDerivativeArray = BodyDerivative * MAX_N_BODIES_CONST
-        k1_buffer = BodyDerivativeArray()
+def load_initial_states(structs, cfg: SolarSystemConfig, body_states):
+    bodies = cfg.initial_bodies_data[:cfg.current_n_bodies]
+    mass = np.array([b.mass for b in bodies], dtype=np.float64)
+    pos, vel = np.zeros((len(bodies), 3)), np.zeros((len(bodies), 3))
+    for i, b in enumerate(bodies):
+        if len(b.pos)<3 or len(b.vel)<3: logging.error(f"Body {b.name} bad pos/vel for 3D."); continue
+        pos[i], vel[i] = b.pos[:3], b.vel[:3]
+    mom = vel * mass[:, None]
+    utils.soa_to_body_states({'x': pos[:, 0], 'y': pos[:, 1], 'z': pos[:, 2], 'px': mom[:, 0], 'py': mom[:, 1], 'pz': mom[:, 2], 'mass': mass,
+                              'inv_mass': np.divide(1.0, mass, out=np.zeros_like(mass), where=mass > 1e-20),
+                              'radius': np.array([b.collision_radius or 0.0 for b in bodies])}, body_states)
+
+def make_sim_config(structs, cfg: SolarSystemConfig):
+    return structs['SimConfig'](G=G_val, dt=(cfg.years_per_frame/cfg.sim_steps_per_frame), 
+                                epsilon_sq=cfg.epsilon**2, num_bodies=cfg.current_n_bodies,
+                                integrator=INTEGRATOR_IDS.get(cfg.integrator, 0),
+                                gradient_mode=GRADIENT_MODE_IDS.get(cfg.gradient_mode, 1),
+                                force_method=FORCE_METHOD_IDS.get(cfg.force_method, 0), theta=cfg.theta,
+                                fmm_order=min(max(cfg.fmm_order, 1), MAX_FMM_ORDER),
+                                tolerance=cfg.tolerance if cfg.precision == 'double' else max(cfg.tolerance, MIN_SINGLE_TOLERANCE),
+                                max_block_level=min(max(cfg.max_block_level, 0), MAX_BLOCK_LEVEL), block_eta=cfg.block_eta,
+                                test_particle_mass=cfg.test_particle_mass,
+                                collision_mode=COLLISION_MODE_IDS.get(cfg.collisions, 0), restitution=cfg.restitution,
+                                layout=LAYOUT_IDS.get(cfg.layout, 0), variational=int(cfg.chaos_indicators))
+
+def make_force_workspace(structs, cfg: SolarSystemConfig):
+    # Octree node pool for the tree methods; the octree degrades to shared leaves rather than overflowing it
+    OctreeNode, ForceWorkspace = structs['OctreeNode'], structs['ForceWorkspace']
+    max_octree_nodes = 8 * cfg.current_n_bodies + 64 if cfg.force_method in ('barnes_hut', 'fmm') else 0
+    octree_nodes_buffer = (OctreeNode * max(max_octree_nodes, 1))()
+    body_next_buffer = (ctypes.c_int * cfg.current_n_bodies)()
+    # FMM expansions and multi-index tables, sized for the expansion order
+    order = min(max(cfg.fmm_order, 1), MAX_FMM_ORDER) if cfg.force_method == 'fmm' else 0
+    num_coeffs = math.comb(order + 3, 3)
+    num_pairs = math.comb(order + 6, 6) # Coefficient pairs with |a| + |b| <= order
+    expansion_size = max_octree_nodes * num_coeffs if cfg.force_method == 'fmm' else 1
+    c_float = FLOAT_CTYPES[cfg.precision]
+    float_array = lambda n: ctypes.cast((c_float * n)(), ctypes.POINTER(c_float))
+    # Structure-of-arrays copy of the bodies for the direct sum
+    soa_size = cfg.current_n_bodies if cfg.layout == 'soa' and cfg.force_method == 'direct' else 1
+    int_array = lambda n: ctypes.cast((ctypes.c_int * n)(), ctypes.POINTER(ctypes.c_int))
+    # ctypes.cast keeps the source buffers alive for as long as the workspace
+    return ForceWorkspace(nodes=ctypes.cast(octree_nodes_buffer, ctypes.POINTER(OctreeNode)),
+                          body_next=ctypes.cast(body_next_buffer, ctypes.POINTER(ctypes.c_int)),
+                          max_nodes=max_octree_nodes, num_nodes=0,
+                          leaf_capacity=cfg.fmm_leaf_size if cfg.force_method == 'fmm' else 1,
+                          multipoles=float_array(expansion_size), locals=float_array(expansion_size),
+                          kernel=float_array((order + 1) * num_coeffs),
+                          coeff_x=int_array(num_coeffs), coeff_y=int_array(num_coeffs), coeff_z=int_array(num_coeffs), coeff_deg=int_array(num_coeffs),
+                          coeff_index=int_array((order + 1)**3), inv_fact=float_array(num_coeffs), coeff_sign=float_array(num_coeffs),
+                          rec_dir=int_array(num_coeffs), rec_prev=int_array(num_coeffs), rec_prev2=int_array(num_coeffs), rec_mul=int_array(num_coeffs),
+                          pair_start=int_array(num_coeffs + 1), pair_other=int_array(num_pairs), pair_sum=int_array(num_pairs),
+                          m2l_sources=float_array(2 * num_coeffs), num_coeffs=num_coeffs,
+                          massive=int_array(cfg.current_n_bodies), tests=int_array(cfg.current_n_bodies),
+                          soa_x=float_array(soa_size), soa_y=float_array(soa_size), soa_z=float_array(soa_size), soa_mass=float_array(soa_size),
+                          soa_ax=float_array(soa_size), soa_ay=float_array(soa_size), soa_az=float_array(soa_size))
+
+def make_adaptive_workspace(structs, cfg: SolarSystemConfig):
+    # The three Dormand-Prince stages beyond the RK4 buffers (dt = 0 starts from the fixed step) and the block timestep levels
+    BodyDerivative, AdaptiveWorkspace = structs['BodyDerivative'], structs['AdaptiveWorkspace']
+    n = cfg.current_n_bodies if cfg.integrator == 'dopri5' else 1
+    derivs_array = lambda: ctypes.cast((BodyDerivative * n)(), ctypes.POINTER(BodyDerivative))
+    levels_buffer = (ctypes.c_int * (cfg.current_n_bodies if cfg.integrator == 'block_leapfrog' else 1))()
+    return AdaptiveWorkspace(k5=derivs_array(), k6=derivs_array(), k7=derivs_array(), dt=0.0, accepted_steps=0, rejected_steps=0,
+                             levels=ctypes.cast(levels_buffer, ctypes.POINTER(ctypes.c_int)), force_evaluations=0)
+
+def next_prime(n: int) -> int:
+    while n < 2 or any(n % d == 0 for d in range(2, math.isqrt(n) + 1)): n += 1
+    return n
+
+def make_collision_workspace(structs, cfg: SolarSystemConfig):
+    # Spatial hash with a prime number of buckets, about two per body, and the contact log
+    n = cfg.current_n_bodies
+    table_size = next_prime(2 * n + 1) if cfg.collisions != 'none' else 1
+    max_events = MAX_COLLISION_EVENTS if cfg.collisions != 'none' else 1
+    int_array = lambda k: ctypes.cast((ctypes.c_int * k)(), ctypes.POINTER(ctypes.c_int))
+    return structs['CollisionWorkspace'](heads=int_array(table_size), body_next=int_array(n),
+                                         cell_x=int_array(n), cell_y=int_array(n), cell_z=int_array(n), table_size=table_size,
+                                         event_i=int_array(max_events), event_j=int_array(max_events), event_frame=int_array(max_events),
+                                         max_events=max_events, num_events=0, num_resolved=0)
+
+def compact_merged_bodies(structs, cfg: SolarSystemConfig, body_states):
+    """ Drops the bodies merged away (radius < 0) from body_states. Returns a config whose
+        initial_bodies_data describes the survivors as they are now, and their states. """
+    survivors = [k for k in range(cfg.current_n_bodies) if body_states[k].radius >= 0.0]
+    new_states = (structs['BodyState'] * len(survivors))()
+    bodies = []
+    for i, k in enumerate(survivors):
+        new_states[i] = body_states[k]
+        s = body_states[k]
+        bodies.append(dataclasses.replace(cfg.initial_bodies_data[k], mass=s.mass, pos=(s.pos.x, s.pos.y, s.pos.z),
+                                          vel=(s.mom.x * s.inv_mass, s.mom.y * s.inv_mass, s.mom.z * s.inv_mass), collision_radius=s.radius))
+    return dataclasses.replace(cfg, initial_bodies_data=bodies, current_n_bodies=len(survivors)), new_states
+
+def check_chaos_indicators(cfg: SolarSystemConfig):
+    # Raises ValueError unless cfg leaves chaos indicators off or steps a system the variational step linearizes
+    if cfg.chaos_indicators and (cfg.integrator not in VARIATIONAL_INTEGRATORS or cfg.force_method != 'direct' or cfg.collisions != 'none'):
+        raise ValueError(f"Chaos indicators need integrator in {VARIATIONAL_INTEGRATORS}, force_method 'direct' and no collisions")
+
+def make_variational_workspace(structs, cfg: SolarSystemConfig, seed: int = 0):
+    # Tangent seeded with a random unit (delta r, delta v); the indicators then follow its most unstable direction
+    n = cfg.current_n_bodies if cfg.chaos_indicators else 1
+    check_chaos_indicators(cfg)
+    BodyDerivative = structs['BodyDerivative']
+    tangent = np.random.default_rng(seed).normal(size=(n, 6))
+    tangent /= np.linalg.norm(tangent)
+    if cfg.chaos_indicators: tangent[:, 3:] *= np.array([b.mass for b in cfg.initial_bodies_data[:n]])[:, None]
+    tangent_buffer = (BodyDerivative * n).from_buffer_copy(tangent.astype(FLOAT_CTYPES[cfg.precision]))
+    return structs['VariationalWorkspace'](tangent=ctypes.cast(tangent_buffer, ctypes.POINTER(BodyDerivative)),
+                                           tangent_force=ctypes.cast((BodyDerivative * n)(), ctypes.POINTER(BodyDerivative)),
+                                           time=0.0, log_growth=0.0, megno_sum=0.0, megno_mean_sum=0.0,
+                                           frame_indicators=ctypes.cast((FLOAT_CTYPES[cfg.precision] * 1)(), ctypes.POINTER(FLOAT_CTYPES[cfg.precision])))
+
+def make_integrator_buffers(structs, cfg: SolarSystemConfig):
+    # Every integrator needs one derivative buffer; RK4 and Dormand-Prince need the rest of the scratch space too
+    BodyDerivativeArray = structs['BodyDerivative'] * cfg.current_n_bodies
+    k1_buffer = BodyDerivativeArray()
+    k2_buffer, k3_buffer, k4_buffer, intermediate_states_buffer_rk4 = (None,)*4
+    if cfg.integrator in ('rk4', 'dopri5'):
         k2_buffer = BodyDerivativeArray()
         k3_buffer = BodyDerivativeArray()
         k4_buffer = BodyDerivativeArray()
-        intermediate_states_buffer_rk4 = BodyStateArray()
-
-    for i in range(cfg.current_n_bodies):
-        p_data = cfg.initial_bodies_data[i] 
-        current_body_states[i].mass = p_data.mass 
-        current_body_states[i].inv_mass = 1.0 / p_data.mass if p_data.mass > 1e-20 else 0.0
-        pos_tuple, vel_tuple = p_data.pos, p_data.vel 
-        if len(pos_tuple)<3 or len(vel_tuple)<3: logging.error(f"Body {p_data.name} bad pos/vel for 3D."); continue
-        current_body_states[i].pos = VecND(x=pos_tuple[0], y=pos_tuple[1], z=pos_tuple[2])
-        current_body_states[i].mom = VecND(x=vel_tuple[0]*p_data.mass, y=vel_tuple[1]*p_data.mass, z=vel_tuple[2]*p_data.mass)
-
-    def get_next_states_closure(frames_to_generate_per_call):
-        sim_conf_loma = SimConfigLoma(G=G_val, dt=(cfg.years_per_frame/cfg.sim_steps_per_frame), 
-                                        epsilon_sq=cfg.epsilon**2, num_bodies=cfg.current_n_bodies)
-        res_list = []
-        for _ in range(frames_to_generate_per_call):
-            res_list.append(utils.convert_ctype_state_to_body_state(current_body_states, cfg))
-            for _s in range(cfg.sim_steps_per_frame):
-                if cfg.integrator == 'rk4':
-                    lib.time_step_system_rk4(current_body_states, sim_conf_loma, next_body_states_buffer,
-                                             k1_buffer, k2_buffer, k3_buffer, k4_buffer, intermediate_states_buffer_rk4)
-                else: # Default to Symplectic Euler
-                    lib.time_step_system(current_body_states, sim_conf_loma, next_body_states_buffer)
-                ctypes.memmove(ctypes.addressof(current_body_states), ctypes.addressof(next_body_states_buffer), ctypes.sizeof(BodyStateArray))
-        return res_list
-    return get_next_states_closure
\ No newline at end of file
+        intermediate_states_buffer_rk4 = (structs['BodyState'] * cfg.current_n_bodies)()
+    return k1_buffer, k2_buffer, k3_buffer, k4_buffer, intermediate_states_buffer_rk4
+
+class SimulationRunner:
+    """ Steps one system through the native frame driver. Calling it with a frame count returns
+        the positions of every body at each new frame; the state between calls lives in loma buffers. """
+    def __init__(self, cfg: SolarSystemConfig, structs, lib, checkpoint_dir: Optional[str] = None, checkpoint_every: int = 0):
+        self.structs, self.lib = structs, lib
+        self.initial_cfg = cfg
+        self.checkpoint_dir, self.checkpoint_every = checkpoint_dir, checkpoint_every
+        self.checkpoints = {} # Frame -> checkpoint file, written by save_checkpoint
+        self.collisions = [] # Every contact so far as {'frame', 'bodies', 'outcome'}
+        self.diagnostics = None # (frames, DIAGNOSTIC_FIELDS) of the latest call if cfg.diagnostics
+        self.chaos = None # (frames, CHAOS_FIELDS) after each frame of the latest call if cfg.chaos_indicators
+        self.body_ids = np.arange(cfg.current_n_bodies) # Body of initial_cfg in each slot of the loma buffers
+        states = (structs['BodyState'] * cfg.current_n_bodies)()
+        load_initial_states(structs, cfg, states)
+        self._reset(cfg, states, 0)
+
+    def _reset(self, cfg: SolarSystemConfig, states, frame: int, adaptive_dt: float = 0.0):
+        # State and scratch buffers are sized to the actual body count
+        self.cfg, self.states, self.frame = cfg, states, frame
+        self.collisions = [c for c in self.collisions if c['frame'] < frame] # Seeking back forgets the contacts to be replayed
+        self.next_states = (self.structs['BodyState'] * cfg.current_n_bodies)()
+        self.k1, self.k2, self.k3, self.k4, self.intermediate_states = make_integrator_buffers(self.structs, cfg)
+        self.ws = make_force_workspace(self.structs, cfg)
+        self.aws = make_adaptive_workspace(self.structs, cfg)
+        self.aws.dt = adaptive_dt # Dormand-Prince carries its last step size over between calls
+        self.cws = make_collision_workspace(self.structs, cfg)
+        self.vws = make_variational_workspace(self.structs, cfg) # A reset reseeds the tangent, so the indicators restart
+
+    def _advance(self, n_frames: int, record: bool):
+        cfg = self.cfg
+        # One native call runs the whole chunk; positions at every frame boundary come back in a flat buffer
+        frame_positions = (FLOAT_CTYPES[cfg.precision] * (n_frames * cfg.current_n_bodies * 3 if record else 1))()
+        record_diagnostics = record and cfg.diagnostics
+        frame_diagnostics = (FLOAT_CTYPES[cfg.precision] * (n_frames * len(DIAGNOSTIC_FIELDS) if record_diagnostics else 1))()
+        frame_chaos = (FLOAT_CTYPES[cfg.precision] * (n_frames * len(CHAOS_FIELDS) if cfg.chaos_indicators else 1))()
+        self.vws.frame_indicators = ctypes.cast(frame_chaos, ctypes.POINTER(FLOAT_CTYPES[cfg.precision]))
+        self.cws.num_events = 0
+        self.lib.advance_frames(self.states, self.next_states, make_sim_config(self.structs, cfg),
+                                n_frames, cfg.sim_steps_per_frame, int(record), frame_positions,
+                                int(record_diagnostics), frame_diagnostics, self.k1, self.k2, self.k3, self.k4, self.intermediate_states,
+                                ctypes.byref(self.ws), ctypes.byref(self.aws), ctypes.byref(self.cws), ctypes.byref(self.vws))
+        # Spread over the slots of initial_cfg's bodies, so bodies keep their index after mergers compact the buffers
+        n_initial = self.initial_cfg.current_n_bodies
+        positions = np.full((n_frames if record else 0, n_initial, 3), np.nan, dtype=np.float64 if cfg.precision == 'double' else np.float32)
+        present = np.zeros((n_frames if record else 0, n_initial), dtype=bool)
+        if record:
+            positions[:, self.body_ids] = np.ctypeslib.as_array(frame_positions).reshape(n_frames, cfg.current_n_bodies, 3)
+            present[:, self.body_ids] = True
+        if record_diagnostics:
+            self.diagnostics = np.ctypeslib.as_array(frame_diagnostics).reshape(n_frames, len(DIAGNOSTIC_FIELDS))
+        if record and cfg.chaos_indicators:
+            self.chaos = np.ctypeslib.as_array(frame_chaos).reshape(n_frames, len(CHAOS_FIELDS))
+        frames_done, self.frame = self.frame, self.frame + n_frames
+        if self.cws.num_events == 0: return positions, present
+
+        merged_at = {} # Body index -> last frame it appears in
+        for e in range(min(self.cws.num_events, self.cws.max_events)):
+            i, j, frame = self.cws.event_i[e], self.cws.event_j[e], self.cws.event_frame[e]
+            names = (cfg.initial_bodies_data[i].name, cfg.initial_bodies_data[j].name)
+            self.collisions.append({'frame': frames_done + frame, 'bodies': names, 'outcome': cfg.collisions})
+            logging.info(f"Collision ({cfg.collisions}) of {names[0]} and {names[1]} in frame {frames_done + frame}")
+            if self.states[j].radius < 0.0: merged_at.setdefault(j, frame)
+        if self.cws.num_events > self.cws.max_events:
+            logging.warning(f"{self.cws.num_events - self.cws.max_events} more collisions in this call were not logged")
+        if not merged_at: return positions, present
+
+        # Merged bodies leave the frames after their merger, and every buffer shrinks to the survivors
+        for k, frame in merged_at.items():
+            positions[frame + 1:, self.body_ids[k]] = np.nan
+            present[frame + 1:, self.body_ids[k]] = False
+        self.body_ids = self.body_ids[[k for k in range(cfg.current_n_bodies) if self.states[k].radius >= 0.0]]
+        self._reset(*compact_merged_bodies(self.structs, cfg, self.states), self.frame, self.aws.dt)
+        return positions, present
+
+    def advance(self, n_frames: int):
+        """ Advances n_frames and returns the positions at the start of each frame as a (frames, N, 3) array over
+            the N bodies of initial_cfg, in the runner's precision, with the (frames, N) mask of the bodies present.
+            A body merged away is NaN and masked off from the frame after its merger. """
+        if not self.checkpoint_every or n_frames <= 0: return self._advance(n_frames, True)
+        # Split the call at every checkpoint_every-th frame so each checkpoint lands on its exact frame
+        chunks, done = [], 0
+        while done < n_frames:
+            n = min(n_frames - done, self.checkpoint_every - self.frame % self.checkpoint_every)
+            chunks.append(self._advance(n, True))
+            done += n
+            if self.frame % self.checkpoint_every == 0:
+                self.save_checkpoint(os.path.join(self.checkpoint_dir, f"frame_{self.frame:08d}.ckpt"))
+        return np.concatenate([p for p, _ in chunks]), np.concatenate([m for _, m in chunks])
+
+    def __call__(self, frames_to_generate_per_call: int):
+        return utils.convert_positions_to_body_states(*self.advance(frames_to_generate_per_call), self.initial_cfg)
+
+    def memory_bytes(self) -> int:
+        """ Bytes held by the runner's loma buffers and workspaces and by its latest recorded arrays """
+        buffers = [b for b in (self.states, self.next_states, self.k1, self.k2, self.k3, self.k4, self.intermediate_states,
+                               self.ws, self.aws, self.cws, self.vws) if b is not None]
+        return utils.ctypes_nbytes(*buffers) + sum(a.nbytes for a in (self.diagnostics, self.chaos) if a is not None)
+
+    def save_checkpoint(self, path: str) -> str:
+        """ Writes the current states and everything needed to resume from them to path """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        BodyStateLoma = self.structs['BodyState']
+        checkpoint.write_checkpoint(path, self.cfg, self.states, {
+            'frame': self.frame, 'time_years': self.frame * self.cfg.years_per_frame, 'adaptive_dt': self.aws.dt, 'body_ids': self.body_ids.tolist(),
+            'body_state_fields': [name for name, _ in BodyStateLoma._fields_], 'body_state_size': ctypes.sizeof(BodyStateLoma)})
+        self.checkpoints[self.frame] = path
+        return path
+
+    def restore_checkpoint(self, path: str):
+        """ Resumes from the checkpoint at path, which must come from code compiled at the same precision """
+        cfg, meta, states_view = checkpoint.read_checkpoint(path)
+        BodyStateLoma = self.structs['BodyState']
+        if cfg.precision != self.cfg.precision:
+            raise ValueError(f"{path} holds {cfg.precision} precision states, this runner is {self.cfg.precision}")
+        if meta['body_state_fields'] != [name for name, _ in BodyStateLoma._fields_] or meta['body_state_size'] != ctypes.sizeof(BodyStateLoma):
+            raise ValueError(f"{path} was written by an incompatible BodyState layout")
+        states = (BodyStateLoma * cfg.current_n_bodies).from_buffer_copy(states_view)
+        self._reset(cfg, states, meta['frame'], meta['adaptive_dt'])
+        self.body_ids = np.array(meta['body_ids'])
+        self.checkpoints[self.frame] = path
+
+    def _advance_steps(self, states, conf, n_steps: int):
+        # n_steps integrator steps of dt on states in place, without touching the runner's own states or tangent
+        if n_steps > 0:
+            no_output = (FLOAT_CTYPES[self.cfg.precision] * 1)()
+            conf.variational = 0
+            self.lib.advance_frames(states, self.next_states, conf, 1, n_steps, 0, no_output, 0, no_output,
+                                    self.k1, self.k2, self.k3, self.k4, self.intermediate_states,
+                                    ctypes.byref(self.ws), ctypes.byref(self.aws), ctypes.byref(self.cws), ctypes.byref(self.vws))
+
+    def _reverse_steps(self, states, conf, n_steps: int, snapshots: int, adj, scratch, vjp):
+        # Pulls adj back through the n_steps after states, keeping at most snapshots more copies of the states.
+        # Each split reverses its later part first; the earlier parts wait in pending, newest last.
+        pending = []
+        while True:
+            if n_steps == 1:
+                self.lib.step_adjoint(states, conf, adj, scratch, self.k1, vjp, ctypes.byref(self.ws))
+            elif snapshots == 0:
+                for k in reversed(range(n_steps)):
+                    work = type(states).from_buffer_copy(states)
+                    self._advance_steps(work, conf, k)
+                    self.lib.step_adjoint(work, conf, adj, scratch, self.k1, vjp, ctypes.byref(self.ws))
+            else:
+                m = binomial_split(n_steps, snapshots)
+                mid = type(states).from_buffer_copy(states)
+                self._advance_steps(mid, conf, m)
+                pending.append((states, m, snapshots))
+                states, n_steps, snapshots = mid, n_steps - m, snapshots - 1
+                continue
+            if not pending: return
+            states, n_steps, snapshots = pending.pop()
+
+    def trajectory_gradient(self, n_steps: int, objective, max_snapshots: int = SENSITIVITY_SNAPSHOTS):
+        """ Reverse-mode gradient of a function of the state n_steps integrator steps of dt after the current one.
+            objective(pos, vel) gets the final (N, 3) positions and velocities and returns (value, d_pos, d_vel),
+            its value and gradient. Returns (value, d_pos, d_vel) with the gradient taken with respect to the
+            current positions and velocities. The runner itself does not move. Binomial checkpointing keeps at
+            most max_snapshots states and recomputes the others from them. """
+        cfg = self.cfg
+        if cfg.integrator not in SENSITIVITY_INTEGRATORS or cfg.force_method != 'direct' or cfg.collisions != 'none':
+            raise ValueError(f"Trajectory gradients need integrator in {SENSITIVITY_INTEGRATORS}, force_method 'direct' and no collisions")
+        conf = make_sim_config(self.structs, cfg)
+        final = type(self.states).from_buffer_copy(self.states)
+        self._advance_steps(final, conf, n_steps)
+        soa = utils.body_states_to_soa(final, cfg.current_n_bodies)
+        pos = np.stack([soa['x'], soa['y'], soa['z']], axis=1).astype(np.float64)
+        vel = np.stack([soa['px'], soa['py'], soa['pz']], axis=1) * soa['inv_mass'][:, None]
+        value, d_pos, d_vel = objective(pos, vel)
+
+        # The adjoint of the final momenta is dL/dv / m; it ends as dL/dp of the initial state, i.e. dL/dv0 / m
+        DerivArray = self.structs['BodyDerivative'] * cfg.current_n_bodies
+        adj_array = np.zeros((cfg.current_n_bodies, 6))
+        adj_array[:, :3], adj_array[:, 3:] = d_pos, np.asarray(d_vel) * soa['inv_mass'][:, None]
+        adj = DerivArray.from_buffer_copy(adj_array.astype(FLOAT_CTYPES[cfg.precision]))
+        start = type(self.states).from_buffer_copy(self.states)
+        if n_steps > 0:
+            self._reverse_steps(start, conf, n_steps, max(max_snapshots, 0), adj, type(self.states)(), DerivArray())
+        adj_array = np.frombuffer(adj, dtype=FLOAT_CTYPES[cfg.precision]).reshape(-1, 6).astype(np.float64)
+        return value, adj_array[:, :3], adj_array[:, 3:] * soa['mass'][:, None]
+
+    def trajectory_jacobian(self, n_steps: int, max_snapshots: int = SENSITIVITY_SNAPSHOTS) -> np.ndarray:
+        """ d(state n_steps later)/d(current state) as a (6N, 6N) array, each state flattened body by body
+            as (x, y, z, vx, vy, vz). Takes one trajectory_gradient per row, so it suits small N. """
+        n = self.cfg.current_n_bodies
+        jacobian = np.zeros((6 * n, 6 * n))
+        for row in range(6 * n):
+            seed = np.zeros((n, 6)); seed.flat[row] = 1.0
+            _, d_pos, d_vel = self.trajectory_gradient(n_steps, lambda pos, vel: (0.0, seed[:, :3], seed[:, 3:]), max_snapshots)
+            jacobian[row] = np.concatenate([d_pos, d_vel], axis=1).ravel()
+        return jacobian
+
+    @classmethod
+    def from_checkpoint(cls, path: str, checkpoint_dir: Optional[str] = None, checkpoint_every: int = 0):
+        """ Compiles the loma code for the checkpoint's config and returns a runner resumed from it """
+        cfg, _, _ = checkpoint.read_checkpoint(path)
+        structs, lib = compile_loma_code(cfg.loma_code_file, COMPILED_LIB_NAME_PREFIX_3D, cfg.precision)
+        if not structs or not lib: raise RuntimeError(f"Failed to compile {cfg.loma_code_file}")
+        runner = cls(cfg, structs, lib, checkpoint_dir, checkpoint_every)
+        runner.restore_checkpoint(path)
+        runner.body_ids = np.arange(cfg.current_n_bodies) # Its initial_cfg holds the checkpoint's bodies
+        return runner
+
+    def seek(self, frame: int):
+        """ Moves to frame, restarting from the nearest earlier checkpoint (or the initial state) when it lies behind """
+        if frame < self.frame:
+            earlier = [f for f in self.checkpoints if f <= frame]
+            if earlier: self.restore_checkpoint(self.checkpoints[max(earlier)])
+            else:
+                states = (self.structs['BodyState'] * self.initial_cfg.current_n_bodies)()
+                load_initial_states(self.structs, self.initial_cfg, states)
+                self._reset(self.initial_cfg, states, 0)
+                self.body_ids = np.arange(self.initial_cfg.current_n_bodies)
+        while self.frame < frame:
+            self._advance(min(frame - self.frame, SEEK_CHUNK_FRAMES), False)
+
+def binomial_split(n_steps: int, snapshots: int) -> int:
+    """ Steps to advance before storing the next snapshot when reversing n_steps with that many free
+        snapshots. With the smallest r such that comb(snapshots + r, r) >= n_steps, the split leaves
+        both halves reversible with at most r recomputations of any step (Griewank's binomial checkpointing). """
+    reps = 0
+    while math.comb(snapshots + reps, reps) < n_steps: reps += 1
+    return max(1, min(math.comb(snapshots + reps - 1, reps - 1), n_steps - 1))
+
+def get_simulation_runner(cfg: SolarSystemConfig, checkpoint_dir: Optional[str] = None, checkpoint_every: int = 0):
+    structs, lib = compile_loma_code(cfg.loma_code_file, COMPILED_LIB_NAME_PREFIX_3D, cfg.precision)
+    if not structs or not lib: logging.error("Sim runner setup failed: no structs/lib."); return lambda _: []
+    return SimulationRunner(cfg, structs, lib, checkpoint_dir, checkpoint_every)
+
+def make_perturbed_ensemble(cfg: SolarSystemConfig, n_members: int, pos_sigma: float = 1e-6, vel_sigma: float = 0.0, seed: int = 0) -> List[List[BodyState]]:
+    """ n_members copies of cfg's bodies, each position and velocity component shifted by
+        independent Gaussian noise of pos_sigma (AU) and vel_sigma (AU/year) """
+    rng = np.random.default_rng(seed)
+    ensemble = []
+    for _ in range(n_members):
+        ensemble.append([dataclasses.replace(b, pos=tuple(np.asarray(b.pos) + rng.normal(0.0, pos_sigma, 3)),
+                                             vel=tuple(np.asarray(b.vel) + rng.normal(0.0, vel_sigma, 3)))
+                         for b in cfg.initial_bodies_data[:cfg.current_n_bodies]])
+    return ensemble
+
+def make_grid_ensemble(cfg: SolarSystemConfig, body: int, positions: np.ndarray, velocities: np.ndarray) -> List[List[BodyState]]:
+    """ One copy of cfg's bodies per row of positions and velocities ((M, 3) each, AU and AU/year), with
+        that row as body's initial position and velocity. Rows of a flattened grid of initial conditions,
+        run with cfg.chaos_indicators, give a stability map. """
+    ensemble = []
+    for pos, vel in zip(np.asarray(positions, dtype=float), np.asarray(velocities, dtype=float)):
+        bodies = list(cfg.initial_bodies_data[:cfg.current_n_bodies])
+        bodies[body] = dataclasses.replace(bodies[body], pos=tuple(pos), vel=tuple(vel))
+        ensemble.append(bodies)
+    return ensemble
+
+def get_ensemble_runner(cfg: SolarSystemConfig, member_bodies: List[List[BodyState]], num_threads: Optional[int] = None):
+    """ Steps one system per entry of member_bodies (each with cfg.current_n_bodies bodies) under cfg's
+        settings through the advance_ensemble SIMD kernel, with the members split into contiguous
+        ranges across num_threads threads (default: one per core). The returned closure advances
+        every member by the given number of frames and returns their positions at the start of each
+        frame as an (M, frames, N, 3) array. Members keep all N slots, so a body merged away by
+        cfg.collisions stays where it merged. With cfg.diagnostics, the closure's diagnostics
+        attribute holds the latest (M, frames, DIAGNOSTIC_FIELDS) array alongside, and with
+        cfg.chaos_indicators its chaos attribute the (M, frames, CHAOS_FIELDS) after each frame. """
+    structs, lib = compile_loma_code(cfg.loma_code_file, COMPILED_LIB_NAME_PREFIX_3D, cfg.precision)
+    if not structs or not lib: logging.error("Ensemble runner setup failed: no structs/lib."); return None
+
+    EnsembleMember = structs['EnsembleMember']
+    n_members, n_bodies = len(member_bodies), cfg.current_n_bodies
+    members = (EnsembleMember * n_members)()
+    buffers = [] # Keeps every member's buffers alive alongside the pointers in members
+    for m, bodies in enumerate(member_bodies):
+        member_cfg = dataclasses.replace(cfg, initial_bodies_data=bodies)
+        states, scratch_states = (structs['BodyState'] * n_bodies)(), (structs['BodyState'] * n_bodies)()
+        load_initial_states(structs, member_cfg, states)
+        k1, k2, k3, k4, intermediate_states = make_integrator_buffers(structs, member_cfg)
+        members[m].states, members[m].scratch_states = states, scratch_states
+        members[m].k1, members[m].k2, members[m].k3, members[m].k4 = k1, k2, k3, k4
+        members[m].intermediate_states = intermediate_states
+        members[m].ws, members[m].aws = make_force_workspace(structs, member_cfg), make_adaptive_workspace(structs, member_cfg)
+        members[m].cws = make_collision_workspace(structs, member_cfg)
+        members[m].vws = make_variational_workspace(structs, member_cfg)
+        buffers.append((states, scratch_states, k1, k2, k3, k4, intermediate_states))
+
+    num_threads = max(1, min(num_threads or os.cpu_count() or 1, n_members))
+    bounds = np.linspace(0, n_members, num_threads + 1).astype(int)
+    c_float = FLOAT_CTYPES[cfg.precision]
+    np_float = np.float64 if cfg.precision == 'double' else np.float32
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+
+    def run_range(start: int, stop: int, sim_conf, frames: int):
+        # ctypes releases the GIL for the duration of the native call
+        members_range = ctypes.pointer(members[start]) # Indexing a ctypes array aliases its storage
+        lib.advance_ensemble(members_range, sim_conf, frames, cfg.sim_steps_per_frame, int(cfg.diagnostics), stop - start)
+
+    def get_next_positions_closure(frames_to_generate_per_call: int) -> np.ndarray:
+        sim_conf_loma = make_sim_config(structs, cfg)
+        # Every member records straight into its slice of the result
+        positions = np.zeros((n_members, frames_to_generate_per_call, n_bodies, 3), dtype=np_float)
+        diagnostics = np.zeros((n_members, frames_to_generate_per_call if cfg.diagnostics else 1, len(DIAGNOSTIC_FIELDS)), dtype=np_float)
+        chaos = np.zeros((n_members, frames_to_generate_per_call if cfg.chaos_indicators else 1, len(CHAOS_FIELDS)), dtype=np_float)
+        for m in range(n_members):
+            members[m].frame_positions = positions[m].ctypes.data_as(ctypes.POINTER(c_float))
+            members[m].frame_diagnostics = diagnostics[m].ctypes.data_as(ctypes.POINTER(c_float))
+            members[m].vws.frame_indicators = chaos[m].ctypes.data_as(ctypes.POINTER(c_float))
+        futures = [executor.submit(run_range, bounds[t], bounds[t + 1], sim_conf_loma, frames_to_generate_per_call)
+                   for t in range(num_threads) if bounds[t + 1] > bounds[t]]
+        for future in futures: future.result()
+        get_next_positions_closure.diagnostics = diagnostics if cfg.diagnostics else None
+        get_next_positions_closure.chaos = chaos if cfg.chaos_indicators else None
+        return positions
+    get_next_positions_closure.buffers = buffers
+    get_next_positions_closure.diagnostics = None
+    get_next_positions_closure.chaos = None
+    return get_next_positions_closure
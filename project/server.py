@@ -1,12 +1,19 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
 import uuid
-from planetary_motion import setup_jupiter_system_scenario, setup_true_chaotic_scenario, setup_solar_system_scenario, get_simulation_runner, LOMA_CODE_3D_FILENAME, BodyState, SolarSystemConfig
+import base64
+import atexit
+from planetary_motion import setup_jupiter_system_scenario, setup_true_chaotic_scenario, setup_solar_system_scenario, LOMA_CODE_3D_FILENAME, DIAGNOSTIC_FIELDS, CHAOS_FIELDS, BodyState, SolarSystemConfig, check_chaos_indicators
 from config import BodyState, SolarSystemConfig
+from frame_producer import DEFAULT_HIGH_WATER
+from session_manager import SessionManager
+from session_pool import SessionPool
 import random
 import os
 import json
 import logging
 import math
+import struct
+import numpy as np
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -14,13 +21,181 @@ app.logger.setLevel(logging.INFO)
 
 # Base directory of the script
 script_dir = os.path.dirname(os.path.realpath(__file__))
+CHECKPOINT_DIR = os.path.join(script_dir, 'checkpoints')
+STATE_MAX_FRAMES = 30 # Frames per /state response; serializing them, not stepping, is now most of its latency
+# /state_binary response: this header, then float32 positions as [frame][body][xyz] over the bodies of the session's
+# system_config (NaN for a body merged away). Its frames are cheap to send, so it hands over all that are ready.
+STATE_MAGIC = b'LOMF'
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct('<4sIIII') # Magic, version, first frame, frames, bodies
+STREAM_WINDOW_FRAMES = DEFAULT_HIGH_WATER # Frames /stream runs ahead of the client's last /ack unless it asks for another window
+STREAM_KEEPALIVE_SECONDS = 15.0 # Longest silence on /stream; a comment line then keeps proxies from closing it
 
 current_session = None
-sessions = {}
+sessions = SessionManager(checkpoint_dir=CHECKPOINT_DIR) # Evicts idle and least recently used sessions to bound the server's memory
+pool = SessionPool() # Runs every session in one of a worker process per core
+atexit.register(pool.close) # Stops the sessions, which frees their shared blocks, before the daemonic workers are killed
 
 # Physical Constants
 KG_PER_SOLAR_MASS = 1.98847e30
 
+# The work behind the routes, shared with the asyncio server in asgi_server.py. These block on the
+# simulation or the disk, so that server runs them on its dispatch threads.
+def scenario_config(simulation_name: str):
+    # The built-in scenario /init_session asks for by name, or None if there is no such scenario
+    setups = {"jupiterchaotic": setup_jupiter_system_scenario, "solarsys": setup_solar_system_scenario,
+              "trulychaotic": setup_true_chaotic_scenario}
+    return setups[simulation_name]() if simulation_name in setups else None
+
+def chaos_config(cfg: SolarSystemConfig):
+    # The variational step has no adaptive form, so a session with chaos indicators on steps a dopri5 scenario, such
+    # as trulychaotic, with leapfrog at its sim_steps_per_frame. Raises ValueError if it still cannot record them.
+    if cfg.chaos_indicators and cfg.integrator == 'dopri5': cfg.integrator = 'leapfrog'
+    check_chaos_indicators(cfg)
+
+def start_session(open_session):
+    # Opens a producer with open_session(new_id) and registers it as a session; returns its id and producer
+    global current_session
+    new_id = str(uuid.uuid4())
+    sim_runner = open_session(new_id)
+    sessions[new_id] = sim_runner
+    current_session = sim_runner
+    return new_id, sim_runner
+
+def check_frames(new_states, session_id: str):
+    # The /state error payload if the drained frames are malformed or hold a NaN position, else None
+    for frame_idx, frame_data in enumerate(new_states):
+        if not isinstance(frame_data, list):
+            app.logger.error(f"get_state: Frame {frame_idx} is not a list for session {session_id}.")
+            return {"error": "Malformed frame data from simulation."}
+        for body_idx, body_state_obj in enumerate(frame_data):
+            if not hasattr(body_state_obj, 'pos') or not isinstance(body_state_obj.pos, tuple):
+                app.logger.error(f"get_state: Body {body_idx} in frame {frame_idx} has malformed position for session {session_id}.")
+                return {"error": "Malformed body state data from simulation."}
+            if any(math.isnan(p_comp) for p_comp in body_state_obj.pos):
+                body_name = getattr(body_state_obj, 'name', f'UnknownBody{body_idx}')
+                error_msg = f"NaN detected in position for body '{body_name}' in frame {frame_idx}. Position: {body_state_obj.pos}"
+                app.logger.error(f"get_state: {error_msg} for session {session_id}")
+                return {"error": "Simulation produced NaN values.", "details": error_msg}
+    return None
+
+def pack_frames(first_frame, positions, present) -> bytes:
+    # The /state_binary payload of drained frames; raises ValueError if a body still present has a NaN position
+    if np.isnan(positions[present]).any():
+        frame, body = np.argwhere(np.isnan(positions).any(axis=2) & present)[0]
+        raise ValueError(f"NaN detected in position for body {body} in frame {first_frame + frame}")
+    header = STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, first_frame, positions.shape[0], positions.shape[1])
+    return header + positions.astype('<f4').tobytes()
+
+def stream_event(producer, window: int, session_id: str, allowed: int = None):
+    # The next /stream event, waiting up to STREAM_KEEPALIVE_SECONDS for frames the window allows (or
+    # taking allowed frames if the caller already waited), and whether it ends the stream. Frames, a
+    # keepalive comment, or a sim_error event that ends it.
+    try:
+        if allowed is None: allowed = producer.wait_for_window(window, STREAM_KEEPALIVE_SECONDS)
+        if producer.stopped and not allowed:
+            if producer.error is not None: raise producer.error
+            return None, True
+        frames = producer.drain_positions(allowed, STREAM_KEEPALIVE_SECONDS) if allowed else None
+    except Exception as e:
+        app.logger.error(f"stream_state: {e} for session {session_id}")
+        return f"event: sim_error\ndata: {json.dumps({'error': str(e)})}\n\n", True
+    if not frames or len(frames[1]) == 0:
+        return ": keepalive\n\n", False
+    try:
+        payload = pack_frames(*frames)
+    except ValueError as e:
+        return f"event: sim_error\ndata: {json.dumps({'error': 'Simulation produced NaN values.', 'details': str(e)})}\n\n", True
+    return f"event: frames\ndata: {base64.b64encode(payload).decode('ascii')}\n\n", False
+
+def checkpoint_file(name: str):
+    # Path of the checkpoint /checkpoint saved as name, or None if the name has nothing usable in it
+    sane_name = "".join(c for c in name if c.isalnum() or c in ('_', '-')).strip()
+    return os.path.join(CHECKPOINT_DIR, f"{sane_name}.ckpt") if sane_name else None
+
+def scenario_file(name: str):
+    # Path of the scenario saved as name, or None if the name has nothing usable in it
+    sane_name = "".join(c for c in name if c.isalnum() or c in (' ', '_', '-')).strip()
+    return os.path.join(script_dir, 'scenarios', f"{sane_name}.json") if sane_name else None
+
+def save_scenario_file(data) -> str:
+    # Writes a scenario from the builder with masses converted to solar masses; raises ValueError if it is invalid
+    if not data or 'name' not in data or 'planets' not in data:
+        raise ValueError('Missing fields')
+    for p in data['planets']:
+        if 'mass' not in p or not isinstance(p['mass'], (int, float)) or float(p['mass']) <= 0:
+            raise ValueError(f"Invalid mass for planet {p.get('name')}")
+        p['mass'] = float(p['mass']) / KG_PER_SOLAR_MASS
+    path = scenario_file(data['name'])
+    if not path: raise ValueError('Invalid scenario name')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f: json.dump(data, f, indent=2)
+    return os.path.splitext(os.path.basename(path))[0]
+
+def scenario_summaries():
+    scenario_dir = os.path.join(script_dir, 'scenarios')
+    scenarios = []
+    if os.path.exists(scenario_dir):
+        for fn in os.listdir(scenario_dir):
+            if fn.endswith('.json'):
+                try:
+                    with open(os.path.join(scenario_dir, fn), 'r') as f: 
+                        data = json.load(f)
+                        if 'name' in data and 'planets' in data:
+                            scenarios.append({
+                                'name': data['name'],
+                                'filename': os.path.splitext(fn)[0],
+                                'planet_count': len(data['planets'])
+                            })
+                except Exception as e:
+                    app.logger.error(f"Err processing {fn}: {e}")
+    return scenarios
+
+def load_scenario_config(scenario_data) -> SolarSystemConfig:
+    # The SolarSystemConfig of a scenario file's contents
+    initial_bodies = []
+    for p in scenario_data.get('planets', []):
+        pos_tuple = (p['pos']['x'], p['pos']['y'], p['pos']['z'])
+        vel_tuple = (p['vel']['x'], p['vel']['y'], p['vel']['z'])
+        initial_bodies.append(BodyState(
+            name=p.get('name'),
+            mass=p.get('mass'),
+            pos=pos_tuple,
+            vel=vel_tuple,
+            color=p.get('color'),
+            radius=p.get('radius'),
+            collision_radius=p.get('collision_radius')
+        ))
+    
+    loaded_cfg_dict = {
+        'name': f"Loaded: {scenario_data.get('name', 'Unnamed')}",
+        'current_n_bodies': len(initial_bodies),
+        'epsilon': scenario_data.get('epsilon', 0.005),
+        'years_per_frame': scenario_data.get('years_per_frame', 0.005),
+        'fps': scenario_data.get('fps', 60),
+        'sim_steps_per_frame': scenario_data.get('sim_steps_per_frame', 512),
+        'initial_bodies_data': initial_bodies,
+        'dimensions': 3,
+        'loma_code_file': LOMA_CODE_3D_FILENAME,
+        'integrator': scenario_data.get('integrator', 'rk4'), # Default loaded scenarios to rk4
+        'gradient_mode': scenario_data.get('gradient_mode', 'reverse'),
+        'force_method': scenario_data.get('force_method', 'direct'),
+        'theta': scenario_data.get('theta', 0.5),
+        'fmm_order': scenario_data.get('fmm_order', 4),
+        'fmm_leaf_size': scenario_data.get('fmm_leaf_size', 16),
+        'tolerance': scenario_data.get('tolerance', 1e-8),
+        'layout': scenario_data.get('layout', 'aos'),
+        'max_block_level': scenario_data.get('max_block_level', 10),
+        'block_eta': scenario_data.get('block_eta', 0.005),
+        'test_particle_mass': scenario_data.get('test_particle_mass', 0.0),
+        'collisions': scenario_data.get('collisions', 'none'),
+        'restitution': scenario_data.get('restitution', 1.0),
+        'diagnostics': scenario_data.get('diagnostics', False),
+        'chaos_indicators': scenario_data.get('chaos_indicators', False),
+        'precision': scenario_data.get('precision', 'single')
+    }
+    return SolarSystemConfig(**loaded_cfg_dict)
+
 @app.route("/")
 def index(): return render_template("index.html")
 
@@ -32,29 +207,21 @@ def conversions(): return render_template("conversions.html")
 
 @app.route("/init_session", methods=['POST'])
 def init_session():
-    global current_session 
     try:
         data = request.get_json()
         simulation_name = data['simulation_name']
         app.logger.info(f"init_session: Initializing: {simulation_name}")
-        cfg = None
-        if simulation_name == "jupiterchaotic":
-            cfg = setup_jupiter_system_scenario() 
-        elif simulation_name == "solarsys":
-            cfg = setup_solar_system_scenario()
-        elif simulation_name == "trulychaotic":
-            cfg = setup_true_chaotic_scenario()
-        else:
+        cfg = scenario_config(simulation_name)
+        if not cfg:
             app.logger.error(f"init_session: Unknown simulation: {simulation_name}")
             return jsonify({"error": f"Unknown simulation: {simulation_name}"}), 400
 
-        if not cfg: return jsonify({"error": "Failed to setup config"}), 500
-        new_id = str(uuid.uuid4())
-        sim_runner = get_simulation_runner(cfg)
-        if not sim_runner or sim_runner == (lambda _: []): 
-            return jsonify({"error": "Failed to init sim runner"}), 500
-        sessions[new_id] = sim_runner
-        current_session = sim_runner
+        cfg.diagnostics = bool(data.get('diagnostics', False))
+        cfg.chaos_indicators = bool(data.get('chaos_indicators', False))
+        try: chaos_config(cfg)
+        except ValueError as e: return jsonify({"error": str(e)}), 400
+        new_id, _ = start_session(lambda sid: pool.open(sid, cfg, high_water=int(data.get('high_water', DEFAULT_HIGH_WATER)),
+                                                        checkpoint_dir=os.path.join(CHECKPOINT_DIR, sid), checkpoint_every=int(data.get('checkpoint_every', 0))))
         return jsonify({"session_id": new_id, "system_config": cfg})
     except Exception as e:
         app.logger.exception("Error in init_session")
@@ -72,27 +239,130 @@ def get_state(session_id):
             app.logger.error(f"get_state: Invalid simulation runner for session ID: {session_id}")
             return jsonify({"error": "Invalid simulation runner"}), 500
             
-        new_states = sim_runner(30)
-        
-        for frame_idx, frame_data in enumerate(new_states):
-            if not isinstance(frame_data, list):
-                app.logger.error(f"get_state: Frame {frame_idx} is not a list for session {session_id}.")
-                return jsonify({"error": "Malformed frame data from simulation."}), 500
-            for body_idx, body_state_obj in enumerate(frame_data):
-                if not hasattr(body_state_obj, 'pos') or not isinstance(body_state_obj.pos, tuple):
-                    app.logger.error(f"get_state: Body {body_idx} in frame {frame_idx} has malformed position for session {session_id}.")
-                    return jsonify({"error": "Malformed body state data from simulation."}), 500
-                if any(math.isnan(p_comp) for p_comp in body_state_obj.pos):
-                    body_name = getattr(body_state_obj, 'name', f'UnknownBody{body_idx}')
-                    error_msg = f"NaN detected in position for body '{body_name}' in frame {frame_idx}. Position: {body_state_obj.pos}"
-                    app.logger.error(f"get_state: {error_msg} for session {session_id}")
-                    return jsonify({"error": "Simulation produced NaN values.", "details": error_msg}), 500
-            
+        # The session's worker computes frames ahead; hand over what is ready, up to STATE_MAX_FRAMES
+        new_states = sim_runner.drain(STATE_MAX_FRAMES)
+        problem = check_frames(new_states, session_id)
+        if problem: return jsonify(problem), 500
         return jsonify(new_states)
     except Exception as e:
         app.logger.exception(f"get_state: An error occurred for session ID: {session_id}")
         return jsonify({"error": str(e)}), 500
 
+@app.get("/state_binary/<session_id>")
+def get_state_binary(session_id):
+    # Same frames as /state, packed for a Float32Array; body names, masses and colors come once with system_config
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        payload = pack_frames(*sessions[session_id].drain_positions())
+        return Response(payload, mimetype='application/octet-stream')
+    except ValueError as e:
+        app.logger.error(f"get_state_binary: {e} for session {session_id}")
+        return jsonify({"error": "Simulation produced NaN values.", "details": str(e)}), 500
+    except Exception as e:
+        app.logger.exception(f"get_state_binary: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/stream/<session_id>")
+def stream_state(session_id):
+    # Server-sent events: every 'frames' event carries a /state_binary payload in base64, pushed as soon as the
+    # worker has frames, as long as fewer than ?window= frames are sent but not yet acknowledged through /ack
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    producer = sessions[session_id]
+    window = max(int(request.args.get('window', STREAM_WINDOW_FRAMES)), 1)
+
+    def events():
+        while sessions.get(session_id) is producer:
+            event, done = stream_event(producer, window, session_id)
+            if event: yield event
+            if done: return
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/ack/<session_id>", methods=['POST'])
+def ack_frames(session_id):
+    # {"frame": n}: the client has played up to frame n, so /stream may run further ahead
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        sessions[session_id].ack(int(request.get_json()['frame']))
+        return jsonify({"acked": sessions[session_id].acked})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.get("/diagnostics/<session_id>")
+def get_diagnostics(session_id):
+    # Conserved quantities at every frame of the latest /state call, for sessions started with diagnostics on
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    diagnostics = getattr(sessions[session_id], 'diagnostics', None)
+    if diagnostics is None:
+        return jsonify({"error": "No diagnostics recorded for this session"}), 404
+    return jsonify({"fields": list(DIAGNOSTIC_FIELDS), "frames": diagnostics.tolist()})
+
+@app.get("/chaos/<session_id>")
+def get_chaos(session_id):
+    # Lyapunov exponent and MEGNO at every frame of the latest /state call, for sessions started with chaos indicators on
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    chaos = getattr(sessions[session_id], 'chaos', None)
+    if chaos is None:
+        return jsonify({"error": "No chaos indicators recorded for this session"}), 404
+    return jsonify({"fields": list(CHAOS_FIELDS), "frames": chaos.tolist()})
+
+@app.route("/checkpoint/<session_id>", methods=['POST'])
+def save_checkpoint(session_id):
+    # Snapshots the session's current states; /restore/<name> resumes from them, even after a restart
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        # The runner stands past the frames already buffered, so the checkpoint is taken there
+        name, frame = sessions[session_id].save_checkpoint(CHECKPOINT_DIR, session_id)
+        return jsonify({"checkpoint": name, "frame": frame})
+    except Exception as e:
+        app.logger.exception(f"save_checkpoint: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/restore/<name>", methods=['POST'])
+def restore_checkpoint(name):
+    # Starts a new session from a checkpoint written by /checkpoint
+    path = checkpoint_file(name)
+    if not path or not os.path.exists(path): return jsonify({'error': 'Checkpoint not found'}), 404
+    try:
+        new_id, sim_runner = start_session(lambda sid: pool.restore(sid, path, checkpoint_dir=os.path.join(CHECKPOINT_DIR, sid)))
+        frame = sim_runner.frame
+        app.logger.info(f"Restored checkpoint '{name}' at frame {frame} into session {new_id}.")
+        return jsonify({'session_id': new_id, 'frame': frame, 'system_config': sim_runner.cfg})
+    except Exception as e:
+        app.logger.exception(f"Error restoring checkpoint {name}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route("/seek/<session_id>", methods=['POST'])
+def seek(session_id):
+    # Moves the session to {"frame": n}; the next /state call starts there, skipping ahead if it is already buffered
+    if session_id not in sessions:
+        return jsonify({"error": "Invalid session ID"}), 404
+    try:
+        frame = int(request.get_json()['frame'])
+        if frame < 0: return jsonify({"error": "Frame must not be negative"}), 400
+        sessions[session_id].seek(frame)
+        return jsonify({"frame": sessions[session_id].frame})
+    except Exception as e:
+        app.logger.exception(f"seek: An error occurred for session ID: {session_id}")
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/admin/sessions")
+def list_sessions():
+    # Session limits, evictions so far and every live session's idle time and memory
+    return jsonify(sessions.stats())
+
+@app.route("/admin/sessions/<session_id>", methods=['DELETE'])
+def close_session(session_id):
+    if not sessions.remove(session_id):
+        return jsonify({"error": "Invalid session ID"}), 404
+    return jsonify({"closed": session_id})
+
 @app.route('/add_planet', methods=['POST'])
 def add_planet():
     data = request.get_json()
@@ -101,91 +371,31 @@ def add_planet():
 
 @app.route('/save_scenario', methods=['POST'])
 def save_scenario():
-    data = request.get_json()
-    if not data or 'name' not in data or 'planets' not in data:
-        return jsonify({'error': 'Missing fields'}), 400
-        
-    for p in data['planets']:
-        if 'mass' not in p or not isinstance(p['mass'], (int, float)) or float(p['mass']) <= 0:
-            return jsonify({'error': f"Invalid mass for planet {p.get('name')}"}), 400
-        p['mass'] = float(p['mass']) / KG_PER_SOLAR_MASS
-            
-    scenario_dir = os.path.join(script_dir, 'scenarios')
-    if not os.path.exists(scenario_dir): os.makedirs(scenario_dir)
-    sane_name = "".join(c for c in data['name'] if c.isalnum() or c in (' ', '_', '-')).strip()
-    if not sane_name: return jsonify({'error': 'Invalid scenario name'}), 400
-    scenario_file = os.path.join(scenario_dir, f"{sane_name}.json")
-    with open(scenario_file, 'w') as f: json.dump(data, f, indent=2)
+    try:
+        sane_name = save_scenario_file(request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     app.logger.info(f"Scenario '{sane_name}' saved with mass converted to Solar Masses.")
     return jsonify({'message': 'Scenario saved successfully'}), 200
 
 @app.route('/list_scenarios')
 def list_scenarios():
-    scenario_dir = os.path.join(script_dir, 'scenarios')
-    scenarios = []
-    if os.path.exists(scenario_dir):
-        for fn in os.listdir(scenario_dir):
-            if fn.endswith('.json'):
-                try:
-                    with open(os.path.join(scenario_dir, fn), 'r') as f: 
-                        data = json.load(f)
-                        if 'name' in data and 'planets' in data:
-                            scenarios.append({
-                                'name': data['name'],
-                                'filename': os.path.splitext(fn)[0],
-                                'planet_count': len(data['planets'])
-                            })
-                except Exception as e:
-                    app.logger.error(f"Err processing {fn}: {e}")
-    return jsonify(scenarios)
+    return jsonify(scenario_summaries())
 
 @app.route('/load_scenario/<filename>')
 def load_scenario(filename):
-    global current_session
-    sane_name = "".join(c for c in filename if c.isalnum() or c in (' ', '_', '-')).strip()
-    if not sane_name: return jsonify({'error': 'Invalid scenario name'}), 400
-    
-    scenario_file = os.path.join(script_dir, 'scenarios', f"{sane_name}.json")
-    if not os.path.exists(scenario_file): return jsonify({'error': 'Scenario not found'}), 404
+    path = scenario_file(filename)
+    if not path: return jsonify({'error': 'Invalid scenario name'}), 400
+    if not os.path.exists(path): return jsonify({'error': 'Scenario not found'}), 404
 
     try:
-        with open(scenario_file, 'r') as f: scenario_data = json.load(f)
-        
-        initial_bodies = []
-        for p in scenario_data.get('planets', []):
-            pos_tuple = (p['pos']['x'], p['pos']['y'], p['pos']['z'])
-            vel_tuple = (p['vel']['x'], p['vel']['y'], p['vel']['z'])
-            initial_bodies.append(BodyState(
-                name=p.get('name'),
-                mass=p.get('mass'),
-                pos=pos_tuple,
-                vel=vel_tuple,
-                color=p.get('color'),
-                radius=p.get('radius')
-            ))
-        
-        loaded_cfg_dict = {
-            'name': f"Loaded: {scenario_data.get('name', 'Unnamed')}",
-            'current_n_bodies': len(initial_bodies),
-            'epsilon': scenario_data.get('epsilon', 0.005),
-            'years_per_frame': scenario_data.get('years_per_frame', 0.005),
-            'fps': scenario_data.get('fps', 60),
-            'sim_steps_per_frame': scenario_data.get('sim_steps_per_frame', 512),
-            'initial_bodies_data': initial_bodies,
-            'dimensions': 3,
-            'loma_code_file': LOMA_CODE_3D_FILENAME,
-            'integrator': scenario_data.get('integrator', 'rk4') # Default loaded scenarios to rk4
-        }
-        loaded_cfg = SolarSystemConfig(**loaded_cfg_dict)
-        
-        new_id = str(uuid.uuid4())
-        sim_runner = get_simulation_runner(loaded_cfg)
-        if not sim_runner or sim_runner == (lambda _: []):
-            return jsonify({'error': 'Failed to init runner for loaded scenario'}), 500
-        
-        sessions[new_id] = sim_runner
-        current_session = sim_runner
-        app.logger.info(f"Loaded scenario '{sane_name}' into session {new_id}.")
+        with open(path, 'r') as f: scenario_data = json.load(f)
+        loaded_cfg = load_scenario_config(scenario_data)
+        try: chaos_config(loaded_cfg)
+        except ValueError as e: return jsonify({'error': str(e)}), 400
+        new_id, _ = start_session(lambda sid: pool.open(sid, loaded_cfg, high_water=int(scenario_data.get('high_water', DEFAULT_HIGH_WATER)),
+                                                        checkpoint_dir=os.path.join(CHECKPOINT_DIR, sid), checkpoint_every=int(scenario_data.get('checkpoint_every', 0))))
+        app.logger.info(f"Loaded scenario '{filename}' into session {new_id}.")
         return jsonify({'session_id': new_id, 'system_config': loaded_cfg})
     except Exception as e:
         app.logger.exception(f"Error loading scenario {filename}")
@@ -0,0 +1,103 @@
+# session_manager.py (Bounded set of live simulation sessions)
+#
+# The server keeps one FrameProducer per session. A SessionManager holds them in least-recently-used
+# order and stops and drops sessions once they sit idle for longer than idle_ttl seconds, once there
+# are more than max_sessions of them, or once together they hold more than max_bytes of buffers, so a
+# long-running server stays within bounded memory however many sessions clients open. A dropped session's
+# auto-checkpoints go with it, so its disk use stays bounded too.
+import collections
+import os
+import shutil
+import threading
+import time
+
+DEFAULT_MAX_SESSIONS = 16
+DEFAULT_IDLE_TTL = 30 * 60.0 # Seconds without a request before a session is dropped
+DEFAULT_MAX_BYTES = 4 << 30 # Buffers of all sessions together
+
+class SessionManager:
+    """ Maps session ids to FrameProducers like a dict. Looking a session up marks it as used, and
+        adding one evicts idle and least recently used sessions until the limits hold again. The
+        session just added is never evicted, so a single oversized session still runs. With checkpoint_dir
+        set, dropping a session also deletes checkpoint_dir/<session id>/, where it writes auto-checkpoints. """
+    def __init__(self, max_sessions: int = DEFAULT_MAX_SESSIONS, idle_ttl: float = DEFAULT_IDLE_TTL, max_bytes: int = DEFAULT_MAX_BYTES,
+                 checkpoint_dir: str = None):
+        self.max_sessions, self.idle_ttl, self.max_bytes = max(max_sessions, 1), idle_ttl, max_bytes
+        self.checkpoint_dir = checkpoint_dir
+        self.evictions = collections.Counter() # Reason -> sessions dropped for it
+        self._sessions = collections.OrderedDict() # Session id -> (producer, created, last used), least recently used first
+        self._lock = threading.Lock()
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def __getitem__(self, session_id):
+        producer = self.get(session_id)
+        if producer is None: raise KeyError(session_id)
+        return producer
+
+    def __setitem__(self, session_id, producer):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_id] = (producer, now, now)
+            self._sessions.move_to_end(session_id)
+        self.evict(keep=session_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id, default=None):
+        """ The session's producer, marked as just used, or default if there is no such live session """
+        self.evict_idle()
+        with self._lock:
+            if session_id not in self._sessions: return default
+            producer, created, _ = self._sessions[session_id]
+            self._sessions[session_id] = (producer, created, time.monotonic())
+            self._sessions.move_to_end(session_id)
+            return producer
+
+    def remove(self, session_id, reason: str = 'removed') -> bool:
+        """ Stops and drops a session; returns whether it existed """
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None: return False
+            self.evictions[reason] += 1
+        entry[0].stop() # Outside the lock: the worker may finish its current chunk first
+        if self.checkpoint_dir: # After stop, so no auto-checkpoint lands in it afterwards
+            shutil.rmtree(os.path.join(self.checkpoint_dir, session_id), ignore_errors=True)
+        return True
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [sid for sid, (_, _, used) in self._sessions.items() if now - used > self.idle_ttl]
+        for sid in idle: self.remove(sid, 'idle')
+
+    def evict(self, keep=None):
+        """ Drops idle sessions, then least recently used ones (other than keep) while there are more than
+            max_sessions or they hold more than max_bytes """
+        self.evict_idle()
+        while True:
+            with self._lock:
+                victims = [sid for sid in self._sessions if sid != keep]
+                over_count = len(self._sessions) > self.max_sessions
+                producers = [producer for producer, _, _ in self._sessions.values()]
+            if not victims: return
+            if over_count: self.remove(victims[0], 'count')
+            elif sum(p.memory_bytes() for p in producers) > self.max_bytes: self.remove(victims[0], 'memory')
+            else: return
+
+    def stats(self) -> dict:
+        """ Limits, eviction counts and every session's age, idle time and memory, least recently used first """
+        self.evict_idle()
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._sessions.items())
+        sessions = []
+        for sid, (producer, created, used) in entries:
+            cfg = producer.cfg
+            sessions.append({'session_id': sid, 'name': cfg.name, 'bodies': cfg.current_n_bodies, 'precision': cfg.precision,
+                             'frame': producer.frame, 'buffered_frames': producer.buffered_frames,
+                             'age_seconds': now - created, 'idle_seconds': now - used, 'bytes': producer.memory_bytes()})
+        return {'max_sessions': self.max_sessions, 'idle_ttl_seconds': self.idle_ttl, 'max_bytes': self.max_bytes,
+                'total_bytes': sum(s['bytes'] for s in sessions), 'evictions': dict(self.evictions), 'sessions': sessions}
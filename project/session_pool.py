@@ -0,0 +1,300 @@
+# session_pool.py (Simulation sessions spread over worker processes)
+#
+# A FrameProducer's native stepping releases the GIL, but the Python around it (unpacking states,
+# buffering frames, tree bookkeeping) still shares one interpreter with the server and every other
+# session. A SessionPool starts up to one worker process per core, places each new session on the
+# worker with the fewest sessions, and hands back a RemoteFrameProducer that the server uses like a
+# FrameProducer. Calls travel as small messages over a pipe and are served on their own thread in the
+# worker, so a blocking wait on one session never holds up another. Drained positions come back through
+# a block of shared memory per session instead of being pickled.
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import checkpoint
+import planetary_motion as pm
+import utils
+from frame_producer import FrameProducer, DEFAULT_HIGH_WATER
+
+POSITION_DTYPES = {'single': np.float32, 'double': np.float64}
+
+class _SessionHost:
+    """ The sessions of one worker process, run by FrameProducers as in the server process """
+    def __init__(self, compile_lock):
+        self.compile_lock = compile_lock # Shared by all workers: they compile to the same library files
+        self.producers, self.frames, self.compiled = {}, {}, {}
+
+    def _compile(self, cfg):
+        # Each worker compiles the loma code once per precision and shares the library among its sessions
+        key = (cfg.loma_code_file, cfg.precision)
+        with self.compile_lock:
+            if key not in self.compiled:
+                structs, lib = pm.compile_loma_code(cfg.loma_code_file, pm.COMPILED_LIB_NAME_PREFIX_3D, cfg.precision)
+                if not structs or not lib: raise RuntimeError(f"Failed to compile {cfg.loma_code_file}")
+                self.compiled[key] = structs, lib
+        return self.compiled[key]
+
+    def _producer(self, session_id):
+        if session_id not in self.producers: raise RuntimeError(f"No session {session_id} in this worker")
+        return self.producers[session_id]
+
+    def _start(self, session_id, runner, high_water):
+        self.producers[session_id] = FrameProducer(runner, high_water=high_water)
+        return runner.cfg, runner.initial_cfg, runner.frame
+
+    def ping(self, _):
+        return os.getpid()
+
+    def open(self, session_id, cfg, high_water, checkpoint_dir, checkpoint_every):
+        runner = pm.SimulationRunner(cfg, *self._compile(cfg), checkpoint_dir, checkpoint_every)
+        return self._start(session_id, runner, high_water)
+
+    def restore(self, session_id, path, high_water, checkpoint_dir):
+        cfg, _, _ = checkpoint.read_checkpoint(path)
+        runner = pm.SimulationRunner(cfg, *self._compile(cfg), checkpoint_dir)
+        runner.restore_checkpoint(path)
+        return self._start(session_id, runner, high_water)
+
+    def attach(self, session_id, shm_name, shape, dtype):
+        # Views onto the session's shared block: positions (frames, N, 3), then the (frames, N) present mask
+        shm = shared_memory.SharedMemory(name=shm_name)
+        positions = np.ndarray(shape, dtype, buffer=shm.buf)
+        present = np.ndarray(shape[:2], bool, buffer=shm.buf, offset=positions.nbytes)
+        self.frames[session_id] = shm, positions, present
+
+    def drain(self, session_id, max_frames, timeout):
+        # Copies the drained frames into the shared block; only their count, diagnostics and chaos indicators go back
+        producer, (_, positions, present) = self._producer(session_id), self.frames[session_id]
+        max_frames = len(positions) if max_frames is None else min(max_frames, len(positions))
+        first_frame, drained_positions, drained_present = producer.drain_positions(max_frames, timeout)
+        n = len(drained_positions)
+        positions[:n], present[:n] = drained_positions, drained_present
+        return first_frame, n, producer.diagnostics, producer.chaos
+
+    def call(self, session_id, name, *args):
+        # A FrameProducer method called with args, or the value of one of its attributes
+        value = getattr(self._producer(session_id), name)
+        return value(*args) if callable(value) else value
+
+    def close(self, session_id):
+        producer = self.producers.pop(session_id, None)
+        if producer is not None: producer.stop()
+        shm, positions, present = self.frames.pop(session_id, (None, None, None))
+        del positions, present # The block can only be closed once no view exports it
+        try:
+            if shm is not None: shm.close()
+        except BufferError: pass # A drain still copying holds a view; the block is unmapped when it lets go
+
+def _serve(conn, compile_lock):
+    # Worker process main loop: every (call id, method, session id, args) message is served on its own thread
+    host, send_lock = _SessionHost(compile_lock), threading.Lock()
+
+    def handle(call_id, method, session_id, args):
+        try: reply = (call_id, True, getattr(host, method)(session_id, *args))
+        except Exception as e: reply = (call_id, False, e)
+        with send_lock:
+            try: conn.send(reply)
+            except Exception as e: conn.send((call_id, False, RuntimeError(f"{method} on {session_id}: unpicklable reply: {e!r}")))
+
+    while True:
+        try: message = conn.recv()
+        except EOFError: break
+        if message is None: break
+        threading.Thread(target=handle, args=message, daemon=True).start()
+    for session_id in list(host.producers): host.close(session_id)
+
+class _Worker:
+    """ Server side of one worker process: sends calls and hands each reply to the thread waiting on it """
+    def __init__(self, context, compile_lock, index: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn, compile_lock), name=f"sessions-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.sessions = 0 # Live sessions placed here
+        self._pending, self._call_ids, self._lock = {}, itertools.count(), threading.Lock()
+        threading.Thread(target=self._read_replies, name=f"{self.process.name}-replies", daemon=True).start()
+        self.call('ping', None) # Wait for the worker to finish importing before another one starts
+
+    @property
+    def alive(self): return self._pending is not None
+
+    def submit(self, method: str, session_id, *args) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._pending is None: raise RuntimeError(f"Worker process {self.process.name} has exited")
+            call_id = next(self._call_ids)
+            self._pending[call_id] = future
+            self.conn.send((call_id, method, session_id, args))
+        return future
+
+    def call(self, method: str, session_id, *args):
+        return self.submit(method, session_id, *args).result()
+
+    def _read_replies(self):
+        while True:
+            try: call_id, ok, result = self.conn.recv()
+            except (EOFError, OSError): break
+            with self._lock: future = self._pending.pop(call_id)
+            if ok: future.set_result(result)
+            else: future.set_exception(result)
+        with self._lock: pending, self._pending = self._pending, None
+        for future in pending.values(): future.set_exception(RuntimeError(f"Worker process {self.process.name} has exited"))
+
+    def close(self):
+        with self._lock:
+            if self._pending is not None: self.conn.send(None)
+        self.process.join(timeout=10.0)
+        if self.process.is_alive(): self.process.terminate()
+        self.conn.close()
+
+class RemoteFrameProducer:
+    """ Stands in for the FrameProducer of a session that runs in a worker process """
+    def __init__(self, worker: _Worker, session_id: str, started, high_water: int, release):
+        _, self.initial_cfg, self._next_frame = started
+        self.session_id, self.diagnostics, self.chaos = session_id, None, None
+        self._worker, self._release, self._closed = worker, release, False # release(worker, producer) once stopped
+        self._drain_lock, self._close_lock = threading.Lock(), threading.Lock()
+        shape = (max(high_water, 1), self.initial_cfg.current_n_bodies, 3)
+        dtype = np.dtype(POSITION_DTYPES[self.initial_cfg.precision])
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * dtype.itemsize + shape[0] * shape[1])
+        self._positions = np.ndarray(shape, dtype, buffer=self._shm.buf)
+        self._present = np.ndarray(shape[:2], bool, buffer=self._shm.buf, offset=self._positions.nbytes)
+        worker.call('attach', session_id, self._shm.name, shape, dtype.str)
+
+    def _call(self, name, *args): return self.submit(name, *args).result()
+
+    def submit(self, name, *args) -> concurrent.futures.Future:
+        """ Calls the worker's producer without waiting for the reply, e.g. so an event loop can await it """
+        return self._worker.submit('call', self.session_id, name, *args)
+
+    def _get(self, name, gone):
+        # An attribute of the worker's producer, or gone once the session or its worker has ended
+        return gone if self._closed or not self._worker.alive else self._call(name)
+
+    cfg = property(lambda self: self._get('cfg', self.initial_cfg))
+    frame = property(lambda self: self._get('frame', self._next_frame))
+    acked = property(lambda self: self._get('acked', self._next_frame))
+    error = property(lambda self: self._get('error', None if self._closed else RuntimeError(f"Worker process {self._worker.process.name} has exited")))
+    stopped = property(lambda self: self._get('stopped', True))
+    buffered_frames = property(lambda self: self._get('buffered_frames', 0))
+    collisions = property(lambda self: self._get('collisions', []))
+
+    def drain_positions(self, max_frames: int = None, timeout: float = 30.0):
+        """ As FrameProducer.drain_positions; the frames are copied out of the session's shared block """
+        with self._drain_lock:
+            if self._closed: # Like a stopped FrameProducer, hand over no frames
+                n_bodies = self.initial_cfg.current_n_bodies
+                return self._next_frame, np.empty((0, n_bodies, 3), POSITION_DTYPES[self.initial_cfg.precision]), np.empty((0, n_bodies), bool)
+            first_frame, n, diagnostics, chaos = self._worker.call('drain', self.session_id, max_frames, timeout)
+            positions, present = self._positions[:n].copy(), self._present[:n].copy()
+            self._next_frame = first_frame + n
+        if diagnostics is not None: self.diagnostics = diagnostics
+        if chaos is not None: self.chaos = chaos
+        return first_frame, positions, present
+
+    def drain(self, max_frames: int = None, timeout: float = 30.0):
+        _, positions, present = self.drain_positions(max_frames, timeout)
+        return utils.convert_positions_to_body_states(positions, present, self.initial_cfg)
+
+    __call__ = drain
+
+    def ack(self, frame: int): self._call('ack', frame)
+
+    def wait_for_window(self, window: int, timeout: float) -> int:
+        return 0 if self.stopped else self._call('wait_for_window', window, timeout)
+
+    def seek(self, frame: int): self._call('seek', frame)
+
+    def save_checkpoint(self, directory: str, prefix: str): return self._call('save_checkpoint', directory, prefix)
+
+    def memory_bytes(self) -> int:
+        """ Bytes held in the worker for this session, plus its shared block """
+        return self._get('memory_bytes', 0) + self._shm.size
+
+    def stop(self):
+        with self._close_lock:
+            if self._closed: return
+            self._closed = True
+        # Closing stops the worker's producer first, which wakes a drain waiting on it before the block goes
+        try: self._worker.call('close', self.session_id)
+        except RuntimeError: pass # The worker already exited, taking the session with it
+        self._release(self._worker, self)
+        with self._drain_lock:
+            self._positions = self._present = None
+            self._shm.close()
+            self._shm.unlink()
+
+class SessionPool:
+    """ Opens sessions on up to processes worker processes (one per core by default), each new session on
+        the worker with the fewest. Workers start as sessions need them. With processes=0 sessions run on
+        threads of the server process as plain FrameProducers. """
+    def __init__(self, processes: int = None):
+        self.processes = (os.cpu_count() or 1) if processes is None else max(processes, 0)
+        self._workers, self._worker_ids = [], itertools.count()
+        self._producers = set() # Live RemoteFrameProducers, stopped by close()
+        self._context = multiprocessing.get_context('spawn') # Forking a threaded server would copy held locks
+        self._compile_lock = None
+        self._lock = threading.Lock()
+
+    @property
+    def in_process(self) -> bool:
+        # A daemonic process, such as a server's own worker process, may not start worker processes of its own
+        if self.processes and multiprocessing.current_process().daemon:
+            logging.warning("SessionPool: running sessions in-process, a daemonic process cannot start workers")
+            self.processes = 0
+        return not self.processes
+
+    def _place(self) -> _Worker:
+        with self._lock:
+            self._workers = [w for w in self._workers if w.alive]
+            worker = min(self._workers, key=lambda w: w.sessions, default=None)
+            if worker is None or (worker.sessions and len(self._workers) < self.processes):
+                if self._compile_lock is None: self._compile_lock = self._context.Lock()
+                worker = _Worker(self._context, self._compile_lock, next(self._worker_ids))
+                self._workers.append(worker)
+            worker.sessions += 1
+            return worker
+
+    def _release(self, worker: _Worker, producer=None):
+        # Undoes _place once a session on worker has stopped, or failed to open
+        with self._lock:
+            worker.sessions -= 1
+            self._producers.discard(producer)
+
+    def _open_on_worker(self, session_id, method, *args, high_water):
+        worker = self._place()
+        try:
+            producer = RemoteFrameProducer(worker, session_id, worker.call(method, session_id, *args), high_water, self._release)
+        except Exception:
+            self._release(worker)
+            if worker.alive: worker.call('close', session_id) # Never raises: closing an unknown session does nothing
+            raise
+        with self._lock: self._producers.add(producer)
+        return producer
+
+    def open(self, session_id: str, cfg, high_water: int = DEFAULT_HIGH_WATER, checkpoint_dir: str = None, checkpoint_every: int = 0):
+        """ Starts a session simulating cfg and returns its producer """
+        if self.in_process:
+            runner = pm.get_simulation_runner(cfg, checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every)
+            if not isinstance(runner, pm.SimulationRunner): raise RuntimeError("Failed to init sim runner")
+            return FrameProducer(runner, high_water=high_water)
+        return self._open_on_worker(session_id, 'open', cfg, high_water, checkpoint_dir, checkpoint_every, high_water=high_water)
+
+    def restore(self, session_id: str, path: str, high_water: int = DEFAULT_HIGH_WATER, checkpoint_dir: str = None):
+        """ Starts a session resumed from the checkpoint at path and returns its producer """
+        if self.in_process:
+            return FrameProducer(pm.SimulationRunner.from_checkpoint(path, checkpoint_dir=checkpoint_dir), high_water=high_water)
+        return self._open_on_worker(session_id, 'restore', path, high_water, checkpoint_dir, high_water=high_water)
+
+    def close(self):
+        """ Stops every session, which frees its shared block, then every worker process """
+        with self._lock:
+            producers = list(self._producers)
+        for producer in producers: producer.stop()
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers: worker.close()
@@ -75,6 +75,7 @@ let isPlayingGlobal = false,
   animationFrameId = null,
   originalSimulationNameForReset = '';
 let lastPositionTableUpdateTime = 0;
+let frameStream = null;
 
 function convertVelocityToAuYear(vx, vy, vz, unit) {
   if (isNaN(vx) || isNaN(vy) || isNaN(vz)) return {x: 0, y: 0, z: 0};
@@ -410,8 +411,40 @@ const initAnimation = (initialChronology, sessionData) => {
   document.getElementById('years').innerHTML = `${yearsGoneBy.toFixed(
     3,
   )} years`;
-  let stateLock = false;
   let cameraFollowing = false;
+  // Frames are pushed over /stream; acknowledging the played ones lets the server run up to 5 s ahead
+  let playedFrame = initialChronology.firstFrame || 0,
+    ackedFrame = playedFrame;
+  if (frameStream) frameStream.close();
+  frameStream = null;
+  if (currentSimSessionId) {
+    const sessionId = currentSimSessionId;
+    const windowFrames = Math.max(
+      Math.ceil(system_config.fps * STREAM_BUFFER_SECONDS),
+      1,
+    );
+    frameStream = new EventSource(
+      `/stream/${sessionId}?window=${windowFrames}`,
+    );
+    frameStream.addEventListener('frames', e => {
+      const bytes = Uint8Array.from(atob(e.data), c => c.charCodeAt(0));
+      chronology.push(...decodeFrames(bytes.buffer));
+    });
+    frameStream.addEventListener('sim_error', e => {
+      console.error('Stream error:', JSON.parse(e.data));
+      frameStream.close();
+    });
+  }
+  const ackPlayedFrames = () => {
+    if (playedFrame - ackedFrame < STREAM_ACK_FRAMES || !currentSimSessionId)
+      return;
+    ackedFrame = playedFrame;
+    fetch(`/ack/${currentSimSessionId}`, {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({frame: ackedFrame}),
+    }).catch(e => console.error('Err ack frames:', e));
+  };
   const playBtn = document.querySelector('#playButton'),
     pauseBtn = document.querySelector('#pauseButton'),
     camFollowBtn = document.querySelector('#cameraFollow');
@@ -445,7 +478,11 @@ const initAnimation = (initialChronology, sessionData) => {
             sumZ = 0,
             activeBodies = 0;
           currentFrameData.forEach((state, index) => {
-            if (planetObjects[index] && planetObjects[index].body) {
+            if (
+              planetObjects[index] &&
+              planetObjects[index].body &&
+              !isNaN(state.pos[0])
+            ) {
               const planetObj = planetObjects[index];
               let currentPosArray = [0, 0, 0];
               if (Array.isArray(state.pos) && state.pos.length === 3)
@@ -502,6 +539,8 @@ const initAnimation = (initialChronology, sessionData) => {
               sumZ / activeBodies,
             );
           currentFrameIndex++;
+          playedFrame++;
+          ackPlayedFrames();
           yearsGoneBy += system_config.years_per_frame;
           document.getElementById('years').innerHTML = `${yearsGoneBy.toFixed(
             3,
@@ -510,31 +549,11 @@ const initAnimation = (initialChronology, sessionData) => {
       }
 
       if (
-        !stateLock &&
-        currentSimSessionId &&
-        system_config &&
-        (chronology.length - currentFrameIndex) / system_config.fps < 5.0
-      ) {
-        stateLock = true;
-        getNextStatesChunk(currentSimSessionId)
-          .then(nC => {
-            if (nC && nC.length > 0) chronology.push(...nC);
-            stateLock = false;
-          })
-          .catch(e => {
-            console.error('Err fetch states:', e);
-            stateLock = false;
-          });
-      }
-      if (
-        !stateLock &&
         currentFrameIndex > 800 &&
         chronology.length > currentFrameIndex + 200
       ) {
-        stateLock = true;
         chronology = chronology.slice(currentFrameIndex);
         currentFrameIndex = 0;
-        stateLock = false;
       }
     }
     if (camera) {
@@ -563,17 +582,49 @@ const initAnimation = (initialChronology, sessionData) => {
   animateFrame();
 };
 
+// /state_binary header: magic 'LOMF', version, first frame, frames, bodies (little-endian uint32 each),
+// then float32 positions as [frame][body][xyz] over system_config's bodies, NaN once a body has merged away
+const STATE_HEADER_BYTES = 20;
+const STREAM_BUFFER_SECONDS = 5.0;
+const STREAM_ACK_FRAMES = 30;
+
+// Frames of a /state_binary payload as lists of {name, mass, pos}, with the first one's frame number as firstFrame
+const decodeFrames = buffer => {
+  const header = new DataView(buffer, 0, STATE_HEADER_BYTES);
+  const nFrames = header.getUint32(12, true),
+    nBodies = header.getUint32(16, true);
+  const positions = new Float32Array(buffer, STATE_HEADER_BYTES);
+  const bodies =
+    (currentSimConfigData &&
+      currentSimConfigData.system_config &&
+      currentSimConfigData.system_config.initial_bodies_data) ||
+    [];
+  const frames = [];
+  for (let f = 0; f < nFrames; f++) {
+    const frame = [];
+    for (let b = 0; b < nBodies; b++) {
+      const o = (f * nBodies + b) * 3;
+      frame.push({
+        name: bodies[b] ? bodies[b].name : `Body ${b + 1}`,
+        mass: bodies[b] ? bodies[b].mass : 0,
+        pos: [positions[o], positions[o + 1], positions[o + 2]],
+      });
+    }
+    frames.push(frame);
+  }
+  frames.firstFrame = header.getUint32(8, true);
+  return frames;
+};
+
 const getNextStatesChunk = async sessionId => {
   if (!sessionId) return [];
   try {
-    const r = await fetch(`/state/${sessionId}`);
+    const r = await fetch(`/state_binary/${sessionId}`);
     if (!r.ok) {
       const eD = await r.json().catch(() => ({e: `Server error: ${r.status}`}));
       throw new Error(eD.error || `Server error: ${r.status}`);
     }
-    const d = await r.json();
-    if (!d || !Array.isArray(d)) return [];
-    return d;
+    return decodeFrames(await r.arrayBuffer());
   } catch (e) {
     console.error('Err fetch chunk:', e);
     return [];
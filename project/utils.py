@@ -1,6 +1,11 @@
 # utils.py
+import ctypes
+import numpy as np
 from config import BodyState, SolarSystemConfig
 
+SOA_FIELDS = {'x': ('pos', 'x'), 'y': ('pos', 'y'), 'z': ('pos', 'z'), 'px': ('mom', 'x'), 'py': ('mom', 'y'), 'pz': ('mom', 'z'),
+              'mass': ('mass',), 'inv_mass': ('inv_mass',), 'radius': ('radius',)} # Structure-of-arrays name -> loma BodyState field
+
 def convert_ctype_state_to_body_state(ctype_state_array, cfg: SolarSystemConfig) -> list[BodyState]:
     body_configs_list = []
     for i in range(cfg.current_n_bodies):
@@ -20,4 +25,45 @@ def convert_ctype_state_to_body_state(ctype_state_array, cfg: SolarSystemConfig)
         # Leaving it as default to avoid unnecessary computation.
 
         body_configs_list.append(py_body_state)
-    return body_configs_list
\ No newline at end of file
+    return body_configs_list
+
+def convert_positions_to_body_states(positions: np.ndarray, present: np.ndarray, cfg: SolarSystemConfig) -> list[list[BodyState]]:
+    # positions is a (frames, N, 3) array over cfg's bodies and present the (frames, N) mask of the bodies in each frame
+    names = [b.name for b in cfg.initial_bodies_data]
+    masses = [b.mass for b in cfg.initial_bodies_data]
+    frames = []
+    for frame_positions, frame_present in zip(positions.tolist(), present):
+        frames.append([BodyState(name=names[i], mass=masses[i], pos=tuple(frame_positions[i])) for i in np.flatnonzero(frame_present)])
+    return frames
+
+def body_states_to_soa(ctype_state_array, n_bodies: int) -> dict[str, np.ndarray]:
+    # Copies the first n_bodies of a loma BodyState array into one contiguous array per SOA_FIELDS entry
+    states = np.ctypeslib.as_array(ctype_state_array)[:n_bodies]
+    soa = {}
+    for name, field in SOA_FIELDS.items():
+        column = states
+        for part in field: column = column[part]
+        soa[name] = np.ascontiguousarray(column)
+    return soa
+
+def soa_to_body_states(soa: dict[str, np.ndarray], ctype_state_array):
+    # Writes the arrays of soa (any subset of SOA_FIELDS) into the leading entries of a loma BodyState array, in place
+    states = np.ctypeslib.as_array(ctype_state_array)
+    for name, values in soa.items():
+        column = states
+        for part in SOA_FIELDS[name]: column = column[part]
+        column[:len(values)] = values
+
+def ctypes_nbytes(*objects) -> int:
+    # Bytes of the ctypes buffers objects hold, including every buffer kept alive behind their pointers
+    # (ctypes.cast and pointer fields keep their source in _objects), each counted once
+    seen, pending, total = set(), list(objects), 0
+    while pending:
+        obj = pending.pop()
+        if isinstance(obj, dict):
+            pending.extend(obj.values())
+        elif isinstance(obj, (ctypes.Array, ctypes.Structure, ctypes._Pointer)) and id(obj) not in seen:
+            seen.add(id(obj))
+            if not isinstance(obj, ctypes._Pointer): total += ctypes.sizeof(obj)
+            if obj._objects is not None: pending.append(obj._objects)
+    return total
@@ -270,6 +270,9 @@ def reverse_diff(diff_func_id: str,
             self.primal_out_arg_names_of_original_func = primal_out_arg_names_of_original_func
             self.original_func_args_full_spec = original_func_args_full_spec
             self.ordered_primary_loop_counters = []
+            # primal loop counter of each while loop, keyed by the loop node,
+            # so the reverse pass does not depend on the visiting order
+            self.loop_counter_by_node = {}
 
         def _get_cache_size_increment(self):
             if self.loop_level == 0:
@@ -300,6 +303,7 @@ def reverse_diff(diff_func_id: str,
             self.loop_max_iters = {}
             self.func_level_loop_var_declarations = []
             self.ordered_primary_loop_counters = []
+            self.loop_counter_by_node = {}
             new_body = irmutator.flatten(
                 [self.mutate_stmt(s) for s in node.body])
 
@@ -438,6 +442,7 @@ def reverse_diff(diff_func_id: str,
                 l_var_n = f'_loop_var_{curr_lvl}_{random_id_generator(size=4)}'
             self.all_declared_loop_counters.add(l_var_n)
             self.ordered_primary_loop_counters.append(l_var_n)
+            self.loop_counter_by_node[id(node)] = l_var_n
             self.current_loop_counter_name_stack.append(l_var_n)
             self.loop_max_iters[l_var_n] = node.max_iter if node.max_iter else 10
             self.func_level_loop_var_declarations.append(loma_ir.Declare(
@@ -606,6 +611,7 @@ def reverse_diff(diff_func_id: str,
             self.current_original_func_out_names = set()
             self.is_differentiating_helper_func = False
             self.primal_ordered_primary_loop_counters = []
+            self.primal_loop_counter_by_node = {}
             self.rev_pass_fwd_ordered_loop_idx = 0
 
         def mutate_function_def(self, node: loma_ir.FunctionDef) -> loma_ir.FunctionDef:
@@ -685,6 +691,7 @@ def reverse_diff(diff_func_id: str,
             val_stack_decls = []
 
             self.primal_ordered_primary_loop_counters = fm.ordered_primary_loop_counters.copy()
+            self.primal_loop_counter_by_node = fm.loop_counter_by_node
             self.rev_pass_fwd_ordered_loop_idx = 0
 
             unique_fm_loop_decls = []
@@ -900,8 +907,11 @@ def reverse_diff(diff_func_id: str,
             if self.rev_pass_fwd_ordered_loop_idx >= len(self.primal_ordered_primary_loop_counters):
                 raise IndexError(
                     f"RDM While: Forward loop counter index {self.rev_pass_fwd_ordered_loop_idx} out of bounds for list of size {len(self.primal_ordered_primary_loop_counters)}.")
-            curr_loop_prim_count_n = self.primal_ordered_primary_loop_counters[
-                self.rev_pass_fwd_ordered_loop_idx]
+            # the reverse pass visits sibling loops last-to-first, so look the
+            # counter up by node instead of by forward visiting order
+            curr_loop_prim_count_n = self.primal_loop_counter_by_node.get(
+                id(node), self.primal_ordered_primary_loop_counters[
+                    self.rev_pass_fwd_ordered_loop_idx])
             self.rev_pass_fwd_ordered_loop_idx += 1
 
             self.rdm_current_loop_counter_name_stack.append(
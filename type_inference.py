@@ -110,9 +110,8 @@ class TypeInferencer(irmutator.IRMutator):
             lineno = ret.lineno)
 
     def mutate_declare(self, dec):
-        t = dec.t
-        if isinstance(t, loma_ir.Struct) and len(t.members) == 0:
-            t = self.structs[t.id]
+        # also fills in arrays of structs, e.g., x : Array[Foo, 10]
+        t = fill_in_struct_info(dec.t, self.structs)
         self.var_types[dec.target] = t
         if dec.val is not None:
             new_val = self.mutate_expr(dec.val)
@@ -297,9 +296,9 @@ class TypeInferencer(irmutator.IRMutator):
             elif isinstance(f, loma_ir.ForwardDiff):
                 primal_f = self.funcs[f.primal_func]
                 f_args = [\
-                    loma_ir.Arg(arg.id, autodiff.type_to_diff_type(self.diff_structs, arg.t), arg.i) \
+                    loma_ir.Arg(arg.id, autodiff.type_to_diff_type(self.diff_structs, arg.t, f.width), arg.i) \
                     for arg in primal_f.args]
-                ret_type = autodiff.type_to_diff_type(self.diff_structs, primal_f.ret_type)
+                ret_type = autodiff.type_to_diff_type(self.diff_structs, primal_f.ret_type, f.width)
             elif isinstance(f, loma_ir.ReverseDiff):
                 primal_f = self.funcs[f.primal_func]
                 f_args = []
@@ -327,6 +326,10 @@ class TypeInferencer(irmutator.IRMutator):
                         [args[i]], lineno = args[i].lineno, t = loma_ir.Int())
                     call_arg = args[i]
 
+                # A statically sized array can be passed where an unsized one is expected
+                if isinstance(call_arg.t, loma_ir.Array) and isinstance(f_arg.t, loma_ir.Array) and \
+                        f_arg.t.static_size is None and call_arg.t.t == f_arg.t.t:
+                    continue
                 if call_arg.t != f_arg.t:
                     raise error.CallTypeMismatch(call)
             inf_type = ret_type